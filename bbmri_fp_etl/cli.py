@@ -0,0 +1,257 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Command line interface that runs a conversion described by a YAML configuration file:
+
+    bbmri-fp-etl config.yaml --workers 8 --compression gzip
+
+The configuration specifies the source class, with the arguments of its constructor, the destination and the
+output, and optionally the options of the Converter. For example:
+
+    source:
+      class: mypackage.sources.MySource
+      args:
+        path: data.csv
+    resource_type: case
+    destination:
+      type: omop
+      id_allocator: omop_ids.db
+    output:
+      type: streaming_csv
+      directory: output
+      staged: true
+    converter:
+      workers: 4
+      chunk_size: 100
+    state_store: state.db
+    metrics:
+      json_path: metrics.json
+
+The options of the output (and of the Converter) are passed as they are to the constructor of the class (e.g.,
+directory and compression for a JsonFile). The command line options override the ones in the file
+"""
+import argparse
+import cProfile
+import importlib
+import logging
+import os
+import sys
+import time
+
+import yaml
+
+from bbmri_fp_etl.converter import Converter
+from bbmri_fp_etl.metrics import Metrics
+from bbmri_fp_etl.serializer import ArchiveFile, CSVFile, FHIRServer, JsonFile, NDJsonFile, ParquetFile, \
+    SQLiteDatabase, StagedOutput, StreamingCSVFile
+
+logger = logging.getLogger('bbmri_fp_etl')
+
+# the destinations are imported only when they are used, so that the OMOP conversions do not load fhirclient
+DESTINATIONS = {
+    'fhir': ('bbmri_fp_etl.destinations.fhir', 'FHIRDest'),
+    'fast_fhir': ('bbmri_fp_etl.destinations.fhir_fast', 'FastFHIRDest'),
+    'omop': ('bbmri_fp_etl.destinations.omop', 'OMOPDest')
+}
+
+OUTPUTS = {
+    'json': JsonFile,
+    'ndjson': NDJsonFile,
+    'archive': ArchiveFile,
+    'csv': CSVFile,
+    'streaming_csv': StreamingCSVFile,
+    'parquet': ParquetFile,
+    'fhir_server': FHIRServer,
+    'sqlite': SQLiteDatabase
+}
+
+# the outputs that accept the compression option (gzip or zstd)
+COMPRESSED_OUTPUTS = ('json', 'ndjson', 'csv', 'streaming_csv')
+
+RESOURCE_TYPES = {
+    'case': Converter.CASE,
+    'organization': Converter.ORGANIZATION
+}
+
+
+def load_class(path):
+    """
+    Returns the class with the dotted path (e.g., mypackage.sources.MySource)
+    """
+    module_name, _, class_name = path.rpartition('.')
+    if not module_name:
+        raise ValueError(f'{path} is not a dotted path of a class')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def create_source(config):
+    source_config = dict(config['source'])
+    return load_class(source_config['class'])(**source_config.get('args', {}))
+
+
+def create_output(config):
+    output_config = dict(config['output'])
+    output_type = output_config.pop('type')
+    staged = output_config.pop('staged', False)
+    try:
+        output_class = OUTPUTS[output_type]
+    except KeyError:
+        raise ValueError(f'Unknown output type {output_type}. Available types: {", ".join(OUTPUTS)}') from None
+    if 'directory' in output_config:
+        os.makedirs(output_config['directory'], exist_ok=True)
+    if isinstance(output_config.get('auth'), list):
+        output_config['auth'] = tuple(output_config['auth'])
+    output = output_class(**output_config)
+    return StagedOutput(output) if staged else output
+
+
+def create_destination(config, output):
+    destination_config = dict(config['destination'])
+    destination_type = destination_config.pop('type')
+    try:
+        module_name, class_name = DESTINATIONS[destination_type]
+    except KeyError:
+        raise ValueError(f'Unknown destination type {destination_type}. '
+                         f'Available types: {", ".join(DESTINATIONS)}') from None
+    if destination_config.get('id_allocator') is not None:
+        from bbmri_fp_etl.ids import IdAllocator
+        destination_config['id_allocator'] = IdAllocator(destination_config['id_allocator'])
+    if destination_config.get('vocabulary') is not None:
+        from bbmri_fp_etl.vocabulary import ConceptIndex
+        destination_config['vocabulary'] = ConceptIndex(destination_config['vocabulary'])
+    destination_class = getattr(importlib.import_module(module_name), class_name)
+    return destination_class(output, **destination_config)
+
+
+def create_converter(config, source, destination):
+    converter_config = dict(config.get('converter') or {})
+    state_store = None
+    if config.get('state_store') is not None:
+        from bbmri_fp_etl.state import StateStore
+        state_store = StateStore(config['state_store'])
+    metrics = Metrics(**config['metrics']) if config.get('metrics') is not None else None
+    return Converter(source, destination, RESOURCE_TYPES[config.get('resource_type', 'case')],
+                     state_store=state_store, metrics=metrics, **converter_config)
+
+
+def apply_arguments(config, args):
+    """
+    Overrides the options of config with the ones specified in the command line. It raises a ValueError if an option
+    is not supported by the configuration
+    """
+    converter_config = config['converter'] = config.get('converter') or {}
+    for option in ('workers', 'chunk_size', 'prefetch', 'source_batch_size', 'checkpoint_path'):
+        if getattr(args, option) is not None:
+            converter_config[option] = getattr(args, option)
+    if args.source_batch_size is not None:
+        # the source is read in batches only by the prefetch thread
+        converter_config['prefetch'] = max(converter_config.get('prefetch') or 0, 1)
+    if args.resume:
+        converter_config['resume'] = True
+    if args.compression is not None:
+        output_type = (config.get('output') or {}).get('type')
+        if output_type not in COMPRESSED_OUTPUTS:
+            raise ValueError(f'--compression is supported only by the {", ".join(COMPRESSED_OUTPUTS)} outputs, '
+                             f'not by the {output_type} output')
+        config['output']['compression'] = args.compression
+    if args.state_store is not None:
+        config['state_store'] = args.state_store
+    if args.metrics is not None:
+        config['metrics'] = dict(config.get('metrics') or {}, json_path=args.metrics)
+    return config
+
+
+def print_summary(resource_type, count, skipped, elapsed, metrics=None):
+    """
+    Prints the number of records converted, the throughput and, if metrics are collected, the stages that took most
+    of the time
+    """
+    rate = count / elapsed if elapsed > 0 else 0
+    print(f'Converted {count} {resource_type}(s) in {elapsed:.2f} s ({rate:.1f} records/s)')
+    if skipped:
+        print(f'Skipped {skipped} unchanged {resource_type}(s)')
+    if metrics is not None:
+        stages = sorted(metrics.seconds.items(), key=lambda item: item[1], reverse=True)
+        for stage, seconds in stages[:10]:
+            print(f'  {stage}: {seconds:.2f} s in {metrics.calls[stage]} call(s)')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='bbmri-fp-etl', description='Converts the data of a source to the formats '
+                                                                      'of the BBMRI Federated Platform')
+    parser.add_argument('config', help='YAML configuration file of the conversion')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, help='number of records sent to a worker at a time')
+    parser.add_argument('--prefetch', type=int, help='number of batches of records read in advance from the source')
+    parser.add_argument('--batch-size', dest='source_batch_size', type=int,
+                        help='number of records of the batches read from the source. The batches are read by the '
+                             'prefetch thread, so it implies --prefetch 1 unless a prefetch is configured')
+    parser.add_argument('--compression', choices=('gzip', 'zstd'),
+                        help=f'compression of the output files. Supported by the {", ".join(COMPRESSED_OUTPUTS)} '
+                             f'outputs')
+    parser.add_argument('--state-store', help='SQLite database of the incremental conversion: only the records '
+                                              'changed since the previous run are converted')
+    parser.add_argument('--checkpoint-path', help='file where the progress of the conversion is saved')
+    parser.add_argument('--resume', action='store_true', help='resumes the conversion from the checkpoint')
+    parser.add_argument('--metrics', help='JSON file where the time spent in each stage is written')
+    parser.add_argument('--profile', help='file where the cProfile statistics of the conversion are written. Only '
+                                          'the main process is profiled')
+    parser.add_argument('-v', '--verbose', action='store_true', help='logs the progress of the conversion')
+    return parser
+
+
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+    if args.source_batch_size is not None and args.prefetch == 0:
+        parser.error('--batch-size requires prefetch: it cannot be used with --prefetch 0')
+    # the converter module configures the handler of the logger
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+    # the source classes are usually defined in the directory where the conversion is run
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    try:
+        config = apply_arguments(config, args)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        source = create_source(config)
+        destination = create_destination(config, create_output(config))
+        converter = create_converter(config, source, destination)
+    except (AssertionError, AttributeError, ImportError, KeyError, TypeError, ValueError) as e:
+        parser.error(f'invalid configuration: {e!r}')
+
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        count = converter.run()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+    print_summary(converter.resource_type, count, converter.skipped, time.perf_counter() - start, converter.metrics)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
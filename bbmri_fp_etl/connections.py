@@ -0,0 +1,54 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Helpers shared by the classes that keep a SQLite database open while they are used by worker processes
+"""
+import os
+
+
+class ProcessConnectionMixin:
+    """
+    Keeps one SQLite connection for each process, opened with _connect() the first time _get_connection() is called
+    in the process. The connection is not pickled, so the instances can be sent to worker processes
+    """
+    _connection = None
+    _pid = None
+
+    def _connect(self):
+        """
+        Returns a new connection to the database
+        """
+        raise NotImplementedError
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    def _get_connection(self):
+        # a connection cannot be used by a forked process: each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = self._connect()
+            self._pid = os.getpid()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
@@ -15,7 +15,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from bbmri_fp_etl.metrics import Metrics
+from bbmri_fp_etl.serializer import BaseOutput
+from bbmri_fp_etl.utils import chunks
+
+# the modules used only by some options (e.g., asyncio with use_async and pydantic, through models, with
+# validation_rate) are imported when they are used, to keep the import of the module fast
 
 logger = logging.getLogger('bbmri_fp_etl')
 logger.setLevel(logging.DEBUG)
@@ -26,34 +40,453 @@ console_handler.setLevel(logging.DEBUG)
 logger.addHandler(console_handler)
 
 
+class _RecordingOutput(BaseOutput):
+    """
+    Output used by the destinations in the worker processes. Instead of writing, it records the payloads created by
+    the payload encoder of the real output (e.g., the encoded JSON), which are sent back and written by the main
+    process. If the real output has no payload encoder, the arguments of the calls to serialize are recorded and
+    replayed
+    """
+
+    def __init__(self, payload_encoder=None):
+        self.payload_encoder = payload_encoder
+        self.calls = []
+
+    def serialize(self, *args, **kwargs):
+        if self.payload_encoder is not None:
+            self.calls.append(self.payload_encoder(*args, **kwargs))
+        else:
+            self.calls.append((args, kwargs))
+
+
+_worker_destination = None
+_worker_metrics = None
+
+
+def _get_instrumented_methods(destination):
+    """
+    Returns the names of the methods of the destination measured when metrics are enabled: the entry points and the
+    builders of the single resources or rows (i.e., the methods starting with _create)
+    """
+    return [name for name in dir(type(destination))
+            if name.startswith('_create') or name in ('create_participant', 'create_organizations', '_process_events',
+                                                      '_bundle_to_json')]
+
+
+def _init_worker(destination, instrument):
+    global _worker_destination, _worker_metrics
+    _worker_destination = destination
+    if instrument:
+        _worker_metrics = Metrics()
+        _worker_metrics.instrument(_worker_destination, _get_instrumented_methods(_worker_destination),
+                                   type(_worker_destination).__name__)
+
+
+def _convert_chunk(method_name, records):
+    convert = getattr(_worker_destination, method_name)
+    for record in records:
+        convert(record)
+    calls = _worker_destination.output.calls
+    _worker_destination.output.calls = []
+    metrics_state = None
+    if _worker_metrics is not None:
+        metrics_state = _worker_metrics.get_state()
+        _worker_metrics.reset()
+    return len(records), calls, metrics_state
+
+
+class _StopPrefetch(Exception):
+    pass
+
+
+class _PrefetchError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_PREFETCH_END = object()
+
+
 class Converter:
     ORGANIZATION = 'organization'
     CASE = 'case'
 
-    def __init__(self, source, destination, resource_type):
+    def __init__(self, source, destination, resource_type, log_interval=10000, workers=1, chunk_size=100,
+                 ordered=True, state_store=None, checkpoint_path=None, checkpoint_interval=10000, resume=False,
+                 metrics=None, prefetch=0, source_batch_size=1000, use_async=False, validation_rate=0.0):
+        """
+        :param source: an instance of AbstractSource
+        :param destination: the destination (e.g., FHIRDest, OMOPDest) the records are converted to
+        :param resource_type: one of Converter.ORGANIZATION or Converter.CASE
+        :param log_interval: number of records after which a progress message is logged. None or 0 disables it
+        :param workers: number of worker processes used for the conversion. With 1 the records are converted in
+            the current process
+        :param chunk_size: number of records sent to a worker process at a time
+        :param ordered: if True, the outputs are written in the same order of the records returned by the source,
+            otherwise they are written as soon as a worker completes
+        :param state_store: a StateStore to perform an incremental conversion. The records whose content did not
+            change since the previous run are skipped and the ones not returned anymore by the source are deleted
+            from the destination, if it supports deletions
+        :param checkpoint_path: path of a file where the progress of the conversion is saved every
+            checkpoint_interval records. It is removed when the conversion completes
+        :param checkpoint_interval: number of records between two checkpoints
+        :param resume: if True and the checkpoint file exists, the conversion continues from the last checkpoint:
+            the records already written are skipped and the output is restored to the checkpointed state. It
+            requires the source to return the records always in the same order
+        :param metrics: a Metrics instance that collects the time spent getting the records from the source, in the
+            methods of the destination and in the output, and exports it at the end of the conversion
+        :param prefetch: number of batches of records read in advance from the source by a background thread, so that
+            the source I/O overlaps with the conversion. With 0 the records are read when they are converted
+        :param source_batch_size: number of records of the batches read from the source when prefetch is used
+        :param use_async: if True, the records are read with the asynchronous methods of the source (e.g.,
+            aget_cases_data) in an event loop run by the background thread. It implies a prefetch of at least 1
+        :param validation_rate: fraction (between 0 and 1) of the records that are validated before the conversion.
+            It is meant to check sources that create the models without validation (see models.construct)
+        """
         assert resource_type in (self.ORGANIZATION, self.CASE)
+        assert workers >= 1 and chunk_size >= 1
+        # the checkpoint is the number of records written, so the outputs must be written in the source order
+        assert checkpoint_path is None or ordered, 'checkpoints require ordered outputs'
+        assert checkpoint_path is None or state_store is None, 'checkpoints are not supported in incremental mode'
+        assert not resume or checkpoint_path is not None, 'resume requires a checkpoint_path'
         self.source = source
         self.destination = destination
         self.resource_type = resource_type
+        self.log_interval = log_interval
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.state_store = state_store
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.metrics = metrics
+        self.prefetch = max(prefetch, 1) if use_async else prefetch
+        self.source_batch_size = source_batch_size
+        self.use_async = use_async
+        assert 0.0 <= validation_rate <= 1.0
+        self.validation_rate = validation_rate
+        self._skipped = 0
 
-    def run(self):
+    @property
+    def skipped(self):
+        """
+        The number of unchanged records skipped by the last incremental run
+        """
+        return self._skipped
+
+    def _validate_sample(self, records):
+        """
+        Validates a random sample of the records, raising the pydantic ValidationError of the first invalid one
+        """
+        import random
+        from bbmri_fp_etl.models import validate
+        rng = random.Random(0)
+        for record in records:
+            if rng.random() < self.validation_rate:
+                try:
+                    validate(record)
+                except Exception as e:
+                    logger.error('Invalid %s: %s', self.resource_type, e)
+                    raise
+            yield record
+
+    def _get_batches(self):
+        if self.resource_type == self.CASE:
+            return self.source.iter_case_batches(self.source_batch_size)
+        else:
+            return self.source.iter_biobank_batches(self.source_batch_size)
+
+    async def _get_async_batches(self, put):
+        if self.resource_type == self.CASE:
+            records = self.source.aget_cases_data()
+        else:
+            records = self.source.aget_biobanks_data()
+        batch = []
+        async for record in records:
+            batch.append(record)
+            if len(batch) == self.source_batch_size:
+                put(batch)
+                batch = []
+        if batch:
+            put(batch)
+
+    def _prefetch_records(self):
+        """
+        Reads the batches of records from the source in a background thread, keeping at most self.prefetch batches
+        in a queue, and yields the records one at a time
+        """
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def _put(item):
+            # blocks while the queue is full, unless the consumer stopped
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise _StopPrefetch()
+
+        def _produce():
+            try:
+                if self.use_async:
+                    import asyncio
+                    asyncio.run(self._get_async_batches(_put))
+                else:
+                    for batch in self._get_batches():
+                        _put(batch)
+                _put(_PREFETCH_END)
+            except _StopPrefetch:
+                pass
+            except Exception as e:
+                try:
+                    _put(_PrefetchError(e))
+                except _StopPrefetch:
+                    pass
+
+        logger.debug('Getting %s(s) from %s with prefetch', self.resource_type, self.source)
+        producer = threading.Thread(target=_produce, name='bbmri-fp-etl-prefetch', daemon=True)
+        producer.start()
+        try:
+            while (batch := batches.get()) is not _PREFETCH_END:
+                if isinstance(batch, _PrefetchError):
+                    logger.error(batch.exception)
+                    raise batch.exception
+                yield from batch
+        finally:
+            stop.set()
+            producer.join()
+
+    def _get_records(self):
+        if self.prefetch:
+            return self._prefetch_records()
         try:
             logger.debug('Getting %s(s) from %s', self.resource_type, self.source)
             if self.resource_type == self.CASE:
-                records = self.source.get_cases_data()
+                return self.source.get_cases_data()
             else:
-                records = self.source.get_biobanks_data()
+                return self.source.get_biobanks_data()
         except Exception as e:
             logger.error(e)
             raise e
-        else:
-            logger.debug('Done getting data. Found %s %s(s)', len(records), self.resource_type)
 
-        logger.debug('Generating outputs')
+    def _get_convert_method_name(self):
+        return 'create_participant' if self.resource_type == self.CASE else 'create_organizations'
+
+    def _filter_changed(self, records):
+        """
+        Yields only the records that are new or changed since the previous run, updating the state store.
+        For changed Cases, the samples and the events that are not present anymore are deleted from the destination
+        """
+        from bbmri_fp_etl.state import content_hash
         for record in records:
             if self.resource_type == self.CASE:
-                self.destination.create_participant(record)
+                id_ = record.donor.id
+            else:
+                id_ = record.id
+            hash_ = content_hash(record)
+            previous_hash = self.state_store.get_hash(self.resource_type, id_)
+            if previous_hash == hash_:
+                self.state_store.mark_seen(self.resource_type, id_)
+                self._skipped += 1
+                continue
+
+            children = None
+            if self.resource_type == self.CASE:
+                children = {
+                    self.state_store.SAMPLE: [s.id for s in record.samples if s is not None],
+                    self.state_store.EVENT: [e.id for e in record.donor.events or []]
+                }
+                if previous_hash is not None and hasattr(self.destination, 'delete_participant'):
+                    removed_samples = set(self.state_store.get_children(self.state_store.SAMPLE, id_)) - \
+                        set(children[self.state_store.SAMPLE])
+                    removed_events = set(self.state_store.get_children(self.state_store.EVENT, id_)) - \
+                        set(children[self.state_store.EVENT])
+                    if removed_samples or removed_events:
+                        self.destination.delete_participant(id_, sorted(removed_samples), sorted(removed_events),
+                                                            delete_patient=False)
+            self.state_store.update(self.resource_type, id_, hash_, children)
+            yield record
+
+    def _delete_missing(self):
+        """
+        Deletes from the destination the records converted in the previous runs and not returned anymore by the source
+        """
+        deleted = self.state_store.get_unseen(self.resource_type)
+        if not deleted:
+            return
+        if self.resource_type == self.CASE:
+            delete_method_name = 'delete_participant'
+        else:
+            delete_method_name = 'delete_organization'
+        delete = getattr(self.destination, delete_method_name, None)
+        if delete is None:
+            logger.warning('%s(s) deleted from the source but %s does not support deletions',
+                           self.resource_type, self.destination)
+            return
+        for id_ in deleted:
+            if self.resource_type == self.CASE:
+                delete(id_, self.state_store.get_children(self.state_store.SAMPLE, id_),
+                       self.state_store.get_children(self.state_store.EVENT, id_))
+            else:
+                delete(id_)
+            self.state_store.delete(self.resource_type, id_)
+        logger.debug('Deleted %s %s(s)', len(deleted), self.resource_type)
+
+    def _log_progress(self, previous_count, count):
+        if self.log_interval and count // self.log_interval > previous_count // self.log_interval:
+            logger.debug('Converted %s %s(s)', count, self.resource_type)
+        if self.checkpoint_path and count // self.checkpoint_interval > previous_count // self.checkpoint_interval:
+            self._save_checkpoint(count)
+
+    def _save_checkpoint(self, count):
+        checkpoint = {
+            'resource_type': self.resource_type,
+            'count': count,
+            'output': self.destination.output.get_state()
+        }
+        tmp_path = f'{self.checkpoint_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+        logger.debug('Saved checkpoint after %s %s(s)', count, self.resource_type)
+
+    def _load_checkpoint(self):
+        """
+        Restores the output from the checkpoint, if any, and returns the number of records already written
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        assert checkpoint['resource_type'] == self.resource_type, 'the checkpoint refers to another resource type'
+        self.destination.output.restore_state(checkpoint['output'])
+        logger.debug('Resuming after %s %s(s)', checkpoint['count'], self.resource_type)
+        return checkpoint['count']
+
+    def _run_sequential(self, records, count=0):
+        convert = getattr(self.destination, self._get_convert_method_name())
+        for record in records:
+            convert(record)
+            count += 1
+            self._log_progress(count - 1, count)
+        return count
+
+    def _run_parallel(self, records, count=0):
+        """
+        Sends chunks of records to a pool of worker processes, each one with its own copy of the destination.
+        The workers also encode the data with the payload encoder of the output, if it has one, and send back the
+        payloads, which are written by the current process. At most two chunks per worker are pending at any time,
+        so the records are still consumed in a streaming fashion
+        """
+        import copy
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+        method_name = self._get_convert_method_name()
+        max_pending = self.workers * 2
+        output = self.destination.output
+        payload_encoder = output.get_payload_encoder()
+
+        def _write(future):
+            nonlocal count
+            converted, calls, metrics_state = future.result()
+            if metrics_state is not None:
+                self.metrics.merge(metrics_state)
+            if payload_encoder is not None:
+                for payload in calls:
+                    output.write_payload(payload)
+            else:
+                for args, kwargs in calls:
+                    output.serialize(*args, **kwargs)
+            self._log_progress(count, count + converted)
+            count += converted
+
+        # the workers receive a copy of the destination without the real output, which may not be picklable
+        worker_destination = copy.copy(self.destination)
+        worker_destination.output = _RecordingOutput(payload_encoder)
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                 initargs=(worker_destination, self.metrics is not None)) as executor:
+            pending = deque()
+            for chunk in chunks(records, self.chunk_size):
+                pending.append(executor.submit(_convert_chunk, method_name, chunk))
+                while len(pending) >= max_pending:
+                    if self.ordered:
+                        _write(pending.popleft())
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            pending.remove(future)
+                            _write(future)
+            while pending:
+                _write(pending.popleft())
+        return count
+
+    def run(self):
+        """
+        Converts the records returned by the source. The records are consumed one at a time, so the source can
+        return any iterable (e.g., a generator) and it is never required to hold all the data in memory
+        """
+        if self.metrics is not None:
+            return self._run_instrumented()
+        return self._run()
+
+    def _run_instrumented(self):
+        """
+        Runs the conversion measuring the stages. The methods of the destination are instrumented only in the
+        process that converts the records: the worker processes, if any, or the current one
+        """
+        destination_methods = [] if self.workers > 1 else _get_instrumented_methods(self.destination)
+        # with workers, the main process writes the payloads encoded by them
+        output_methods = ['serialize', 'write_payload'] if self.workers > 1 else ['serialize']
+        self.metrics.instrument(self.destination, destination_methods, type(self.destination).__name__)
+        self.metrics.instrument(self.destination.output, output_methods, type(self.destination.output).__name__)
+        try:
+            count = self._run()
+        finally:
+            Metrics.uninstrument(self.destination, destination_methods)
+            Metrics.uninstrument(self.destination.output, output_methods)
+        self.metrics.increment(f'{self.resource_type}_records', count)
+        self.metrics.export()
+        return count
+
+    def _run(self):
+        if self.metrics is not None:
+            start = time.perf_counter()
+            records = self.metrics.wrap_iterable('source', self._get_records())
+            self.metrics.add_time('source', time.perf_counter() - start, 0)
+        else:
+            records = self._get_records()
+        if self.validation_rate:
+            records = self._validate_sample(records)
+        self._skipped = 0
+        start = 0
+        if self.resume:
+            start = self._load_checkpoint()
+            records = islice(records, start, None)
+        if self.state_store is not None:
+            self.state_store.begin_run(self.resource_type)
+            records = self._filter_changed(records)
+
+        logger.debug('Generating outputs')
+        try:
+            if self.workers > 1:
+                count = self._run_parallel(records, start)
             else:
-                self.destination.create_organizations(record)
+                count = self._run_sequential(records, start)
+            if self.state_store is not None:
+                self._delete_missing()
+            self.destination.output.commit()
+        finally:
+            self.destination.close()
 
-        logger.debug('found %s %s(s)', len(records), self.resource_type)
+        if self.state_store is not None:
+            # the state is saved only after the outputs have been closed
+            self.state_store.commit()
+            logger.debug('Skipped %s unchanged %s(s)', self._skipped, self.resource_type)
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        logger.debug('found %s %s(s)', count, self.resource_type)
+        return count
@@ -15,14 +15,105 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
 
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger('bbmri_fp_etl')
+
+ID_TRANSLATION_TABLE = str.maketrans({
+    "/": "-",
+    "_": "-",
+    "(": "",
+    ")": "",
+    ' ': '-',
+    '+': '',
+    ':': '-'
+})
+
+# number of ids kept by transform_cached_id
+ID_CACHE_SIZE = 4096
+
+
 def transform_id(id_):
-    transformation = {
-        "/": "-",
-        "_": "-",
-        "(": "",
-        ")": "",
-        ' ': '-',
-        '+': '',
-        ':': '-'
-    }
-    return id_.translate(str.maketrans(transformation))
+    return id_.translate(ID_TRANSLATION_TABLE)
+
+
+@lru_cache(maxsize=ID_CACHE_SIZE)
+def transform_cached_id(id_):
+    """
+    Version of transform_id that caches the last transformed ids. It should be used for the ids that are transformed
+    many times, like the ones of the Collections referenced by the Specimens
+    """
+    return transform_id(id_)
+
+
+class IdCollisionDetector:
+    """
+    Keeps track of the source id of each transformed id, and reports when two different source ids are transformed to
+    the same id of a resource type (e.g., "a:1" and "a_1"). The destination would overwrite the first resource with
+    the second one otherwise
+    """
+
+    def __init__(self):
+        self._source_ids = {}
+        self.collisions = []
+
+    def check(self, resource_type, source_id, resource_id):
+        """
+        :return: True if resource_id was already assigned to a different source id
+        """
+        previous_id = self._source_ids.setdefault((resource_type, resource_id), source_id)
+        if previous_id == source_id:
+            return False
+        self.collisions.append((resource_type, resource_id, previous_id, source_id))
+        logger.warning('Ids "%s" and "%s" are both transformed to %s/%s', previous_id, source_id, resource_type,
+                       resource_id)
+        return True
+
+
+class BaseFHIRDest:
+    """
+    Base class of the FHIR destinations, with the methods that do not depend on how the resources are built
+    """
+
+    def __init__(self, serializer, detect_id_collisions=False):
+        """
+        :param serializer: the output where the bundles are saved
+        :param detect_id_collisions: if True, logs a warning when two different source ids are transformed to the
+            same resource id. The ids of all the resources are kept in memory
+        """
+        self.output = serializer
+        self.id_collisions = IdCollisionDetector() if detect_id_collisions else None
+
+    def _get_resource_id(self, resource_type, source_id):
+        resource_id = self._transform_resource_id(source_id)
+        if self.id_collisions is not None:
+            self.id_collisions.check(resource_type, source_id, resource_id)
+        return resource_id
+
+    def _create_specimen_entry(self, patient_id, data):
+        raise NotImplementedError
+
+    def _create_condition_entry(self, patient_id, data):
+        raise NotImplementedError
+
+    def _create_specimens_entry(self, patient_id, data):
+        return [self._create_specimen_entry(patient_id, specimen) for specimen in data if specimen is not None]
+
+    def _create_conditions_entry(self, patient_id, diagnosis_event):
+        return [self._create_condition_entry(patient_id, de) for de in diagnosis_event]
+
+    @staticmethod
+    def _get_custodian_id(collection):
+        # the same Collections are referenced by many Specimens
+        return transform_cached_id(collection.id)
+
+    @staticmethod
+    def _transform_resource_id(id_):
+        return transform_id(id_)
+
+    def save(self, file_name, json_data):
+        self.output.serialize(file_name, json_data)
+
+    def close(self):
+        self.output.close()
@@ -29,160 +29,30 @@ from fhirclient.models.organization import Organization, OrganizationContact
 from fhirclient.models.patient import Patient
 from fhirclient.models.specimen import Specimen, SpecimenCollection
 
-from bbmri_fp_etl.destinations import transform_id
+from bbmri_fp_etl.destinations import BaseFHIRDest, transform_cached_id, transform_id
+# the constants are also imported by the modules that used to import them from here
+from bbmri_fp_etl.destinations.fhir_constants import PATIENT_PROFILE, CONDITION_PROFILE, SPECIMEN_PROFILE, \
+    BIOBANK_PROFILE, COLLECTION_PROFILE, CUSTODIAN_EXTENSION, SAMPLE_DIAGNOSIS_EXTENSION, \
+    STORAGE_TEMPERATURE_EXTENSION, DESCRIPTION_EXTENSION, COLLECTION_TYPE_EXTENSION, DATA_CATEGORY_EXTENSION, \
+    CONTACT_ROLE_EXTENSION, COLLECTION_TYPE_CODE_SYSTEM, DATA_CATEGORY_CODE_SYSTEM, BBMRI_ERIC_IDENTIFIER_SYSTEM, \
+    CONTACT_POINT_PURPOSE, CONTACT_POINT_PURPOSE_ADMIN, CONTACT_POINT_PURPOSE_RESEARCH, FHIR_STORE_PATIENT_URL, \
+    FHIR_STORE_SPECIMEN_URL, FHIR_STORE_CONDITION_URL, COLLECTION_TYPE_MAP, DATA_CATEGORY_MAP, GENDER_MAP, \
+    SPECIMEN_TYPE_MAP, AGE_UNIT_MAP
 from bbmri_fp_etl.destinations.resources import Condition
-from bbmri_fp_etl.models import Aggregate, RoleType, Biobank, DataCategory, CollectionType, Sex, \
-    Collection, AgeUnit, DiseaseOntology, SamplingEvent, SampleType
-
-PATIENT_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Patient'
-CONDITION_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Condition'
-SPECIMEN_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Specimen'
-BIOBANK_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Biobank'
-COLLECTION_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Collection'
-
-CUSTODIAN_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/Custodian'
-SAMPLE_DIAGNOSIS_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/SampleDiagnosis'
-STORAGE_TEMPERATURE_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/StorageTemperature'
-DESCRIPTION_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/OrganizationDescription'
-COLLECTION_TYPE_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/CollectionType'
-DATA_CATEGORY_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/DataCategory'
-CONTACT_ROLE_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/ContactRole'
-
-COLLECTION_TYPE_CODE_SYSTEM = 'https://fhir.bbmri.de/CodeSystem/CollectionType'
-DATA_CATEGORY_CODE_SYSTEM = 'https://fhir.bbmri.de/ValueSet/DataCategory'
-
-BBMRI_ERIC_IDENTIFIER_SYSTEM = 'http://www.bbmri-eric.eu/'
-
-CONTACT_POINT_PURPOSE = 'http://terminology.hl7.org/CodeSystem/contactentity-type'
-CONTACT_POINT_PURPOSE_ADMIN = 'ADMIN'
-CONTACT_POINT_PURPOSE_RESEARCH = 'RESEARCH'
-
-FHIR_STORE_PATIENT_URL = '{base_url}/Patient'
-FHIR_STORE_SPECIMEN_URL = '{base_url}/Specimen'
-FHIR_STORE_CONDITION_URL = '{base_url}/Condition'
-
-COLLECTION_TYPE_MAP = {
-    CollectionType.BIRTH_COHORT: ('BIRTH_COHORT', 'Birth Cohort'),
-    CollectionType.CASE_CONTROL: ('CASE_CONTROL', 'Case-Control'),
-    CollectionType.COHORT: ('COHORT', 'Cohort'),
-    CollectionType.CROSS_SECTIONAL: ('CROSS_SECTIONAL', 'Cross-sectional'),
-    CollectionType.DISEASE_SPECIFIC: ('DISEASE_SPECIFIC', 'Disease specific'),
-    CollectionType.HOSPITAL: ('HOSPITAL', 'Hospital'),
-    CollectionType.IMAGE: ('IMAGE', 'Image collection'),
-    CollectionType.LONGITUDINAL: ('LONGITUDINAL', 'Longitudinal'),
-    CollectionType.NON_HUMAN: ('NON_HUMAN', 'Non-human'),
-    CollectionType.OTHER: ('OTHER', 'Other'),
-    CollectionType.POPULATION_BASED: ('POPULATION_BASED', 'Population-based'),
-    CollectionType.PROSPECTIVE_COLLECTION: ('PROSPECTIVE_COLLECTION', 'Prospective collection'),
-    CollectionType.QUALITY_CONTROL: ('QUALITY_CONTROL', 'Quality control'),
-    CollectionType.RD: ('RD', 'Rare disease colleciton'),
-    CollectionType.SAMPLE: ('SAMPLE', 'Sample collection'),
-    CollectionType.TWIN_STUDY: ('TWIN_STUDY', 'Twin study'),
-}
-
-DATA_CATEGORY_MAP = {
-    DataCategory.BIOLOGICAL_SAMPLES: ('BIOLOGICAL_SAMPLES', 'Biological Samples'),
-    DataCategory.GENEALOGICAL_RECORDS: ('GENEALOGICAL_RECORDS', 'Genealogical records'),
-    DataCategory.IMAGING_DATA: ('IMAGING_DATA', 'Imaging data'),
-    DataCategory.MEDICAL_RECORDS: ('MEDICAL_RECORDS', 'Medical records'),
-    DataCategory.NATIONAL_REGISTRIES: ('NATIONAL_REGISTRIES', 'National registries'),
-    DataCategory.NAV: ('NAV', 'Not available'),
-    DataCategory.OTHER: ('OTHER', 'other'),
-    DataCategory.PHYSIOLOGICAL_BIOCHEMICAL_MEASUREMENTS: (
-        'PHYSIOLOGICAL_BIOCHEMICAL_MEASUREMENTS', 'Physiological/Biochemical measurements'),
-    DataCategory.SURVEY_DATA: ('SURVEY_DATA', 'Survey data')
-}
-
-GENDER_MAP = {
-    Sex.FEMALE: 'female',
-    Sex.MALE: 'male',
-    Sex.UNDIFFERENTIATED: 'other',
-    Sex.UNKNOWN: 'unknown'
-}
-
-SPECIMEN_TYPE_MAP = {
-    SampleType.AMNIOTIC_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.ASCITES_FLUID: ('ascites', 'Ascites'),
-    SampleType.BILE: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.BODY_CAVITY_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.BONE: ('derivative-other', 'Other Derivative'),
-    SampleType.BONE_MARROW_ASPIRATE: ('bone marrow', 'Bone Marrow'),
-    SampleType.BONE_MARROW_PLASMA: ('bone marrow', 'Bone Marrow'),
-    SampleType.BONE_MARROW_WHOLE: ('bone marrow', 'Bone Marrow'),
-    SampleType.BREAST_MILK: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.BRONCHOALVEOLAR_LAVAGE: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.BUFFY_COAT: ('buffy-coat', 'Buffy-Coat'),
-    SampleType.CANCER_CELL_LINES: ('derivative-other', 'Other Derivative'),
-    SampleType.CEREBROSPINAL_FLUID: ('csf-liquor', 'CSF/Liquor'),
-    SampleType.CORD_BLOOD: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.DENTAL_PULP: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.DIGITAL_SAMPLE: ('derivative-other', 'Other Derivative'),
-    SampleType.DNA: ('dna', 'DNA'),
-    SampleType.EMBRYO: ('tissue-other', 'Other tissue storage'),
-    SampleType.ENTIRE_BODY_ORGAN: ('derivative-other', 'Other Derivative'),
-    SampleType.FECES: ('stool-faeces', 'Stool/Faeces'),
-    SampleType.FETAL_TISSUE: ('tissue-other', 'Other tissue storage'),
-    SampleType.FIBROBLASTS: ('derivative-other', 'Other Derivative'),  # TODO: check
-    SampleType.GAS_EXHALED_BREATH: ('derivative-other', 'Other Derivative'),
-    SampleType.GASTRIC_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.HAIR: ('derivative-other', 'Other Derivative'),
-    SampleType.IMMORTALIZED_CELL_LINES: ('derivative-other', 'Other Derivative'),
-    SampleType.ISOLATED_MICROBES: ('derivative-other', 'Other Derivative'),
-    SampleType.MENSTRUAL_BLOOD: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.NAIL: ('derivative-other', 'Other Derivative'),
-    SampleType.NASAL_WASHING: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.OTHER: ('derivative-other', 'Other Derivative'),
-    SampleType.PERICARDIAL_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.PBMC: ('peripheral-blood-cells-vital', 'Peripheral blood mononuclear cells (PBMCs, viable)'),
-    SampleType.PROTEINS: ('derivative-other', 'Other Derivative'),
-    SampleType.PLACENTA: ('derivative-other', 'Other Derivative'),
-    SampleType.PLASMA: ('blood-plasma', 'Plasma'),
-    SampleType.PLEURAL_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.POSTMORTEM_TISSUE: ('tissue-other', 'Other tissue storage'),
-    SampleType.PRIMARY_CELLS: ('derivative-other', 'Other Derivative'),  # TODO: check
-    SampleType.RED_BLOOD_CELLS: ('derivative-other', 'Other Derivative'),
-    SampleType.RNA: ('rna', 'RNA'),
-    SampleType.SALIVA: ('saliva', 'Saliva'),
-    SampleType.SEMEN: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.SERUM: ('blood-serum', 'Blood Serum'),
-    SampleType.SPUTUM: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.STEM_IPS_CELLS: ('derivative-other', 'Other Derivative'),
-    SampleType.SWAB: ('swab', 'Swab'),
-    SampleType.SWEAT: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.SYNOVIAL_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.TEARS: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.TEETH: ('derivative-other', 'Other Derivative'),
-    SampleType.TISSUE_FFPE: ('tissue-other', 'Other tissue storage'),
-    SampleType.TISSUE_FROZEN_OR_FFPE: ('tissue-other', 'Other tissue storage'),
-    SampleType.TISSUE_FROZEN: ('tissue-other', 'Other tissue storage'),
-    SampleType.UMBILICAL_CORD: ('derivative-other', 'Other Derivative'),
-    SampleType.URINE: ('urine', 'Urine'),
-    SampleType.URINE_SEDIMENT: ('urine', 'Urine'),
-    SampleType.VENOUS_BLOOD: ('whole-blood', 'Whole Blood'),
-    SampleType.VITREOUS_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
-    SampleType.WHOLE_BLOOD_DRIED: ('dried-whole-blood', 'Dried Whole Blood'),
-    SampleType.WHOLE_BLOOD: ('whole-blood', 'Whole Blood')
-}
-
-AGE_UNIT_MAP = {
-    AgeUnit.YEARS: 'a',
-    AgeUnit.MONTHS: 'mo',
-    AgeUnit.WEEKS: 'wk',
-    AgeUnit.DAYS: 'd'
-}
-
-
-class FHIRDest:
-    def __init__(self, serializer):
-        self.output = serializer
+from bbmri_fp_etl.models import Aggregate, RoleType, Biobank, Collection, SamplingEvent
 
-    @staticmethod
-    def _create_patient_entry(data):
+
+class FHIRDest(BaseFHIRDest):
+    """
+    Destination that creates the FHIR bundles with the fhirclient models
+    """
+
+    def _create_patient_entry(self, data):
         patient = Patient()
         patient.meta = Meta({
             'profile': [PATIENT_PROFILE]
         })
-        patient.id = transform_id(data.id)
+        patient.id = self._get_resource_id('Patient', data.id)
         patient.identifier = [Identifier({
             'value': data.id
         })]
@@ -200,7 +70,7 @@ class FHIRDest:
 
     def _create_condition_entry(self, patient_id, data):
         condition = Condition()
-        condition.id = self._transform_resource_id(data.id)
+        condition.id = self._get_resource_id('Condition', data.id)
         condition.meta = Meta({
             'profile': [CONDITION_PROFILE]
         })
@@ -237,7 +107,7 @@ class FHIRDest:
 
     def _create_specimen_entry(self, patient_id, data):
         specimen = Specimen()
-        specimen.id = transform_id(data.id)
+        specimen.id = self._get_resource_id('Specimen', data.id)
         specimen.identifier = [Identifier({
             'value': data.id
         })]
@@ -260,7 +130,8 @@ class FHIRDest:
                         'display': data.anatomical_site.free_text
                     }]
                 },
-                'collectedDateTime': collected_date_time
+                # FHIRDate accepts only strings
+                'collectedDateTime': collected_date_time.isoformat() if collected_date_time is not None else None
             })
         specimen_types = []
         if data.type is not None:  # some values are not mapped to obib so skip them
@@ -309,7 +180,7 @@ class FHIRDest:
                 'valueReference': {
                     'identifier': {
                         'system': 'https://bbmri-eric.eu/',
-                        'value': self._transform_resource_id(data.collection.id)
+                        'value': self._get_custodian_id(data.collection)
                     }
                 }
             })] + disease_extensions
@@ -325,25 +196,6 @@ class FHIRDest:
 
         return specimen_entry
 
-    def _create_specimens_entry(self, patient_id, data):
-        return [self._create_specimen_entry(patient_id, specimen) for specimen in data if specimen is not None]
-
-    def _create_conditions_entry(self, patient_id, diagnosis_event):
-        return [self._create_condition_entry(patient_id, de) for de in diagnosis_event]
-
-    @staticmethod
-    def _transform_resource_id(id_):
-        transformation = {
-            "/": "-",
-            "_": "-",
-            "(": "",
-            ")": "",
-            ' ': '-',
-            '+': '',
-            ':': '-'
-        }
-        return id_.translate(str.maketrans(transformation))
-
     def create_participant(self, record):
         b = Bundle()
         b.type = 'transaction'
@@ -360,7 +212,7 @@ class FHIRDest:
         for se in specimens_entries:
             b.entry.append(se)
 
-        self.save(patient_entry.resource.id, b.as_json())
+        self.save(patient_entry.resource.id, self._bundle_to_json(b))
 
     def create_organizations(self, record: Aggregate):
         b = Bundle()
@@ -368,7 +220,7 @@ class FHIRDest:
         b.entry = []
 
         resource = Organization()
-        resource.id = self._transform_resource_id(record.id)
+        resource.id = self._get_resource_id('Organization', record.id)
         resource.identifier = [Identifier({
             'system': BBMRI_ERIC_IDENTIFIER_SYSTEM,
             'value': record.id
@@ -401,8 +253,8 @@ class FHIRDest:
                 contact.name = HumanName({
                     'given': [c.name.given] if c.name is not None else None,
                     'family': c.name.family if c.name is not None else None,
-                    'prefix': c.name.prefix if c.name is not None else None,
-                    'suffix': c.name.suffix if c.name is not None else None
+                    'prefix': [c.name.prefix] if c.name is not None and c.name.prefix is not None else None,
+                    'suffix': [c.name.suffix] if c.name is not None and c.name.suffix is not None else None
                 })
                 contact.telecom = [ContactPoint({
                     'system': t.type.value,
@@ -451,7 +303,7 @@ class FHIRDest:
                 }
             }) for c in record.data_category)
             resource.partOf = FHIRReference(
-                {'reference': f'Organization/{self._transform_resource_id(record.biobank.id)}'})
+                {'reference': f'Organization/{transform_cached_id(record.biobank.id)}'})
 
         entry = BundleEntry()
         entry.resource = resource
@@ -460,7 +312,38 @@ class FHIRDest:
             'url': f'Organization/{resource.id}'
         })
         b.entry.append(entry)
-        self.save(resource.id, b.as_json())
+        self.save(resource.id, self._bundle_to_json(b))
 
-    def save(self, file_name, json_data):
-        self.output.serialize(file_name, json_data)
+    @staticmethod
+    def _create_delete_entry(resource_type, resource_id):
+        entry = BundleEntry()
+        entry.request = BundleEntryRequest({
+            'method': 'DELETE',
+            'url': f'{resource_type}/{resource_id}'
+        })
+        return entry
+
+    def delete_participant(self, donor_id, sample_ids, event_ids, delete_patient=True):
+        """
+        Creates a transaction bundle that deletes the Patient and the Specimens and Conditions of the given samples
+        and events. With delete_patient False, only the Specimens and Conditions are deleted
+        """
+        patient_id = transform_id(donor_id)
+        b = Bundle()
+        b.type = 'transaction'
+        b.entry = [self._create_delete_entry('Specimen', transform_id(s)) for s in sample_ids] + \
+                  [self._create_delete_entry('Condition', self._transform_resource_id(e)) for e in event_ids]
+        if delete_patient:
+            b.entry.append(self._create_delete_entry('Patient', patient_id))
+        self.save(f'delete-{patient_id}', self._bundle_to_json(b))
+
+    def delete_organization(self, organization_id):
+        resource_id = self._transform_resource_id(organization_id)
+        b = Bundle()
+        b.type = 'transaction'
+        b.entry = [self._create_delete_entry('Organization', resource_id)]
+        self.save(f'delete-{resource_id}', self._bundle_to_json(b))
+
+    @staticmethod
+    def _bundle_to_json(bundle):
+        return bundle.as_json()
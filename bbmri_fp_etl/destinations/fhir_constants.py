@@ -0,0 +1,159 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Profiles, extensions, code systems and maps of the FHIR destinations. They are kept apart from fhir.py, so that
+FastFHIRDest can use them without importing fhirclient
+"""
+from bbmri_fp_etl.models import AgeUnit, CollectionType, DataCategory, SampleType, Sex
+
+PATIENT_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Patient'
+CONDITION_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Condition'
+SPECIMEN_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Specimen'
+BIOBANK_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Biobank'
+COLLECTION_PROFILE = 'https://fhir.bbmri.de/StructureDefinition/Collection'
+
+CUSTODIAN_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/Custodian'
+SAMPLE_DIAGNOSIS_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/SampleDiagnosis'
+STORAGE_TEMPERATURE_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/StorageTemperature'
+DESCRIPTION_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/OrganizationDescription'
+COLLECTION_TYPE_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/CollectionType'
+DATA_CATEGORY_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/DataCategory'
+CONTACT_ROLE_EXTENSION = 'https://fhir.bbmri.de/StructureDefinition/ContactRole'
+
+COLLECTION_TYPE_CODE_SYSTEM = 'https://fhir.bbmri.de/CodeSystem/CollectionType'
+DATA_CATEGORY_CODE_SYSTEM = 'https://fhir.bbmri.de/ValueSet/DataCategory'
+
+BBMRI_ERIC_IDENTIFIER_SYSTEM = 'http://www.bbmri-eric.eu/'
+
+CONTACT_POINT_PURPOSE = 'http://terminology.hl7.org/CodeSystem/contactentity-type'
+CONTACT_POINT_PURPOSE_ADMIN = 'ADMIN'
+CONTACT_POINT_PURPOSE_RESEARCH = 'RESEARCH'
+
+FHIR_STORE_PATIENT_URL = '{base_url}/Patient'
+FHIR_STORE_SPECIMEN_URL = '{base_url}/Specimen'
+FHIR_STORE_CONDITION_URL = '{base_url}/Condition'
+
+COLLECTION_TYPE_MAP = {
+    CollectionType.BIRTH_COHORT: ('BIRTH_COHORT', 'Birth Cohort'),
+    CollectionType.CASE_CONTROL: ('CASE_CONTROL', 'Case-Control'),
+    CollectionType.COHORT: ('COHORT', 'Cohort'),
+    CollectionType.CROSS_SECTIONAL: ('CROSS_SECTIONAL', 'Cross-sectional'),
+    CollectionType.DISEASE_SPECIFIC: ('DISEASE_SPECIFIC', 'Disease specific'),
+    CollectionType.HOSPITAL: ('HOSPITAL', 'Hospital'),
+    CollectionType.IMAGE: ('IMAGE', 'Image collection'),
+    CollectionType.LONGITUDINAL: ('LONGITUDINAL', 'Longitudinal'),
+    CollectionType.NON_HUMAN: ('NON_HUMAN', 'Non-human'),
+    CollectionType.OTHER: ('OTHER', 'Other'),
+    CollectionType.POPULATION_BASED: ('POPULATION_BASED', 'Population-based'),
+    CollectionType.PROSPECTIVE_COLLECTION: ('PROSPECTIVE_COLLECTION', 'Prospective collection'),
+    CollectionType.QUALITY_CONTROL: ('QUALITY_CONTROL', 'Quality control'),
+    CollectionType.RD: ('RD', 'Rare disease colleciton'),
+    CollectionType.SAMPLE: ('SAMPLE', 'Sample collection'),
+    CollectionType.TWIN_STUDY: ('TWIN_STUDY', 'Twin study'),
+}
+
+DATA_CATEGORY_MAP = {
+    DataCategory.BIOLOGICAL_SAMPLES: ('BIOLOGICAL_SAMPLES', 'Biological Samples'),
+    DataCategory.GENEALOGICAL_RECORDS: ('GENEALOGICAL_RECORDS', 'Genealogical records'),
+    DataCategory.IMAGING_DATA: ('IMAGING_DATA', 'Imaging data'),
+    DataCategory.MEDICAL_RECORDS: ('MEDICAL_RECORDS', 'Medical records'),
+    DataCategory.NATIONAL_REGISTRIES: ('NATIONAL_REGISTRIES', 'National registries'),
+    DataCategory.NAV: ('NAV', 'Not available'),
+    DataCategory.OTHER: ('OTHER', 'other'),
+    DataCategory.PHYSIOLOGICAL_BIOCHEMICAL_MEASUREMENTS: (
+        'PHYSIOLOGICAL_BIOCHEMICAL_MEASUREMENTS', 'Physiological/Biochemical measurements'),
+    DataCategory.SURVEY_DATA: ('SURVEY_DATA', 'Survey data')
+}
+
+GENDER_MAP = {
+    Sex.FEMALE: 'female',
+    Sex.MALE: 'male',
+    Sex.UNDIFFERENTIATED: 'other',
+    Sex.UNKNOWN: 'unknown'
+}
+
+SPECIMEN_TYPE_MAP = {
+    SampleType.AMNIOTIC_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.ASCITES_FLUID: ('ascites', 'Ascites'),
+    SampleType.BILE: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.BODY_CAVITY_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.BONE: ('derivative-other', 'Other Derivative'),
+    SampleType.BONE_MARROW_ASPIRATE: ('bone marrow', 'Bone Marrow'),
+    SampleType.BONE_MARROW_PLASMA: ('bone marrow', 'Bone Marrow'),
+    SampleType.BONE_MARROW_WHOLE: ('bone marrow', 'Bone Marrow'),
+    SampleType.BREAST_MILK: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.BRONCHOALVEOLAR_LAVAGE: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.BUFFY_COAT: ('buffy-coat', 'Buffy-Coat'),
+    SampleType.CANCER_CELL_LINES: ('derivative-other', 'Other Derivative'),
+    SampleType.CEREBROSPINAL_FLUID: ('csf-liquor', 'CSF/Liquor'),
+    SampleType.CORD_BLOOD: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.DENTAL_PULP: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.DIGITAL_SAMPLE: ('derivative-other', 'Other Derivative'),
+    SampleType.DNA: ('dna', 'DNA'),
+    SampleType.EMBRYO: ('tissue-other', 'Other tissue storage'),
+    SampleType.ENTIRE_BODY_ORGAN: ('derivative-other', 'Other Derivative'),
+    SampleType.FECES: ('stool-faeces', 'Stool/Faeces'),
+    SampleType.FETAL_TISSUE: ('tissue-other', 'Other tissue storage'),
+    SampleType.FIBROBLASTS: ('derivative-other', 'Other Derivative'),  # TODO: check
+    SampleType.GAS_EXHALED_BREATH: ('derivative-other', 'Other Derivative'),
+    SampleType.GASTRIC_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.HAIR: ('derivative-other', 'Other Derivative'),
+    SampleType.IMMORTALIZED_CELL_LINES: ('derivative-other', 'Other Derivative'),
+    SampleType.ISOLATED_MICROBES: ('derivative-other', 'Other Derivative'),
+    SampleType.MENSTRUAL_BLOOD: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.NAIL: ('derivative-other', 'Other Derivative'),
+    SampleType.NASAL_WASHING: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.OTHER: ('derivative-other', 'Other Derivative'),
+    SampleType.PERICARDIAL_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.PBMC: ('peripheral-blood-cells-vital', 'Peripheral blood mononuclear cells (PBMCs, viable)'),
+    SampleType.PROTEINS: ('derivative-other', 'Other Derivative'),
+    SampleType.PLACENTA: ('derivative-other', 'Other Derivative'),
+    SampleType.PLASMA: ('blood-plasma', 'Plasma'),
+    SampleType.PLEURAL_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.POSTMORTEM_TISSUE: ('tissue-other', 'Other tissue storage'),
+    SampleType.PRIMARY_CELLS: ('derivative-other', 'Other Derivative'),  # TODO: check
+    SampleType.RED_BLOOD_CELLS: ('derivative-other', 'Other Derivative'),
+    SampleType.RNA: ('rna', 'RNA'),
+    SampleType.SALIVA: ('saliva', 'Saliva'),
+    SampleType.SEMEN: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.SERUM: ('blood-serum', 'Blood Serum'),
+    SampleType.SPUTUM: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.STEM_IPS_CELLS: ('derivative-other', 'Other Derivative'),
+    SampleType.SWAB: ('swab', 'Swab'),
+    SampleType.SWEAT: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.SYNOVIAL_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.TEARS: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.TEETH: ('derivative-other', 'Other Derivative'),
+    SampleType.TISSUE_FFPE: ('tissue-other', 'Other tissue storage'),
+    SampleType.TISSUE_FROZEN_OR_FFPE: ('tissue-other', 'Other tissue storage'),
+    SampleType.TISSUE_FROZEN: ('tissue-other', 'Other tissue storage'),
+    SampleType.UMBILICAL_CORD: ('derivative-other', 'Other Derivative'),
+    SampleType.URINE: ('urine', 'Urine'),
+    SampleType.URINE_SEDIMENT: ('urine', 'Urine'),
+    SampleType.VENOUS_BLOOD: ('whole-blood', 'Whole Blood'),
+    SampleType.VITREOUS_FLUID: ('liquid-other', 'Other liquid biosample/storage'),
+    SampleType.WHOLE_BLOOD_DRIED: ('dried-whole-blood', 'Dried Whole Blood'),
+    SampleType.WHOLE_BLOOD: ('whole-blood', 'Whole Blood')
+}
+
+AGE_UNIT_MAP = {
+    AgeUnit.YEARS: 'a',
+    AgeUnit.MONTHS: 'mo',
+    AgeUnit.WEEKS: 'wk',
+    AgeUnit.DAYS: 'd'
+}
@@ -0,0 +1,279 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+FHIR destination that builds the resources directly as dictionaries, without creating the fhirclient objects
+and validating them with as_json(). The output is the same of FHIRDest: the keys are inserted in the same order
+used by fhirclient and the elements with None or empty values are omitted. The module does not import fhirclient.
+
+The fragments that are the same for many resources (e.g., the meta profiles, the Specimen.type codings and the
+custodian extensions) are created once and the same objects are inserted in all the bundles, to reduce the memory
+allocated per record. The bundles are therefore read-only: the outputs only serialize them, and code that needs to
+modify a bundle must copy it first (e.g., with copy.deepcopy).
+"""
+
+import functools
+
+from bbmri_fp_etl.destinations import ID_CACHE_SIZE, BaseFHIRDest, transform_cached_id, transform_id
+from bbmri_fp_etl.destinations.fhir_constants import PATIENT_PROFILE, CONDITION_PROFILE, SPECIMEN_PROFILE, \
+    BIOBANK_PROFILE, COLLECTION_PROFILE, CUSTODIAN_EXTENSION, SAMPLE_DIAGNOSIS_EXTENSION, DESCRIPTION_EXTENSION, \
+    COLLECTION_TYPE_EXTENSION, DATA_CATEGORY_EXTENSION, CONTACT_ROLE_EXTENSION, COLLECTION_TYPE_CODE_SYSTEM, \
+    DATA_CATEGORY_CODE_SYSTEM, BBMRI_ERIC_IDENTIFIER_SYSTEM, CONTACT_POINT_PURPOSE, CONTACT_POINT_PURPOSE_ADMIN, \
+    CONTACT_POINT_PURPOSE_RESEARCH, COLLECTION_TYPE_MAP, DATA_CATEGORY_MAP, GENDER_MAP, SPECIMEN_TYPE_MAP, \
+    AGE_UNIT_MAP
+from bbmri_fp_etl.models import Aggregate, RoleType, Biobank, Collection, SamplingEvent, SampleType, \
+    CollectionType, DataCategory
+
+
+def _compact(**kwargs):
+    """
+    Returns a dict with the not None and not empty values, in the order of the arguments
+    """
+    return {k: v for k, v in kwargs.items() if v is not None and v != []}
+
+
+def _coding(system, code, display=None):
+    return _compact(code=code, display=display, system=system)
+
+
+# Fragments of the resources that are the same for all the records. They are computed once and the same objects are
+# inserted in all the resources, so they must never be modified. Only the lists that get extended per record (e.g.,
+# the Specimen.type codings) are copied
+
+PATIENT_META = {'profile': [PATIENT_PROFILE]}
+CONDITION_META = {'profile': [CONDITION_PROFILE]}
+SPECIMEN_META = {'profile': [SPECIMEN_PROFILE]}
+BIOBANK_META = {'profile': [BIOBANK_PROFILE]}
+COLLECTION_META = {'profile': [COLLECTION_PROFILE]}
+BIOBANK_TYPE = [{'coding': [{'code': 'Biobank'}]}]
+COLLECTION_TYPE = [{'coding': [{'code': 'Collection'}]}]
+
+# the codings of the Specimen.type of each SampleType: the miabis value (as obib term) and the SampleMaterialType
+SPECIMEN_TYPE_CODINGS = {
+    t: (_coding(t.value.ontology, t.value.code, t.value.free_text),
+        _coding('https://fhir.bbmri.de/CodeSystem/SampleMaterialType', SPECIMEN_TYPE_MAP[t][0],
+                SPECIMEN_TYPE_MAP[t][1]))
+    for t in SampleType if t in SPECIMEN_TYPE_MAP
+}
+
+COLLECTION_TYPE_EXTENSIONS = {
+    t: {
+        'url': COLLECTION_TYPE_EXTENSION,
+        'valueCodeableConcept': {
+            'coding': [_coding(COLLECTION_TYPE_CODE_SYSTEM, COLLECTION_TYPE_MAP[t][0], COLLECTION_TYPE_MAP[t][1])]
+        }
+    } for t in CollectionType if t in COLLECTION_TYPE_MAP
+}
+
+DATA_CATEGORY_EXTENSIONS = {
+    c: {
+        'url': DATA_CATEGORY_EXTENSION,
+        'valueCodeableConcept': {
+            'coding': [_coding(DATA_CATEGORY_CODE_SYSTEM, DATA_CATEGORY_MAP[c][0], DATA_CATEGORY_MAP[c][1])]
+        }
+    } for c in DataCategory if c in DATA_CATEGORY_MAP
+}
+
+
+@functools.lru_cache(maxsize=ID_CACHE_SIZE)
+def _custodian_extension(custodian_id):
+    # the Specimens of a Collection share the same extension
+    return {
+        'url': CUSTODIAN_EXTENSION,
+        'valueReference': {
+            'identifier': {
+                'system': 'https://bbmri-eric.eu/',
+                'value': custodian_id
+            }
+        }
+    }
+
+
+def _entry(resource_type, resource):
+    return {
+        'request': {
+            'method': 'PUT',
+            'url': f'{resource_type}/{resource["id"]}'
+        },
+        'resource': resource
+    }
+
+
+def _bundle(entries):
+    return {
+        'entry': entries,
+        'type': 'transaction',
+        'resourceType': 'Bundle'
+    }
+
+
+def _disease_codings(disease):
+    return [_coding(d.ontology, d.code) for d in [disease.main_code] + disease.mapping_codes]
+
+
+class FastFHIRDest(BaseFHIRDest):
+    """
+    Drop-in replacement of FHIRDest that creates the bundles as plain dictionaries. The bundles share the
+    constant fragments and must not be modified
+    """
+
+    def _create_patient_entry(self, data):
+        patient = _compact(
+            id=self._get_resource_id('Patient', data.id),
+            meta=PATIENT_META,
+            birthDate=data.birth_date.isoformat() if data.birth_date is not None else None,
+            gender=GENDER_MAP[data.gender],
+            identifier=[_compact(value=data.id)]
+        )
+        patient['resourceType'] = 'Patient'
+        return _entry('Patient', patient)
+
+    def _create_condition_entry(self, patient_id, data):
+        # as in FHIRDest, the date of the event is not reported since FHIRDate does not accept date objects
+        onset_age = None
+        if data.age_at_event is not None:
+            onset_age = _compact(unit=AGE_UNIT_MAP[data.age_at_event_unit], value=data.age_at_event)
+
+        condition = _compact(
+            id=self._get_resource_id('Condition', data.id),
+            meta=CONDITION_META,
+            code={'coding': _disease_codings(data.disease)},
+            onsetAge=onset_age,
+            subject={'reference': f'Patient/{patient_id}'}
+        )
+        condition['resourceType'] = 'Condition'
+        return _entry('Condition', condition)
+
+    def _create_specimen_entry(self, patient_id, data):
+        collected_date_time = None
+        for event in data.events:
+            if isinstance(event, SamplingEvent):
+                collected_date_time = event.date_at_event
+
+        collection = None
+        if data.anatomical_site is not None:
+            collection = _compact(
+                bodySite={
+                    'coding': [_coding(data.anatomical_site.ontology, data.anatomical_site.code,
+                                       data.anatomical_site.free_text)]
+                },
+                collectedDateTime=collected_date_time.isoformat() if collected_date_time is not None else None
+            )
+
+        specimen_types = list(SPECIMEN_TYPE_CODINGS[data.type])
+        for t in data.additional_types:
+            specimen_types.append(_coding(t.ontology, t.code, t.free_text))
+
+        extensions = [_custodian_extension(self._get_custodian_id(data.collection))]
+        if data.content_diagnosis is not None:
+            extensions.extend({
+                'url': SAMPLE_DIAGNOSIS_EXTENSION,
+                'valueCodeableConcept': {'coding': _disease_codings(disease)}
+            } for disease in data.content_diagnosis)
+
+        specimen = _compact(
+            id=self._get_resource_id('Specimen', data.id),
+            meta=SPECIMEN_META,
+            extension=extensions,
+            collection=collection,
+            identifier=[_compact(value=data.id)],
+            subject={'reference': f'Patient/{patient_id}'},
+            type={'coding': specimen_types}
+        )
+        specimen['resourceType'] = 'Specimen'
+        return _entry('Specimen', specimen)
+
+    def create_participant(self, record):
+        patient_entry = self._create_patient_entry(record.donor)
+        patient_id = patient_entry['resource']['id']
+        entries = [patient_entry]
+        entries.extend(self._create_conditions_entry(patient_id, record.donor.events))
+        entries.extend(self._create_specimens_entry(patient_id, record.samples))
+        self.save(patient_id, _bundle(entries))
+
+    @staticmethod
+    def _create_contact(contact):
+        extension = None
+        if contact.role.type == RoleType.HEAD and contact.role.description is not None:
+            extension = [{'url': CONTACT_ROLE_EXTENSION, 'valueString': contact.role.description}]
+        name = contact.name
+        return _compact(
+            extension=extension,
+            name=_compact(
+                family=name.family if name is not None else None,
+                given=[name.given] if name is not None else None,
+                prefix=[name.prefix] if name is not None and name.prefix is not None else None,
+                suffix=[name.suffix] if name is not None and name.suffix is not None else None
+            ),
+            purpose={
+                'coding': [_compact(
+                    code=CONTACT_POINT_PURPOSE_ADMIN if contact.role.type == RoleType.HEAD
+                    else CONTACT_POINT_PURPOSE_RESEARCH,
+                    system=CONTACT_POINT_PURPOSE
+                )]
+            },
+            telecom=[_compact(system=t.type.value, value=t.value) for t in contact.telecom]
+        )
+
+    def create_organizations(self, record: Aggregate):
+        resource_id = self._get_resource_id('Organization', record.id)
+        extensions = [_compact(url=DESCRIPTION_EXTENSION, valueString=record.description)]
+        organization_type = meta = part_of = None
+        if isinstance(record, Biobank):
+            organization_type = BIOBANK_TYPE
+            meta = BIOBANK_META
+        elif isinstance(record, Collection):
+            organization_type = COLLECTION_TYPE
+            meta = COLLECTION_META
+            extensions.extend(COLLECTION_TYPE_EXTENSIONS[t] for t in record.type)
+            extensions.extend(DATA_CATEGORY_EXTENSIONS[c] for c in record.data_category)
+            part_of = {'reference': f'Organization/{transform_cached_id(record.biobank.id)}'}
+
+        resource = _compact(
+            id=resource_id,
+            meta=meta,
+            extension=extensions,
+            contact=[self._create_contact(c) for c in record.contact] if record.contact else None,
+            identifier=[{'system': BBMRI_ERIC_IDENTIFIER_SYSTEM, 'value': record.id}],
+            name=record.name,
+            partOf=part_of,
+            telecom=[{'system': 'url', 'value': t} for t in record.url] if record.url is not None else None,
+            type=organization_type
+        )
+        resource['resourceType'] = 'Organization'
+        self.save(resource_id, _bundle([_entry('Organization', resource)]))
+
+    @staticmethod
+    def _create_delete_entry(resource_type, resource_id):
+        return {
+            'request': {
+                'method': 'DELETE',
+                'url': f'{resource_type}/{resource_id}'
+            }
+        }
+
+    def delete_participant(self, donor_id, sample_ids, event_ids, delete_patient=True):
+        patient_id = transform_id(donor_id)
+        entries = [self._create_delete_entry('Specimen', transform_id(s)) for s in sample_ids] + \
+                  [self._create_delete_entry('Condition', self._transform_resource_id(e)) for e in event_ids]
+        if delete_patient:
+            entries.append(self._create_delete_entry('Patient', patient_id))
+        self.save(f'delete-{patient_id}', _bundle(entries))
+
+    def delete_organization(self, organization_id):
+        resource_id = self._transform_resource_id(organization_id)
+        self.save(f'delete-{resource_id}', _bundle([self._create_delete_entry('Organization', resource_id)]))
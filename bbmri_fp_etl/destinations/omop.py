@@ -126,10 +126,35 @@ PROCEDURE_MAP = {
     EventType.RESPONSE_TO_THERAPY: ('Evaluating response to treatment', 225953001)
 }
 
+# vocabulary_id of the disease ontologies in the OMOP vocabularies
+VOCABULARY_MAP = {
+    DiseaseOntology.ICD_10: 'ICD10',
+    DiseaseOntology.SNOMED: 'SNOMED'
+}
+
+# the columns with the ids allocated by the IdAllocator and the ones with the concept ids of the ConceptIndex
+ID_COLUMNS = ('person_id', 'condition_occurrence_id', 'procedure_occurrence_id', 'specimen_id',
+              'observation_period_id')
+VOCABULARY_COLUMNS = ('condition_concept_id', 'condition_source_concept_id', 'disease_status_concept_id')
+
 
 class OMOPDest:
-    def __init__(self, serializer):
+    def __init__(self, serializer, id_allocator=None, vocabulary=None):
+        """
+        :param serializer: the output where the rows are saved
+        :param id_allocator: an ids.IdAllocator. If specified, the ids of the rows (e.g., person_id) are integers
+            allocated by it, otherwise they are the ids of the source
+        :param vocabulary: a vocabulary.ConceptIndex. If specified, the disease, specimen and procedure codes are
+            converted to OMOP concept ids, otherwise the codes of the source are used
+        """
         self.output = serializer
+        self.id_allocator = id_allocator
+        self.vocabulary = vocabulary
+        # without them the columns hold the ids and the codes of the source
+        int_columns = (ID_COLUMNS if id_allocator is not None else ()) + \
+            (VOCABULARY_COLUMNS if vocabulary is not None else ())
+        if int_columns:
+            self.output.set_int_columns(int_columns)
         self._person_file = 'person.csv'
         self.condition_file = 'condition_occurence.csv'
         self.observation_period_file = 'observation_period.csv'
@@ -158,10 +183,48 @@ class OMOPDest:
         self._observation_period_cols = ['observation_period_id', 'person_id', 'observation_period_start_date',
                                          'observation_period_end_date', 'period_type_concept_id']
 
+    def _get_ids(self, record):
+        """
+        Returns a dict table -> ids of the rows of record, in the order of the samples and of the events
+        """
+        events = record.donor.events or []
+        source_ids = {
+            'person': [record.donor.id],
+            'condition_occurrence': [e.id for e in events if e.event_type == EventType.DIAGNOSIS],
+            'procedure_occurrence': [e.id for e in events if e.event_type != EventType.DIAGNOSIS],
+            'specimen': [s.id for s in record.samples or []]
+        }
+        if self.id_allocator is None:
+            return source_ids
+        return self.id_allocator.get_ids_by_table(source_ids)
+
+    def _get_disease_concept_ids(self, code):
+        """
+        Returns the standard concept id and the source concept id of a DiseaseOntologyCode, 0 if the code is not in
+        the vocabulary
+        """
+        if self.vocabulary is None:
+            return code.code, code.code
+        concept = self.vocabulary.get_concept(VOCABULARY_MAP.get(code.ontology), code.code)
+        if concept is None:
+            return 0, 0
+        return concept[1] or 0, concept[0]
+
+    def _get_snomed_concept_ids(self, snomed_code, default_concept_id):
+        """
+        Returns the standard concept id and the source concept id of a SNOMED code of the maps
+        """
+        if self.vocabulary is None:
+            return default_concept_id, default_concept_id
+        concept = self.vocabulary.get_concept('SNOMED', str(snomed_code))
+        if concept is None:
+            return default_concept_id, default_concept_id
+        return concept[1] or default_concept_id, concept[0]
+
     @staticmethod
-    def _create_person_entry(donor):
+    def _create_person_entry(donor, person_id):
         return OrderedDict({
-            'person_id': donor.id,
+            'person_id': person_id,
             'gender_concept_id': GENDER_MAP[donor.gender][1],
             'year_of_birth': donor.birth_date.year if donor.birth_date is not None else '',
             'month_of_birth': donor.birth_date.month if donor.birth_date is not None else '',
@@ -181,20 +244,24 @@ class OMOPDest:
             'ethnicity_source_concept_id': 0
         })
 
-    @staticmethod
-    def _process_events(donor):
+    def _process_events(self, donor, person_id, condition_ids, procedure_ids):
         conditions = []
         procedures = []
         if donor.events is not None:
+            condition_ids = iter(condition_ids)
+            procedure_ids = iter(procedure_ids)
             for event in donor.events:
                 # TODO add calculation of condition_start_date from age_at_event
                 if event.event_type == EventType.DIAGNOSIS:
+                    concept_id, source_concept_id = self._get_disease_concept_ids(event.disease.main_code) \
+                        if event.disease is not None else ('', '')
                     conditions.append(OrderedDict({
-                        'condition_occurrence_id': event.id,
-                        'person_id': donor.id,
-                        'condition_concept_id': event.disease.code if event.disease is not None else '',
-                        'condition_source_value': event.disease.description if event.disease is not None else '',
-                        'condition_source_concept_id': event.disease.code if event.disease is not None else '',
+                        'condition_occurrence_id': next(condition_ids),
+                        'person_id': person_id,
+                        'condition_concept_id': concept_id,
+                        'condition_source_value': event.disease.main_code.description
+                        if event.disease is not None else '',
+                        'condition_source_concept_id': source_concept_id,
                         'condition_start_date': event.date_at_event.isoformat() if event.date_at_event else '0001-01-01',
                         'condition_start_datetime': event.date_at_event.isoformat() if event.date_at_event else datetime.date(
                             1, 1, 1),
@@ -209,10 +276,12 @@ class OMOPDest:
                         'condition_status_source_value': event.provenance.description if event.provenance is not None else ''
                     }))
                 else:
+                    concept_id, source_concept_id = self._get_snomed_concept_ids(
+                        PROCEDURE_MAP[event.event_type][1], PROCEDURE_MAP[event.event_type][1])
                     procedures.append(OrderedDict({
-                        'procedure_occurrence_id': event.id,
-                        'person_id': donor.id,
-                        'procedure_concept_id': PROCEDURE_MAP[event.event_type][1],
+                        'procedure_occurrence_id': next(procedure_ids),
+                        'person_id': person_id,
+                        'procedure_concept_id': concept_id,
                         'procedure_date': event.date_at_event.isoformat() if event.date_at_event else '0001-01-01',
                         'procedure_datetime': event.date_at_event if event.date_at_event else datetime.date(1, 1, 1),
                         'procedure_end_date': '',
@@ -224,17 +293,16 @@ class OMOPDest:
                         'visit_occurrence_id': '',
                         'visit_detail_id': '',
                         'procedure_source_value': PROCEDURE_MAP[event.event_type][0],
-                        'procedure_source_concept_id': PROCEDURE_MAP[event.event_type][1],
+                        'procedure_source_concept_id': source_concept_id,
                         'modifier_source_value': '',
                     }))
         return conditions, procedures
 
-    @staticmethod
-    def _create_specimen_entries(donor, samples_data: List[Sample]):
+    def _create_specimen_entries(self, person_id, samples_data: List[Sample], specimen_ids):
         samples = []
         first_sample_acquisition = None
         if samples_data is not None:
-            for sample in samples_data:
+            for sample, specimen_id in zip(samples_data, specimen_ids):
                 specimen_date = sample.creation_time.isoformat() if sample.creation_time is not None else ''
                 specimen_datetime = sample.creation_time.isoformat() if sample.creation_time is not None else ''
 
@@ -245,16 +313,17 @@ class OMOPDest:
                 disease_status_source_value = ''
                 if sample.content_diagnosis is not None:
                     for cd in sample.content_diagnosis:
-                        if cd.ontology == DiseaseOntology.SNOMED:
-                            disease_status_concept_id = cd.code
-                            disease_status_source_value = cd.description
+                        if cd.main_code.ontology == DiseaseOntology.SNOMED:
+                            disease_status_concept_id = self._get_disease_concept_ids(cd.main_code)[0]
+                            disease_status_source_value = cd.main_code.description
                             break
 
                 # TODO: can we handle multiple diseases? Currently seems not
                 samples.append(OrderedDict({
-                    'specimen_id': sample.id,
-                    'person_id': donor.id,
-                    'specimen_concept_id': SPECIMEN_TYPE_MAP[sample.type][2],
+                    'specimen_id': specimen_id,
+                    'person_id': person_id,
+                    'specimen_concept_id': self._get_snomed_concept_ids(SPECIMEN_TYPE_MAP[sample.type][1],
+                                                                        SPECIMEN_TYPE_MAP[sample.type][2])[0],
                     'specimen_type_concept_id': 581378,  # OMOP 4822448 581378 EHR Detail
                     'specimen_date': specimen_date,
                     'specimen_datetime': specimen_datetime,
@@ -272,20 +341,26 @@ class OMOPDest:
         return samples, first_sample_acquisition
 
     @staticmethod
-    def _create_observation_period_entry(donor, first_sample_acquisition, condition_status_concept_id):
+    def _create_observation_period_entry(donor, person_id, first_sample_acquisition, condition_status_concept_id):
+        # there is one observation period for each person, so it has the same id
         return OrderedDict({
-            'observation_period_id': donor.id,
-            'person_id': donor.id,
+            'observation_period_id': person_id,
+            'person_id': person_id,
             'observation_period_start_date': first_sample_acquisition,
             'observation_period_end_date': donor.last_update,
             'period_type_concept_id': condition_status_concept_id
         })
 
     def create_participant(self, record):
-        person = self._create_person_entry(record.donor)
-        conditions, procedures = self._process_events(record.donor)
-        samples, first_sample_acquisition = self._create_specimen_entries(record.donor, record.samples)
-        observation_period = self._create_observation_period_entry(record.donor, first_sample_acquisition, '')
+        ids = self._get_ids(record)
+        person_id = ids['person'][0]
+        person = self._create_person_entry(record.donor, person_id)
+        conditions, procedures = self._process_events(record.donor, person_id, ids['condition_occurrence'],
+                                                      ids['procedure_occurrence'])
+        samples, first_sample_acquisition = self._create_specimen_entries(person_id, record.samples,
+                                                                          ids['specimen'])
+        observation_period = self._create_observation_period_entry(record.donor, person_id,
+                                                                   first_sample_acquisition, '')
 
         self.save('person', list(person.keys()), [person])
         self.save('observation_period', list(observation_period.keys()), [observation_period])
@@ -297,3 +372,6 @@ class OMOPDest:
 
     def save(self, file_name, header, csvdata):
         self.output.serialize(file_name, header, csvdata)
+
+    def close(self):
+        self.output.close()
@@ -0,0 +1,88 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+JSON encoders used by the outputs. The encoders return the JSON document as UTF-8 bytes. orjson and msgspec, if
+installed, are considerably faster than the json module and encode directly to bytes
+"""
+import json
+
+ORJSON = 'orjson'
+MSGSPEC = 'msgspec'
+STDLIB = 'json'
+
+
+class StdlibJsonEncoder:
+    def __init__(self, indent=False):
+        self._encoder = json.JSONEncoder(indent=2 if indent else None, separators=None if indent else (',', ':'),
+                                         ensure_ascii=False)
+
+    def encode(self, obj):
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+class OrjsonEncoder:
+    def __init__(self, indent=False):
+        try:
+            import orjson
+        except ImportError as e:
+            raise ImportError('The orjson encoder requires orjson. Install it with "pip install orjson"') from e
+        self._dumps = orjson.dumps
+        self._option = orjson.OPT_INDENT_2 if indent else 0
+
+    def encode(self, obj):
+        return self._dumps(obj, option=self._option)
+
+
+class MsgspecEncoder:
+    def __init__(self, indent=False):
+        try:
+            import msgspec
+        except ImportError as e:
+            raise ImportError('The msgspec encoder requires msgspec. Install it with "pip install msgspec"') from e
+        self._encode = msgspec.json.Encoder().encode
+        self._format = msgspec.json.format if indent else None
+
+    def encode(self, obj):
+        data = self._encode(obj)
+        return self._format(data, indent=2) if self._format is not None else data
+
+
+JSON_ENCODERS = {
+    ORJSON: OrjsonEncoder,
+    MSGSPEC: MsgspecEncoder,
+    STDLIB: StdlibJsonEncoder
+}
+
+
+def get_json_encoder(backend=None, indent=False):
+    """
+    Returns an encoder with an encode(obj) method that returns bytes
+    :param backend: ORJSON, MSGSPEC or STDLIB. If None, the first one installed is used, in this order
+    :param indent: if True, the JSON is indented with 2 spaces, otherwise it is compact
+    """
+    if backend is not None:
+        try:
+            return JSON_ENCODERS[backend](indent)
+        except KeyError:
+            raise ValueError(f'Unsupported JSON backend {backend}') from None
+    for backend in (ORJSON, MSGSPEC):
+        try:
+            return JSON_ENCODERS[backend](indent)
+        except ImportError:
+            pass
+    return StdlibJsonEncoder(indent)
@@ -0,0 +1,120 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Allocation of the integer surrogate keys of the OMOP tables
+"""
+import sqlite3
+
+from bbmri_fp_etl.connections import ProcessConnectionMixin
+
+
+class IdAllocator(ProcessConnectionMixin):
+    """
+    Assigns dense integer ids, starting from 1, to the source values (e.g., the donor ids) of each OMOP table. The
+    mapping is stored in a SQLite database, so that the same source value keeps its id in the following runs. The
+    allocator can be shared by worker processes: each process opens its own connection and the new ids are inserted
+    in transactions serialized by SQLite
+    """
+
+    def __init__(self, path, timeout=60):
+        """
+        :param path: the path of the SQLite database. It must be a file to be shared with worker processes
+        :param timeout: seconds to wait for the lock held by other processes
+        """
+        self.path = path
+        self.timeout = timeout
+        connection = self._get_connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS ids ('
+                           'table_name TEXT NOT NULL, '
+                           'source_value TEXT NOT NULL, '
+                           'id INTEGER NOT NULL, '
+                           'PRIMARY KEY (table_name, source_value))')
+        connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS ids_id ON ids (table_name, id)')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    @staticmethod
+    def _select(connection, table_name, source_values):
+        ids = {}
+        # the number of parameters of a query is limited
+        for start in range(0, len(source_values), 500):
+            chunk = source_values[start:start + 500]
+            ids.update(connection.execute(
+                f'SELECT source_value, id FROM ids WHERE table_name = ? AND source_value IN '
+                f'({", ".join("?" * len(chunk))})', (table_name, *chunk)))
+        return ids
+
+    def get_ids_by_table(self, source_values):
+        """
+        Returns the ids of the source values of several tables, allocating the ones of the new values in a single
+        transaction
+        :param source_values: a dict table_name -> list of source values
+        :return: a dict table_name -> list of ids, in the order of the source values
+        """
+        source_values = {t: [str(v) for v in values] for t, values in source_values.items()}
+        connection = self._get_connection()
+        ids = {t: self._select(connection, t, values) for t, values in source_values.items()}
+        if any(len(ids[t]) < len(set(values)) for t, values in source_values.items()):
+            # the write lock is taken before reading again, since another process could have allocated the ids
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                for table_name, values in source_values.items():
+                    table_ids = ids[table_name] = self._select(connection, table_name, values)
+                    if len(table_ids) == len(set(values)):
+                        continue
+                    last_id = connection.execute('SELECT MAX(id) FROM ids WHERE table_name = ?',
+                                                 (table_name,)).fetchone()[0] or 0
+                    new_ids = []
+                    for value in values:
+                        if value not in table_ids:
+                            last_id += 1
+                            table_ids[value] = last_id
+                            new_ids.append((table_name, value, last_id))
+                    connection.executemany('INSERT INTO ids (table_name, source_value, id) VALUES (?, ?, ?)',
+                                           new_ids)
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        return {t: [ids[t][v] for v in values] for t, values in source_values.items()}
+
+    def get_ids(self, table_name, source_values):
+        """
+        Returns the ids of source_values in table_name, allocating the ones of the new values
+        :return: a list with the ids, in the order of source_values
+        """
+        return self.get_ids_by_table({table_name: source_values})[table_name]
+
+    def get_id(self, table_name, source_value):
+        return self.get_ids(table_name, [source_value])[0]
+
+    def export_crosswalk(self, output, file_name='id_crosswalk', batch_size=10000):
+        """
+        Writes the mapping between source values and ids to output, an OMOP output like StreamingCSVFile, as a table
+        with the columns table_name, source_value and id
+        """
+        header = ['table_name', 'source_value', 'id']
+        cursor = self._get_connection().execute('SELECT table_name, source_value, id FROM ids '
+                                                'ORDER BY table_name, id')
+        while rows := cursor.fetchmany(batch_size):
+            output.serialize(file_name, header, [dict(zip(header, row)) for row in rows])
+        output.flush()
@@ -0,0 +1,151 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Timers and counters of the conversion stages. The instrumentation is applied only when a Metrics instance is passed
+to the Converter, by wrapping the methods of the destination and of its output: when it is not used, the conversion
+code runs unchanged
+"""
+import functools
+import json
+import os
+import time
+from collections import defaultdict
+
+
+class Metrics:
+    """
+    Collects, for each stage, the number of calls and the total time spent. At the end of the conversion the
+    Converter calls export(), which writes the summary as JSON to json_path and in the Prometheus textfile format
+    to prometheus_path, if they are specified
+    """
+    PROMETHEUS_PREFIX = 'bbmri_fp_etl'
+
+    def __init__(self, json_path=None, prometheus_path=None):
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def add_time(self, stage, seconds, calls=1):
+        self.calls[stage] += calls
+        self.seconds[stage] += seconds
+
+    def increment(self, counter, value=1):
+        self.counters[counter] += value
+
+    def wrap(self, stage, function):
+        """
+        Returns a function that calls function adding its execution time to stage
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+        return wrapper
+
+    def wrap_iterable(self, stage, iterable):
+        """
+        Yields the items of iterable adding to stage the time spent to get each of them
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start, 0)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def instrument(self, obj, method_names, prefix):
+        """
+        Replaces the methods of obj with timed wrappers, setting them as instance attributes. The stages are named
+        prefix.method_name
+        """
+        for name in method_names:
+            setattr(obj, name, self.wrap(f'{prefix}.{name}', getattr(obj, name)))
+
+    @staticmethod
+    def uninstrument(obj, method_names):
+        for name in method_names:
+            obj.__dict__.pop(name, None)
+
+    def get_state(self):
+        return {'calls': dict(self.calls), 'seconds': dict(self.seconds), 'counters': dict(self.counters)}
+
+    def reset(self):
+        self.calls.clear()
+        self.seconds.clear()
+        self.counters.clear()
+
+    def merge(self, state):
+        """
+        Adds the values of a state returned by get_state (e.g., from a worker process)
+        """
+        for stage, calls in state['calls'].items():
+            self.add_time(stage, state['seconds'][stage], calls)
+        for counter, value in state['counters'].items():
+            self.increment(counter, value)
+
+    def summary(self):
+        return {
+            'stages': {stage: {
+                'calls': self.calls[stage],
+                'seconds': round(self.seconds[stage], 6)
+            } for stage in sorted(self.calls)},
+            'counters': dict(sorted(self.counters.items()))
+        }
+
+    def to_prometheus(self):
+        lines = [
+            f'# HELP {self.PROMETHEUS_PREFIX}_stage_seconds_total Time spent in the conversion stage',
+            f'# TYPE {self.PROMETHEUS_PREFIX}_stage_seconds_total counter'
+        ]
+        lines.extend(f'{self.PROMETHEUS_PREFIX}_stage_seconds_total{{stage="{stage}"}} {self.seconds[stage]}'
+                     for stage in sorted(self.calls))
+        lines.extend([
+            f'# HELP {self.PROMETHEUS_PREFIX}_stage_calls_total Number of calls of the conversion stage',
+            f'# TYPE {self.PROMETHEUS_PREFIX}_stage_calls_total counter'
+        ])
+        lines.extend(f'{self.PROMETHEUS_PREFIX}_stage_calls_total{{stage="{stage}"}} {self.calls[stage]}'
+                     for stage in sorted(self.calls))
+        for counter in sorted(self.counters):
+            lines.extend([
+                f'# TYPE {self.PROMETHEUS_PREFIX}_{counter}_total counter',
+                f'{self.PROMETHEUS_PREFIX}_{counter}_total {self.counters[counter]}'
+            ])
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _write_atomically(path, content):
+        # the textfile collector could read a partially written file otherwise
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def export(self):
+        if self.json_path is not None:
+            self._write_atomically(self.json_path, json.dumps(self.summary(), indent=2))
+        if self.prometheus_path is not None:
+            self._write_atomically(self.prometheus_path, self.to_prometheus())
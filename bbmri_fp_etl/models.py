@@ -26,6 +26,7 @@ from enum import StrEnum
 from typing import List, Optional, NamedTuple
 
 from pydantic import BaseModel, Field
+from pydantic_core import PydanticUndefined
 from pydantic.types import date
 
 
@@ -459,3 +460,46 @@ class SamplingEvent(Event):
 class Case(BaseModel):
     donor: Donor
     samples: List[Sample]
+
+
+_CONSTRUCT_FIELDS = {}
+
+
+def _get_construct_fields(model):
+    try:
+        return _CONSTRUCT_FIELDS[model]
+    except KeyError:
+        fields = _CONSTRUCT_FIELDS[model] = [(name, field.default, field.default_factory)
+                                             for name, field in model.model_fields.items()]
+        return fields
+
+
+def construct(model, **values):
+    """
+    Creates an instance of model without validating the values, for sources whose data are already clean.
+    The values must already have the types of the fields (e.g., enum members, nested model instances and dates),
+    since no conversion is performed. Default values of the missing fields are set as in the normal constructor.
+    It is equivalent to model.model_construct, which is much slower since it inspects the default factories at
+    each call. The Converter can validate a sample of these instances (see validation_rate)
+    """
+    data = {}
+    for name, default, default_factory in _get_construct_fields(model):
+        if name in values:
+            data[name] = values[name]
+        elif default_factory is not None:
+            data[name] = default_factory()
+        elif default is not PydanticUndefined:
+            data[name] = default
+    instance = model.__new__(model)
+    object.__setattr__(instance, '__dict__', data)
+    object.__setattr__(instance, '__pydantic_fields_set__', set(values))
+    object.__setattr__(instance, '__pydantic_extra__', None)
+    object.__setattr__(instance, '__pydantic_private__', None)
+    return instance
+
+
+def validate(instance):
+    """
+    Validates an instance created with construct, raising a pydantic ValidationError if its values are not valid
+    """
+    type(instance).model_validate(instance.model_dump(serialize_as_any=True, warnings=False))
@@ -0,0 +1,97 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Registry that the sources can use to share a single instance of the models referenced by many records, such as the
+Collection of the Samples. Pydantic does not copy the model instances assigned to the fields, so all the Samples
+of a Collection reference the same object, which is created and validated only once
+"""
+from .models import Aggregate, Biobank, Collection, DiseaseOntologyCode, construct
+
+
+class ModelRegistry:
+    """
+    Keeps one instance for each Biobank and Collection id and for each DiseaseOntologyCode. The instances are shared,
+    so they must not be modified after they are registered. With trusted True, the models are created with
+    models.construct, without validation
+    """
+
+    def __init__(self, trusted=False):
+        self.trusted = trusted
+        self._instances = {}
+
+    def __len__(self):
+        return len(self._instances)
+
+    def _new(self, model, **values):
+        return construct(model, **values) if self.trusted else model(**values)
+
+    @staticmethod
+    def _get_code_key(ontology, code, ontology_version=None, description=None, free_text=None):
+        return DiseaseOntologyCode, ontology, code, ontology_version, description, free_text
+
+    def _get_key(self, instance):
+        if isinstance(instance, Aggregate):
+            return type(instance), instance.id
+        if isinstance(instance, DiseaseOntologyCode):
+            return self._get_code_key(instance.ontology, instance.code, instance.ontology_version,
+                                      instance.description, instance.free_text)
+        raise TypeError(f'{type(instance).__name__} instances cannot be registered')
+
+    def intern(self, instance):
+        """
+        Returns the registered instance equal to instance (i.e., with the same id for Biobanks and Collections),
+        registering instance if there is none
+        """
+        return self._instances.setdefault(self._get_key(instance), instance)
+
+    def get(self, model, id_):
+        """
+        Returns the registered Biobank or Collection with id id_, or None if it is not registered
+        """
+        return self._instances.get((model, id_))
+
+    def _get_or_create(self, model, key, values):
+        try:
+            return self._instances[key]
+        except KeyError:
+            instance = self._instances[key] = self._new(model, **values)
+            return instance
+
+    def biobank(self, id_, **values):
+        """
+        Returns the Biobank with id id_, creating it with values the first time. Later calls return the same
+        instance and ignore values
+        """
+        return self._get_or_create(Biobank, (Biobank, id_), dict(values, id=id_))
+
+    def collection(self, id_, **values):
+        """
+        Returns the Collection with id id_, creating it with values the first time. Later calls return the same
+        instance and ignore values
+        """
+        return self._get_or_create(Collection, (Collection, id_), dict(values, id=id_))
+
+    def disease_code(self, ontology, code, **values):
+        """
+        Returns the DiseaseOntologyCode with the specified values, creating it the first time
+        """
+        key = self._get_code_key(ontology, code, **values)
+        return self._get_or_create(DiseaseOntologyCode, key, dict(values, ontology=ontology, code=code))
+
+    def clear(self):
+        self._instances.clear()
@@ -16,31 +16,1245 @@
 # along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
 
 import csv
+import datetime
+import io
 import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from .encoders import get_json_encoder
+
+# the modules needed only by some of the outputs (e.g., tarfile, sqlite3) are imported when they are used, to keep the
+# import of the module fast
+
+logger = logging.getLogger('bbmri_fp_etl')
 
 
 class BaseOutput:
     def serialize(self, *args, **kwargs):
         raise NotImplementedError
 
+    def flush(self):
+        """
+        Writes any buffered data
+        """
+
+    def get_state(self):
+        """
+        Flushes the output and returns a JSON serializable description of what has been written so far. It is saved
+        in the Converter checkpoints and passed to restore_state when a conversion is resumed
+        """
+        self.flush()
+        return {}
+
+    def restore_state(self, state):
+        """
+        Prepares the output to continue a conversion from the state returned by get_state, discarding what has been
+        written after it. Outputs that overwrite their data (e.g., one file per resource) do not need to do anything
+        """
+
+    def get_payload_encoder(self):
+        """
+        Returns a picklable callable that takes the arguments of serialize and returns the data to write (e.g., the
+        encoded JSON) as a payload for write_payload, or None if the output does not support it. The Converter calls it
+        in the worker processes, so that the data are encoded in parallel and only the payloads are sent to the main
+        process
+        """
+        return None
+
+    def write_payload(self, payload):
+        """
+        Writes a payload created by the callable returned by get_payload_encoder
+        """
+        raise NotImplementedError
+
+    def track_modified_files(self):
+        """
+        Starts recording the paths of the files written by the output, which are returned by pop_modified_files. It is
+        used by StagedOutput to sync to disk only the files written since the last checkpoint
+        """
+
+    def pop_modified_files(self):
+        """
+        Returns the set of the paths of the files written, truncated or currently open since the last call, if
+        track_modified_files has been called. Outputs that do not write files return an empty set
+        """
+        return set()
+
+    def set_int_columns(self, columns):
+        """
+        Declares that the columns hold integers (e.g., the ids allocated by an IdAllocator). It is called by the
+        destinations and used by the outputs that write typed columns
+        """
+
+    def commit(self):
+        """
+        Called by the Converter when the conversion completes successfully, before close()
+        """
+
+    def close(self):
+        """
+        Flushes and releases any resource kept open by the output. It is called at the end of the conversion
+        """
+
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+COMPRESSION_EXTENSIONS = {
+    None: '',
+    GZIP: '.gz',
+    ZSTD: '.zst'
+}
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError('zstd compression requires zstandard. Install it with "pip install zstandard"') from e
+    return zstandard
+
+
+def _open_compressed(path, mode, compression, level=None):
+    """
+    Opens a binary file that compresses the data written to it. In append mode a new gzip member or zstd frame
+    is added to the file: zcat and zstdcat decompress all of them
+    """
+    if compression == GZIP:
+        import gzip
+        return gzip.GzipFile(path, mode, compresslevel=level if level is not None else 6)
+    if compression == ZSTD:
+        zstandard = _import_zstandard()
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).stream_writer(open(path, mode))
+    raise ValueError(f'Unsupported compression {compression}')
+
+
+def _write_compressed(path, data, compression, level):
+    with _open_compressed(path, 'wb', compression, level) as f:
+        f.write(data)
+
+
+class _BackgroundWriter:
+    """
+    Runs the write operations of an output in a background thread, in the order they are submitted, so that the
+    compression of the data overlaps with the conversion. At most max_pending operations are queued. zlib and zstd
+    release the GIL while compressing
+    """
+
+    def __init__(self, max_pending=8):
+        import queue
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='bbmri_fp_etl-writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                # after an error the following operations are skipped, the error is raised in the main thread
+                if self._error is None:
+                    task[0](*task[1:])
+            except BaseException as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def submit(self, function, *args):
+        self._check_error()
+        if not self._thread.is_alive():
+            raise ValueError('The background writer is closed')
+        self._queue.put((function, *args))
+
+    def wait(self):
+        """
+        Waits for the completion of the submitted operations
+        """
+        self._queue.join()
+        self._check_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check_error()
+
+
+class _BackgroundStream(io.RawIOBase):
+    """
+    Binary stream that writes to file in the thread of a _BackgroundWriter. It should be wrapped in a BufferedWriter,
+    so that the data are passed to the thread in large blocks
+    """
+
+    def __init__(self, file, writer):
+        super().__init__()
+        self._file = file
+        self._writer = writer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._writer.submit(self._file.write, bytes(data))
+        return len(data)
+
+    def flush(self):
+        if not self._file.closed:
+            self._writer.wait()
+            self._file.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._writer.wait()
+            finally:
+                # the compressed stream is ended in this thread, since no other write can be pending
+                self._file.close()
+                super().close()
+
+
+class _ModifiedFilesMixin:
+    """
+    Implements track_modified_files for the file outputs, which call _mark_modified when they write, truncate, open or
+    close a file, and list the files they keep open in _get_open_paths
+    """
+    _modified_paths = None
+
+    def track_modified_files(self):
+        if self._modified_paths is None:
+            self._modified_paths = set()
+
+    def _mark_modified(self, path):
+        if self._modified_paths is not None:
+            self._modified_paths.add(path)
+
+    def _get_open_paths(self):
+        return ()
+
+    def pop_modified_files(self):
+        if self._modified_paths is None:
+            return set()
+        # the files still open can be written after this call, so they are returned again the next time
+        paths, self._modified_paths = self._modified_paths, set()
+        paths.update(self._get_open_paths())
+        return paths
+
+
+class _CompressionMixin:
+    """
+    Methods shared by the file outputs that support compression. compression can be None, GZIP or ZSTD and the
+    extension of the files is .gz or .zst respectively. The data are compressed in a background thread
+    """
+
+    def _init_compression(self, compression, compression_level):
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(f'Unsupported compression {compression}')
+        if compression == ZSTD:
+            # fails at creation if zstandard is not installed
+            _import_zstandard()
+        self.compression = compression
+        self.compression_level = compression_level
+        self._background_writer = None
+
+    def _get_background_writer(self):
+        if self._background_writer is None:
+            self._background_writer = _BackgroundWriter()
+        return self._background_writer
+
+    def _open_binary(self, path, mode, buffer_size):
+        """
+        Opens a buffered binary file, compressed in the background if compression is set
+        """
+        if self.compression is None:
+            return open(path, mode, buffering=buffer_size)
+        raw = _BackgroundStream(_open_compressed(path, mode, self.compression, self.compression_level),
+                                self._get_background_writer())
+        return io.BufferedWriter(raw, buffer_size)
+
+    def _submit_file(self, path, data):
+        """
+        Writes a whole file with the data, in the background
+        """
+        self._get_background_writer().submit(_write_compressed, path, data, self.compression,
+                                             self.compression_level)
+
+    def _wait_background_writer(self):
+        if self._background_writer is not None:
+            self._background_writer.wait()
 
-class JsonFile(BaseOutput):
+    def _close_background_writer(self):
+        if self._background_writer is not None:
+            writer, self._background_writer = self._background_writer, None
+            writer.close()
 
-    def __init__(self, directory):
+
+class _JsonPayloadEncoder:
+    """
+    Payload encoder of the outputs that write a JSON document for each call of serialize: the payload is the file name
+    and the encoded document. The JSON encoder is created in the process that uses it
+    """
+
+    def __init__(self, json_backend=None, indent=False):
+        self.json_backend = json_backend
+        self.indent = indent
+        self._encoder = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_encoder'] = None
+        return state
+
+    def encode(self, obj):
+        if self._encoder is None:
+            self._encoder = get_json_encoder(self.json_backend, self.indent)
+        return self._encoder.encode(obj)
+
+    def __call__(self, file_name, obj):
+        return file_name, self.encode(obj)
+
+
+class _NDJsonPayloadEncoder(_JsonPayloadEncoder):
+    """
+    Payload encoder of NDJsonFile: the payload is the list of the (file name, line) written for a bundle
+    """
+
+    def __init__(self, json_backend=None, mode='resource'):
+        super().__init__(json_backend)
+        self.mode = mode
+
+    def __call__(self, file_name, obj):
+        if self.mode == NDJsonFile.BUNDLE:
+            return [('bundles', self.encode(obj) + b'\n')]
+        lines = []
+        for entry in obj['entry']:
+            if 'resource' in entry:
+                lines.append((entry['resource']['resourceType'], self.encode(entry['resource']) + b'\n'))
+            else:  # entries without resource (e.g., DELETE) are written as they are in a separate file
+                lines.append(('deleted', self.encode(entry['request']) + b'\n'))
+        return lines
+
+
+def _format_csv(header, rows, write_header=False):
+    f = io.StringIO(newline='')
+    writer = csv.DictWriter(f, fieldnames=header)
+    if write_header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return f.getvalue()
+
+
+class _CSVPayloadEncoder:
+    """
+    Payload encoder of the CSV outputs: the payload is the table name, the header and the CSV text of the rows
+    """
+
+    def __init__(self, write_header=False):
+        self.write_header = write_header
+
+    def __call__(self, file_name, header, rows):
+        return file_name, header, _format_csv(header, rows, self.write_header)
+
+
+def get_shard_path(file_name, shard_depth):
+    """
+    Returns the subdirectory of file_name in a sharded layout, made of shard_depth levels named with two hexadecimal
+    characters of the hash of the name (e.g., "3f/a0")
+    """
+    import hashlib
+    digest = hashlib.blake2b(file_name.encode('utf-8'), digest_size=max(shard_depth, 1)).hexdigest()
+    return '/'.join(digest[i:i + 2] for i in range(0, 2 * shard_depth, 2))
+
+
+class JsonFile(_ModifiedFilesMixin, _CompressionMixin, BaseOutput):
+    """
+    Writes each object in a JSON file. The JSON is compact, unless indent is True, and is encoded with the backend
+    json_backend of encoders.get_json_encoder. With shard_depth greater than 0 the files are distributed in
+    subdirectories (e.g., ab/cd/file_name.json with shard_depth 2), to avoid directories with too many files
+    """
+
+    def __init__(self, directory, compression=None, compression_level=None, json_backend=None, indent=False,
+                 shard_depth=0):
         self.output_dir = directory
+        self.shard_depth = shard_depth
+        self._init_compression(compression, compression_level)
+        self._encoder = _JsonPayloadEncoder(json_backend, indent)
+        self._directories = set()
+
+    def _get_directory(self, file_name):
+        if self.shard_depth == 0:
+            return self.output_dir
+        directory = f'{self.output_dir}/{get_shard_path(file_name, self.shard_depth)}'
+        if directory not in self._directories:
+            os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+        return directory
+
+    def get_payload_encoder(self):
+        return self._encoder
 
     def serialize(self, file_name, obj):
-        with open(f'{self.output_dir}/{file_name}.json', 'w') as f:
-            json.dump(obj, f, indent=2)
+        self.write_payload(self._encoder(file_name, obj))
+
+    def write_payload(self, payload):
+        file_name, data = payload
+        path = f'{self._get_directory(file_name)}/{file_name}.json{COMPRESSION_EXTENSIONS[self.compression]}'
+        if self.compression is None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        else:
+            self._submit_file(path, data)
+        self._mark_modified(path)
+
+    def flush(self):
+        self._wait_background_writer()
 
+    def close(self):
+        self._close_background_writer()
 
-class CSVFile(BaseOutput):
 
-    def __init__(self, directory):
+class CSVFile(_ModifiedFilesMixin, _CompressionMixin, BaseOutput):
+
+    def __init__(self, directory, compression=None, compression_level=None):
         self.output_dir = directory
+        self._init_compression(compression, compression_level)
+
+    def get_payload_encoder(self):
+        return _CSVPayloadEncoder(write_header=True)
 
     def serialize(self, file_name, header, rows):
-        with open(f'{self.output_dir}/{file_name}.csv', 'w', newline='') as f:
+        self.write_payload((file_name, header, _format_csv(header, rows, write_header=True)))
+
+    def write_payload(self, payload):
+        file_name, _, text = payload
+        path = f'{self.output_dir}/{file_name}.csv{COMPRESSION_EXTENSIONS[self.compression]}'
+        if self.compression is None:
+            with open(path, 'w', newline='') as f:
+                f.write(text)
+        else:
+            self._submit_file(path, text.encode('utf-8'))
+        self._mark_modified(path)
+
+    def flush(self):
+        self._wait_background_writer()
+
+    def close(self):
+        self._close_background_writer()
+
+
+class StreamingCSVFile(_ModifiedFilesMixin, _CompressionMixin, BaseOutput):
+    """
+    CSV output that keeps one file open for each table for the whole conversion. The header is written once, when
+    the file is created, and the rows of all the following calls are appended. Rows are buffered and written to disk
+    in blocks of buffer_size bytes. The files can be compressed with GZIP or ZSTD
+    """
+
+    def __init__(self, directory, buffer_size=1024 * 1024, compression=None, compression_level=None):
+        self.output_dir = directory
+        self.buffer_size = buffer_size
+        self._init_compression(compression, compression_level)
+        self._files = {}
+        self._writers = {}
+        self._created = set()
+
+    def _get_file_path(self, file_name):
+        return f'{self.output_dir}/{file_name}.csv{COMPRESSION_EXTENSIONS[self.compression]}'
+
+    def _get_writer(self, file_name, header):
+        try:
+            return self._writers[file_name]
+        except KeyError:
+            # if the file has been created before a close, the new rows are appended to it
+            mode = 'a' if file_name in self._created else 'w'
+            path = self._get_file_path(file_name)
+            if self.compression is None:
+                f = open(path, mode, newline='', buffering=self.buffer_size)
+            else:
+                f = io.TextIOWrapper(self._open_binary(path, f'{mode}b', self.buffer_size), encoding='utf-8',
+                                     newline='')
+            self._mark_modified(path)
             writer = csv.DictWriter(f, fieldnames=header)
-            writer.writeheader()
-            writer.writerows(rows)
+            if file_name not in self._created:
+                writer.writeheader()
+                self._created.add(file_name)
+            self._files[file_name] = f
+            self._writers[file_name] = writer
+            return writer
+
+    def serialize(self, file_name, header, rows):
+        self._get_writer(file_name, header).writerows(rows)
+
+    def get_payload_encoder(self):
+        return _CSVPayloadEncoder()
+
+    def write_payload(self, payload):
+        file_name, header, text = payload
+        self._get_writer(file_name, header)
+        self._files[file_name].write(text)
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+        # the buffered writers do not flush their raw stream, so the compressed data may still be in the queue
+        self._wait_background_writer()
+
+    def get_state(self):
+        if self.compression is None:
+            self.flush()
+        else:
+            # the compressed stream is ended, so that the file can be truncated at this size. The next rows are
+            # written in a new gzip member or zstd frame
+            self._close_files()
+        return {file_name: os.path.getsize(self._get_file_path(file_name)) for file_name in self._created}
+
+    def restore_state(self, state):
+        for file_name, size in state.items():
+            with open(self._get_file_path(file_name), 'r+b') as f:
+                f.truncate(size)
+            self._mark_modified(self._get_file_path(file_name))
+            self._created.add(file_name)
+
+    def _get_open_paths(self):
+        return [self._get_file_path(file_name) for file_name in self._files]
+
+    def _close_files(self):
+        for file_name, f in self._files.items():
+            f.close()
+            self._mark_modified(self._get_file_path(file_name))
+        self._files.clear()
+        self._writers.clear()
+
+    def close(self):
+        try:
+            self._close_files()
+        finally:
+            self._close_background_writer()
+
+
+class NDJsonFile(_ModifiedFilesMixin, _CompressionMixin, BaseOutput):
+    """
+    Output for FHIRDest that writes the bundles as newline delimited JSON, as in the FHIR Bulk Data format.
+    With mode RESOURCE the resources of the bundles are written in one file for each resource type
+    (e.g., Patient.ndjson, Specimen.ndjson) and the requests of the DELETE entries in deleted.ndjson.
+    With mode BUNDLE each bundle is written in a line of bundles.ndjson.
+    If max_file_size is specified, a new file (e.g., Patient.1.ndjson) is started when the current one
+    exceeds that size in bytes. The files can be compressed with GZIP or ZSTD: in that case max_file_size refers
+    to the uncompressed data.
+    """
+    RESOURCE = 'resource'
+    BUNDLE = 'bundle'
+
+    def __init__(self, directory, mode=RESOURCE, max_file_size=None, buffer_size=1024 * 1024, compression=None,
+                 compression_level=None, json_backend=None):
+        assert mode in (self.RESOURCE, self.BUNDLE)
+        self.output_dir = directory
+        self.mode = mode
+        self.max_file_size = max_file_size
+        self.buffer_size = buffer_size
+        self._init_compression(compression, compression_level)
+        self._encoder = _NDJsonPayloadEncoder(json_backend, mode)
+        self._files = {}
+        self._sizes = {}
+        self._parts = {}
+
+    def _get_file_path(self, name):
+        part = self._parts.get(name, 0)
+        extension = COMPRESSION_EXTENSIONS[self.compression]
+        if part == 0:
+            return f'{self.output_dir}/{name}.ndjson{extension}'
+        return f'{self.output_dir}/{name}.{part}.ndjson{extension}'
+
+    def _write(self, name, line):
+        try:
+            f = self._files[name]
+        except KeyError:
+            mode = 'ab' if name in self._parts else 'wb'
+            self._parts.setdefault(name, 0)
+            f = self._files[name] = self._open_binary(self._get_file_path(name), mode, self.buffer_size)
+            self._mark_modified(self._get_file_path(name))
+            # the size of the uncompressed data already in a compressed file is not known: the one written by this
+            # output is used
+            self._sizes[name] = f.tell() if self.compression is None else self._sizes.get(name, 0)
+        if self.max_file_size is not None and 0 < self._sizes[name] and \
+                self._sizes[name] + len(line) > self.max_file_size:
+            f.close()
+            self._mark_modified(self._get_file_path(name))
+            self._parts[name] += 1
+            f = self._files[name] = self._open_binary(self._get_file_path(name), 'wb', self.buffer_size)
+            self._mark_modified(self._get_file_path(name))
+            self._sizes[name] = 0
+        f.write(line)
+        self._sizes[name] += len(line)
+
+    def get_payload_encoder(self):
+        return self._encoder
+
+    def serialize(self, file_name, obj):
+        self.write_payload(self._encoder(file_name, obj))
+
+    def write_payload(self, payload):
+        for name, line in payload:
+            self._write(name, line)
+
+    def flush(self):
+        for f in self._files.values():
+            f.flush()
+        # the buffered writers do not flush their raw stream, so the compressed data may still be in the queue
+        self._wait_background_writer()
+
+    def get_state(self):
+        if self.compression is None:
+            self.flush()
+        else:
+            # as in StreamingCSVFile, the compressed streams are ended so that the files can be truncated
+            self._close_files()
+        # the uncompressed size is saved to split the files at the same points when the conversion is resumed
+        return {name: [part, os.path.getsize(self._get_file_path(name)), self._sizes.get(name, 0)]
+                for name, part in self._parts.items()}
+
+    def restore_state(self, state):
+        for name, (part, size, *uncompressed_size) in state.items():
+            self._parts[name] = part
+            if self.compression is not None and uncompressed_size:
+                self._sizes[name] = uncompressed_size[0]
+            with open(self._get_file_path(name), 'r+b') as f:
+                f.truncate(size)
+            self._mark_modified(self._get_file_path(name))
+            # removes the files started after the state was saved
+            self._parts[name] = part + 1
+            while os.path.exists(self._get_file_path(name)):
+                os.remove(self._get_file_path(name))
+                self._parts[name] += 1
+            self._parts[name] = part
+
+    def _get_open_paths(self):
+        return [self._get_file_path(name) for name in self._files]
+
+    def _close_files(self):
+        for name, f in self._files.items():
+            f.close()
+            self._mark_modified(self._get_file_path(name))
+        self._files.clear()
+
+    def close(self):
+        try:
+            self._close_files()
+        finally:
+            self._close_background_writer()
+
+
+class ArchiveFile(_ModifiedFilesMixin, BaseOutput):
+    """
+    Output for FHIRDest that writes all the bundles in a single tar or zip file, as the files file_name.json written
+    by JsonFile, which are obtained extracting the archive. The tar file is written as a stream, while the zip file
+    keeps in memory the list of its members until it is closed. Next to the archive, the file path.index.csv lists
+    the name, offset and size of each member, so that a bundle can be read without scanning the archive. The offset
+    is the one of the data for tar files and of the member header for zip files
+    """
+    TAR = 'tar'
+    ZIP = 'zip'
+
+    def __init__(self, path, archive_format=TAR, json_backend=None, indent=False, buffer_size=1024 * 1024):
+        assert archive_format in (self.TAR, self.ZIP)
+        self.path = path
+        self.archive_format = archive_format
+        self.buffer_size = buffer_size
+        self._encoder = _JsonPayloadEncoder(json_backend, indent)
+        self._file = None
+        self._zip = None
+        self._index_file = None
+        self._index_writer = None
+        # the size of the tar file without the end of archive blocks
+        self._offset = 0
+        self._created = False
+
+    def _open(self):
+        mode = 'a' if self._created else 'w'
+        if self.archive_format == self.TAR:
+            if self._created:
+                # the new members overwrite the end of archive blocks
+                self._file = open(self.path, 'r+b', buffering=self.buffer_size)
+                self._file.truncate(self._offset)
+                self._file.seek(self._offset)
+            else:
+                self._file = open(self.path, 'wb', buffering=self.buffer_size)
+        else:
+            import zipfile
+            self._zip = zipfile.ZipFile(self.path, mode, compression=zipfile.ZIP_DEFLATED)
+        self._index_file = open(f'{self.path}.index.csv', mode, newline='', buffering=self.buffer_size)
+        self._index_writer = csv.writer(self._index_file)
+        self._mark_modified(self.path)
+        self._mark_modified(f'{self.path}.index.csv')
+        if not self._created:
+            self._index_writer.writerow(['name', 'offset', 'size'])
+            self._created = True
+
+    def _add_tar_member(self, name, data):
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+        padding = -len(data) % tarfile.BLOCKSIZE
+        self._file.write(header)
+        self._file.write(data)
+        self._file.write(b'\0' * padding)
+        offset = self._offset + len(header)
+        self._offset = offset + len(data) + padding
+        return offset
+
+    def get_payload_encoder(self):
+        return self._encoder
+
+    def serialize(self, file_name, obj):
+        self.write_payload(self._encoder(file_name, obj))
+
+    def write_payload(self, payload):
+        file_name, data = payload
+        if self._index_writer is None:
+            self._open()
+        name = f'{file_name}.json'
+        if self.archive_format == self.TAR:
+            offset = self._add_tar_member(name, data)
+        else:
+            self._zip.writestr(name, data)
+            offset = self._zip.filelist[-1].header_offset
+        self._index_writer.writerow([name, offset, len(data)])
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+        if self._index_file is not None:
+            self._index_file.flush()
+
+    def get_state(self):
+        self.flush()
+        if not self._created:
+            return {}
+        return {'size': self._offset, 'index_size': os.path.getsize(f'{self.path}.index.csv')}
+
+    def restore_state(self, state):
+        if self.archive_format == self.ZIP:
+            raise NotImplementedError('Resuming a conversion is not supported by zip files')
+        if state:
+            with open(f'{self.path}.index.csv', 'r+b') as f:
+                f.truncate(state['index_size'])
+            self._mark_modified(f'{self.path}.index.csv')
+            self._offset = state['size']
+            self._created = True
+
+    def _get_open_paths(self):
+        if self._index_file is None:
+            return ()
+        return [self.path, f'{self.path}.index.csv']
+
+    def close(self):
+        for path in self._get_open_paths():
+            self._mark_modified(path)
+        if self._file is not None:
+            import tarfile
+            # end of archive: two empty blocks
+            self._file.write(b'\0' * 2 * tarfile.BLOCKSIZE)
+            self._file.close()
+            self._file = None
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = self._index_writer = None
+
+
+class FHIRServer(BaseOutput):
+    """
+    Output for FHIRDest that uploads the bundles to a FHIR server. The entries of bundle_size participant bundles
+    are merged in a single transaction bundle, which is POSTed to the base url of the server. Up to max_concurrency
+    transactions are sent in parallel on a pool of keep-alive connections. Requests failing with 429 or 5xx status
+    codes, connection errors or timeouts are retried with exponential backoff (honouring the Retry-After header)
+    """
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url, bundle_size=100, max_concurrency=4, max_retries=5, backoff_factor=0.5, timeout=60,
+                 auth=None, json_backend=None):
+        self.base_url = base_url.rstrip('/')
+        self.bundle_size = bundle_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        # requests is imported only when it is used, since it takes a large part of the import time of the package
+        import requests
+        from requests.adapters import HTTPAdapter
+        self._retry_errors = (requests.ConnectionError, requests.Timeout)
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update({'Content-Type': 'application/fhir+json', 'Accept': 'application/fhir+json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._encoder = get_json_encoder(json_backend)
+        self._entries = []
+        self._bundles_count = 0
+        self._executor = None
+        self._pending = deque()
+
+    def _get_retry_delay(self, attempt, response=None):
+        if response is not None:
+            try:
+                return float(response.headers['Retry-After'])
+            except (KeyError, ValueError):
+                pass
+        return self.backoff_factor * 2 ** attempt
+
+    def _post(self, data):
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.base_url, data=data, timeout=self.timeout)
+            except self._retry_errors:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._get_retry_delay(attempt)
+            else:
+                if response.status_code not in self.RETRY_STATUS_CODES or attempt == self.max_retries:
+                    response.raise_for_status()
+                    return response
+                delay = self._get_retry_delay(attempt, response)
+            logger.debug('Transaction to %s failed. Retrying in %s seconds', self.base_url, delay)
+            time.sleep(delay)
+
+    def serialize(self, file_name, obj):
+        self._entries.extend(obj['entry'])
+        self._bundles_count += 1
+        if self._bundles_count >= self.bundle_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends the transaction with the pending entries. It blocks when max_concurrency transactions are in progress
+        """
+        if self._entries:
+            data = self._encoder.encode({
+                'resourceType': 'Bundle',
+                'type': 'transaction',
+                'entry': self._entries
+            })
+            self._entries = []
+            self._bundles_count = 0
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+            self._pending.append(self._executor.submit(self._post, data))
+        while len(self._pending) >= self.max_concurrency:
+            self._pending.popleft().result()
+
+    def get_state(self):
+        self.flush()
+        while self._pending:
+            self._pending.popleft().result()
+        return {}
+
+    def close(self):
+        self.flush()
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self.session.close()
+
+
+class OMOPDatabase(BaseOutput):
+    """
+    Base output for OMOPDest that inserts the rows directly in the tables of a database. The rows are buffered and
+    inserted in batches of batch_size rows, each batch in a single transaction
+    """
+
+    def __init__(self, connection, batch_size=10000):
+        self.connection = connection
+        self.batch_size = batch_size
+        self._rows = {}
+        self._headers = {}
+        self._rows_count = 0
+
+    def _insert(self, cursor, table, header, rows):
+        raise NotImplementedError
+
+    def serialize(self, file_name, header, rows):
+        self._headers.setdefault(file_name, header)
+        self._rows.setdefault(file_name, []).extend(rows)
+        self._rows_count += len(rows)
+        if self._rows_count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows_count == 0:
+            return
+        cursor = self.connection.cursor()
+        try:
+            for table, rows in self._rows.items():
+                if rows:
+                    self._insert(cursor, table, self._headers[table], rows)
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        self._rows = {}
+        self._rows_count = 0
+
+    def restore_state(self, state):
+        raise NotImplementedError('Resuming a conversion is not supported by database outputs: '
+                                  'the rows committed after the checkpoint cannot be told apart')
+
+    def close(self):
+        self.flush()
+
+
+class SQLiteDatabase(OMOPDatabase):
+    """
+    OMOPDatabase for SQLite, using executemany. If create_tables is True, the missing tables are created with the
+    columns of the rows
+    """
+
+    def __init__(self, database, batch_size=10000, create_tables=True):
+        import sqlite3
+        if isinstance(database, sqlite3.Connection):
+            connection = database
+        else:
+            connection = sqlite3.connect(database)
+        super().__init__(connection, batch_size)
+        self.create_tables = create_tables
+
+    @staticmethod
+    def _to_db_value(value):
+        if value == '':
+            return None
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return value.isoformat()
+        return value
+
+    def _insert(self, cursor, table, header, rows):
+        if self.create_tables:
+            cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(header)})')
+        cursor.executemany(
+            f'INSERT INTO {table} ({", ".join(header)}) VALUES ({", ".join("?" * len(header))})',
+            [tuple(self._to_db_value(row[col]) for col in header) for row in rows]
+        )
+
+
+class PostgreSQLDatabase(OMOPDatabase):
+    """
+    OMOPDatabase for PostgreSQL compatible databases, using COPY FROM STDIN. The connection must be created with
+    psycopg or psycopg2 and the tables of the OMOP CDM must already exist. Empty values are loaded as NULL
+    """
+
+    def _insert(self, cursor, table, header, rows):
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=header)
+        writer.writerows(rows)
+        statement = f'COPY {table} ({", ".join(header)}) FROM STDIN WITH (FORMAT csv)'
+        if hasattr(cursor, 'copy'):  # psycopg 3
+            with cursor.copy(statement) as copy:
+                copy.write(buffer.getvalue())
+        else:  # psycopg2
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+
+
+# Types of the OMOP columns in the Parquet files. The columns not listed here are written as strings
+PARQUET_INT_COLUMNS = {
+    'year_of_birth', 'month_of_birth', 'day_of_birth', 'gender_concept_id', 'race_concept_id',
+    'gender_source_concept_id', 'race_source_concept_id', 'ethnicity_source_concept_id', 'location_id', 'provider_id',
+    'care_site_id', 'specimen_concept_id', 'specimen_type_concept_id', 'unit_concept_id', 'procedure_concept_id',
+    'procedure_source_concept_id', 'procedure_type_concept_id', 'modifier_concept_id', 'condition_type_concept_id',
+    'period_type_concept_id', 'visit_occurrence_id', 'visit_detail_id'
+}
+PARQUET_DATE_COLUMNS = {
+    'condition_start_date', 'condition_end_date', 'specimen_date', 'procedure_date', 'procedure_end_date',
+    'observation_period_start_date', 'observation_period_end_date'
+}
+PARQUET_TIMESTAMP_COLUMNS = {
+    'birth_datetime', 'condition_start_datetime', 'condition_end_datetime', 'specimen_datetime', 'procedure_datetime',
+    'procedure_end_datetime'
+}
+
+
+class ParquetFile(_ModifiedFilesMixin, BaseOutput):
+    """
+    Output for OMOPDest that writes one Parquet file for each table. The rows are accumulated in column buffers and
+    written in row groups of row_group_size rows. Concept ids are written as integers, dates as date32 and
+    datetimes as timestamps. It requires pyarrow
+    """
+
+    def __init__(self, directory, row_group_size=100000, compression='zstd'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise ImportError('ParquetFile requires pyarrow. Install it with "pip install pyarrow"') from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.output_dir = directory
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self._int_columns = PARQUET_INT_COLUMNS
+        self._columns = {}
+        self._counts = {}
+        self._writers = {}
+
+    def set_int_columns(self, columns):
+        self._int_columns = PARQUET_INT_COLUMNS.union(columns)
+
+    @staticmethod
+    def _to_int(value):
+        return None if value is None or value == '' else int(value)
+
+    @staticmethod
+    def _to_date(value):
+        if value is None or value == '':
+            return None
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if isinstance(value, datetime.date):
+            return value
+        return datetime.date.fromisoformat(value[:10])
+
+    @staticmethod
+    def _to_timestamp(value):
+        if value is None or value == '':
+            return None
+        if isinstance(value, datetime.datetime):
+            return value
+        if isinstance(value, datetime.date):
+            return datetime.datetime(value.year, value.month, value.day)
+        return datetime.datetime.fromisoformat(value)
+
+    @staticmethod
+    def _to_string(value):
+        return None if value is None or value == '' else str(value)
+
+    def _get_type(self, column):
+        if column in self._int_columns:
+            return self._pa.int64(), self._to_int
+        if column in PARQUET_DATE_COLUMNS:
+            return self._pa.date32(), self._to_date
+        if column in PARQUET_TIMESTAMP_COLUMNS:
+            return self._pa.timestamp('us'), self._to_timestamp
+        return self._pa.string(), self._to_string
+
+    def _get_file_path(self, table):
+        return f'{self.output_dir}/{table}.parquet'
+
+    def _get_open_paths(self):
+        return [self._get_file_path(table) for table in self._writers]
+
+    def _write_row_group(self, table):
+        columns = self._columns[table]
+        writer = self._writers.get(table)
+        if writer is None:
+            schema = self._pa.schema([(c, self._get_type(c)[0]) for c in columns])
+            writer = self._writers[table] = self._pq.ParquetWriter(
+                self._get_file_path(table), schema, compression=self.compression)
+            self._mark_modified(self._get_file_path(table))
+        writer.write_table(self._pa.table({
+            c: self._pa.array(values, type=writer.schema.field(c).type) for c, values in columns.items()
+        }, schema=writer.schema))
+        for values in columns.values():
+            values.clear()
+        self._counts[table] = 0
+
+    def serialize(self, file_name, header, rows):
+        try:
+            columns = self._columns[file_name]
+        except KeyError:
+            columns = self._columns[file_name] = {c: [] for c in header}
+            self._counts[file_name] = 0
+        for column, values in columns.items():
+            convert = self._get_type(column)[1]
+            values.extend(convert(row[column]) for row in rows)
+        self._counts[file_name] += len(rows)
+        if self._counts[file_name] >= self.row_group_size:
+            self._write_row_group(file_name)
+
+    def restore_state(self, state):
+        raise NotImplementedError('Resuming a conversion is not supported by ParquetFile: '
+                                  'Parquet files cannot be appended')
+
+    def close(self):
+        for table, count in self._counts.items():
+            if count > 0:
+                self._write_row_group(table)
+        for table, writer in self._writers.items():
+            writer.close()
+            self._mark_modified(self._get_file_path(table))
+        self._writers.clear()
+        self._columns.clear()
+        self._counts.clear()
+
+
+class StagedOutput(BaseOutput):
+    """
+    Wraps a file output (e.g., JsonFile or StreamingCSVFile) so that its files are written in a staging directory and
+    published in the output directory only when the conversion completes. The files written since the last checkpoint
+    are synced to disk, with their directories, at each checkpoint and before they are moved to the output directory.
+    The published files are listed, with their size and SHA-256 checksum, in a manifest written last. An interrupted
+    conversion leaves the files in the staging directory, where they are used if the conversion is resumed from a
+    checkpoint and removed otherwise
+    """
+    MANIFEST = 'manifest.json'
+    STAGING_DIR = '.staging'
+
+    def __init__(self, output):
+        """
+        :param output: the wrapped output. It must write its files in the directory output_dir
+        """
+        self.output = output
+        self.directory = output.output_dir
+        self.staging_dir = os.path.join(self.directory, self.STAGING_DIR)
+        output.output_dir = self.staging_dir
+        output.track_modified_files()
+        self._started = False
+        self._committed = False
+
+    def _start(self, clear):
+        if clear and os.path.isdir(self.staging_dir):
+            import shutil
+            shutil.rmtree(self.staging_dir)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self._started = True
+
+    def serialize(self, *args, **kwargs):
+        if not self._started:
+            # the files left by an interrupted conversion are kept only when it is resumed
+            self._start(clear=True)
+        self.output.serialize(*args, **kwargs)
+
+    def get_payload_encoder(self):
+        return self.output.get_payload_encoder()
+
+    def write_payload(self, payload):
+        if not self._started:
+            self._start(clear=True)
+        self.output.write_payload(payload)
+
+    def flush(self):
+        self.output.flush()
+
+    def set_int_columns(self, columns):
+        self.output.set_int_columns(columns)
+
+    def _get_staged_files(self):
+        """
+        Returns the paths of the staged files relative to the staging directory
+        """
+        return sorted(os.path.relpath(os.path.join(root, f), self.staging_dir)
+                      for root, _, files in os.walk(self.staging_dir) for f in files)
+
+    @staticmethod
+    def _fsync(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _sync_directories(self, paths):
+        # the renames are durable only after the directories are synced. Directories cannot be opened on Windows
+        if os.name != 'nt':
+            for path in paths:
+                self._fsync(path)
+
+    def _sync_modified_files(self):
+        """
+        Syncs the files written by the output since the last call and the staging directories that contain them, up
+        to the staging directory, so that the new files and subdirectories are durable too
+        """
+        directories = {self.staging_dir}
+        for path in self.output.pop_modified_files():
+            self._fsync(path)
+            directory = os.path.dirname(path)
+            while directory not in directories and len(directory) > len(self.staging_dir):
+                directories.add(directory)
+                directory = os.path.dirname(directory)
+        self._sync_directories(directories)
+
+    def get_state(self):
+        state = self.output.get_state()
+        if self._started:
+            # the staged files must be on disk before the checkpoint is saved
+            self._sync_modified_files()
+        return state
+
+    def restore_state(self, state):
+        self._start(clear=False)
+        self.output.restore_state(state)
+
+    def commit(self):
+        self._committed = True
+
+    @staticmethod
+    def _get_checksum(path):
+        import hashlib
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    def _publish(self):
+        # the files are synced before they are renamed, so that a published file is never incomplete
+        self._sync_modified_files()
+        files = self._get_staged_files()
+        staged_paths = [os.path.join(self.staging_dir, f) for f in files]
+
+        # the files of the previous conversions in the directory stay in the manifest, which is removed while the
+        # files are moved so that it never describes a partially published output
+        manifest_path = os.path.join(self.directory, self.MANIFEST)
+        manifest = {'files': {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            os.remove(manifest_path)
+
+        directories = {self.directory}
+        for file_name, staged_path in zip(files, staged_paths):
+            manifest['files'][file_name.replace(os.sep, '/')] = {
+                'size': os.path.getsize(staged_path),
+                'sha256': self._get_checksum(staged_path)
+            }
+            path = os.path.join(self.directory, file_name)
+            directories.add(os.path.dirname(path))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(staged_path, path)
+        self._sync_directories(directories)
+
+        manifest['created'] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with open(f'{manifest_path}.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+        self._sync_directories([self.directory])
+        import shutil
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+        logger.debug('Published %s file(s) in %s', len(files), self.directory)
+
+    def close(self):
+        self.output.close()
+        if self._committed:
+            self._publish()
+            self._committed = self._started = False
+        elif self._started:
+            logger.warning('The conversion did not complete: the files are left in %s', self.staging_dir)
@@ -16,8 +16,9 @@
 # along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
 
 from abc import ABC, abstractmethod
-from typing import Iterable
+from typing import AsyncIterator, Iterable, List, Optional
 from . models import Aggregate, Case
+from . utils import chunks
 
 
 class AbstractSource(ABC):
@@ -28,6 +29,8 @@ class AbstractSource(ABC):
         This method should return the data in the Biobank represented as Case
         Each Case contains data about the donor, his/her samples and events related to the donor and to the samples
         (e.g., Diagnosis Event, Sampling Event, etc...)
+        The Converter consumes the Cases one at a time, so the method can be implemented as a generator to avoid
+        loading all the data in memory
         :return: Iterable[Case]
         """
 
@@ -37,3 +40,70 @@ class AbstractSource(ABC):
         This method should return data about Biobanks and Collections
         :return:  Iterable[Aggregate]
         """
+
+    def iter_case_batches(self, batch_size) -> Iterable[List[Case]]:
+        """
+        Returns the Cases in lists of at most batch_size elements. The default implementation splits the output of
+        get_cases_data: sources that query a database or a REST API can override it to retrieve one page at a time
+        :return: Iterable[List[Case]]
+        """
+        return chunks(self.get_cases_data(), batch_size)
+
+    def iter_biobank_batches(self, batch_size) -> Iterable[List[Aggregate]]:
+        """
+        Returns the Biobanks and Collections in lists of at most batch_size elements
+        :return: Iterable[List[Aggregate]]
+        """
+        return chunks(self.get_biobanks_data(), batch_size)
+
+    async def aget_cases_data(self) -> AsyncIterator[Case]:
+        """
+        Asynchronous version of get_cases_data, used by the Converter when use_async is True. Sources based on
+        asynchronous clients should override it. The default implementation iterates over get_cases_data
+        :return: AsyncIterator[Case]
+        """
+        for case in self.get_cases_data():
+            yield case
+
+    async def aget_biobanks_data(self) -> AsyncIterator[Aggregate]:
+        """
+        Asynchronous version of get_biobanks_data
+        :return: AsyncIterator[Aggregate]
+        """
+        for aggregate in self.get_biobanks_data():
+            yield aggregate
+
+
+class KeysetPaginatedSource(AbstractSource, ABC):
+    """
+    Base class for sources that read the Cases one page at a time using keyset pagination: each page contains the
+    Cases whose key (by default the donor id) follows the key of the last Case of the previous page, in the order
+    used by the underlying store. Concrete classes implement get_cases_page
+    """
+    page_size = 1000
+
+    @abstractmethod
+    def get_cases_page(self, after_key: Optional[str], limit: int) -> List[Case]:
+        """
+        Returns at most limit Cases, sorted by key, whose key follows after_key. after_key is None for the first page
+        :return: List[Case]
+        """
+
+    @staticmethod
+    def get_case_key(case: Case) -> str:
+        return case.donor.id
+
+    def iter_case_batches(self, batch_size=None) -> Iterable[List[Case]]:
+        limit = batch_size or self.page_size
+        after_key = None
+        while True:
+            page = self.get_cases_page(after_key, limit)
+            if page:
+                yield page
+            if len(page) < limit:
+                return
+            after_key = self.get_case_key(page[-1])
+
+    def get_cases_data(self) -> Iterable[Case]:
+        for page in self.iter_case_batches():
+            yield from page
@@ -0,0 +1,112 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent state used by the Converter for incremental conversions
+"""
+import hashlib
+import sqlite3
+
+
+def content_hash(record):
+    """
+    Returns the hash of the content of a model instance. The fields are serialized with their runtime type, so that
+    the ones of the subclasses (e.g., the disease of a DiagnosisEvent in Donor.events) are part of the hash
+    """
+    data = record.model_dump_json(serialize_as_any=True, warnings=False)
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class StateStore:
+    """
+    SQLite store that keeps, for each record converted in the previous runs, its content hash and the ids of its
+    children (e.g., the samples and the events of a Case). During a run the records returned by the source are
+    marked as seen, so that at the end the ones not seen can be recognized as deleted
+    """
+    SAMPLE = 'sample'
+    EVENT = 'event'
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS records ('
+                                'kind TEXT NOT NULL, '
+                                'id TEXT NOT NULL, '
+                                'parent_id TEXT, '
+                                'hash TEXT, '
+                                'seen INTEGER NOT NULL DEFAULT 1, '
+                                'parent_kind TEXT, '
+                                'PRIMARY KEY (kind, id))')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(records)')]
+        if 'parent_kind' not in columns:
+            # stores created by the previous versions: the kind of the parents is taken from their records
+            self.connection.execute('ALTER TABLE records ADD COLUMN parent_kind TEXT')
+            self.connection.execute('UPDATE records SET parent_kind = ('
+                                    'SELECT p.kind FROM records p '
+                                    'WHERE p.id = records.parent_id AND p.parent_id IS NULL'
+                                    ') WHERE parent_id IS NOT NULL')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS records_parent ON records (parent_id, kind)')
+        self.connection.commit()
+
+    def __getstate__(self):
+        # the connection cannot be pickled: the store is only used by the main process
+        state = self.__dict__.copy()
+        state['connection'] = None
+        return state
+
+    def begin_run(self, kind):
+        self.connection.execute('UPDATE records SET seen = 0 WHERE kind = ?', (kind,))
+
+    def get_hash(self, kind, id_):
+        row = self.connection.execute('SELECT hash FROM records WHERE kind = ? AND id = ?', (kind, id_)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_children(self, kind, parent_id):
+        return [row[0] for row in self.connection.execute(
+            'SELECT id FROM records WHERE kind = ? AND parent_id = ?', (kind, parent_id))]
+
+    def mark_seen(self, kind, id_):
+        self.connection.execute('UPDATE records SET seen = 1 WHERE kind = ? AND id = ?', (kind, id_))
+
+    def update(self, kind, id_, hash_, children=None):
+        """
+        Stores the hash of a record replacing its children with the ones in children, a dict kind -> ids
+        """
+        self.connection.execute('INSERT OR REPLACE INTO records (kind, id, parent_id, hash, seen) '
+                                'VALUES (?, ?, NULL, ?, 1)', (kind, id_, hash_))
+        self._delete_children(kind, id_)
+        for child_kind, ids in (children or {}).items():
+            self.connection.executemany('INSERT OR REPLACE INTO records (kind, id, parent_id, hash, seen, parent_kind) '
+                                        'VALUES (?, ?, ?, NULL, 1, ?)', ((child_kind, i, id_, kind) for i in ids))
+
+    def get_unseen(self, kind):
+        return [row[0] for row in self.connection.execute(
+            'SELECT id FROM records WHERE kind = ? AND seen = 0', (kind,))]
+
+    def _delete_children(self, kind, id_):
+        # the ids of the records of different kinds (e.g., a Case and an Aggregate) can be the same
+        self.connection.execute('DELETE FROM records WHERE parent_id = ? AND parent_kind = ?', (id_, kind))
+
+    def delete(self, kind, id_):
+        self._delete_children(kind, id_)
+        self.connection.execute('DELETE FROM records WHERE kind = ? AND id = ?', (kind, id_))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
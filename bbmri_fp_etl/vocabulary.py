@@ -0,0 +1,144 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Index of the OMOP standardized vocabularies, built from the CSV files downloaded from Athena
+(https://athena.ohdsi.org), to get the concept ids of the codes of the source
+"""
+import csv
+import logging
+import os
+import sqlite3
+import sys
+
+from bbmri_fp_etl.connections import ProcessConnectionMixin
+
+logger = logging.getLogger('bbmri_fp_etl')
+
+_MISSING = object()
+
+
+class ConceptIndex(ProcessConnectionMixin):
+    """
+    SQLite index with the concept id and the standard concept id of each (vocabulary_id, concept_code). The standard
+    concept is the concept itself if it is standard, otherwise the one it "Maps to". The index is created once with
+    build() and then opened read only. The lookups are cached in memory
+    """
+
+    def __init__(self, path):
+        """
+        :param path: the path of an index created with build()
+        """
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f'Concept index {path} not found. Create it with ConceptIndex.build()')
+        self.path = path
+        self._cache = {}
+
+    def _connect(self):
+        return sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, check_same_thread=False)
+
+    def get_concept(self, vocabulary_id, code):
+        """
+        :return: a tuple (concept_id, standard_concept_id) or None if the code is not in the vocabulary.
+            standard_concept_id is None if the concept has no standard concept
+        """
+        key = (vocabulary_id, code)
+        concept = self._cache.get(key, _MISSING)
+        if concept is _MISSING:
+            concept = self._cache[key] = self._get_connection().execute(
+                'SELECT concept_id, standard_concept_id FROM concepts WHERE vocabulary_id = ? AND concept_code = ?',
+                key).fetchone()
+        return concept
+
+    def get_concept_id(self, vocabulary_id, code):
+        """
+        :return: the id of the concept of code, or None if it is not in the vocabulary
+        """
+        concept = self.get_concept(vocabulary_id, code)
+        return concept[0] if concept is not None else None
+
+    def get_standard_concept_id(self, vocabulary_id, code):
+        """
+        :return: the id of the standard concept of code, or None if there is none
+        """
+        concept = self.get_concept(vocabulary_id, code)
+        return concept[1] if concept is not None else None
+
+    @staticmethod
+    def _read_csv(path, columns):
+        # the Athena files are tab separated and contain long fields and quotes in the names
+        csv.field_size_limit(sys.maxsize)
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+            header = next(reader)
+            indexes = [header.index(c) for c in columns]
+            for row in reader:
+                yield tuple(row[i] for i in indexes)
+
+    @classmethod
+    def build(cls, path, concept_file, concept_relationship_file, vocabularies=None):
+        """
+        Creates the index from the CONCEPT.csv and CONCEPT_RELATIONSHIP.csv files of an Athena download
+        :param path: the path of the index. It is replaced if it exists
+        :param concept_file: the path of CONCEPT.csv
+        :param concept_relationship_file: the path of CONCEPT_RELATIONSHIP.csv
+        :param vocabularies: if specified, only the concepts of these vocabulary ids are indexed
+        :return: the ConceptIndex
+        """
+        tmp_path = f'{path}.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        try:
+            connection.execute('PRAGMA journal_mode=OFF')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TEMP TABLE source_concepts ('
+                               'concept_id INTEGER PRIMARY KEY, vocabulary_id TEXT, concept_code TEXT, '
+                               'standard_concept TEXT)')
+            rows = cls._read_csv(concept_file, ('concept_id', 'vocabulary_id', 'concept_code', 'standard_concept'))
+            if vocabularies is not None:
+                vocabularies = set(vocabularies)
+                rows = (r for r in rows if r[1] in vocabularies)
+            connection.executemany('INSERT INTO source_concepts VALUES (?, ?, ?, ?)', rows)
+
+            connection.execute('CREATE TEMP TABLE maps_to (concept_id_1 INTEGER, concept_id_2 INTEGER)')
+            connection.executemany('INSERT INTO maps_to VALUES (?, ?)', (
+                (r[0], r[1]) for r in cls._read_csv(
+                    concept_relationship_file, ('concept_id_1', 'concept_id_2', 'relationship_id', 'invalid_reason'))
+                if r[2] == 'Maps to' and r[3] == ''))
+            connection.execute('CREATE INDEX temp.maps_to_concept ON maps_to (concept_id_1)')
+
+            # a concept can map to several standard concepts (e.g., a condition and a finding): the lowest id is used
+            connection.execute('CREATE TABLE concepts ('
+                               'vocabulary_id TEXT NOT NULL, '
+                               'concept_code TEXT NOT NULL, '
+                               'concept_id INTEGER NOT NULL, '
+                               'standard_concept_id INTEGER, '
+                               'PRIMARY KEY (vocabulary_id, concept_code)) WITHOUT ROWID')
+            connection.execute('INSERT OR IGNORE INTO concepts '
+                               'SELECT vocabulary_id, concept_code, concept_id, '
+                               "CASE WHEN standard_concept = 'S' THEN concept_id ELSE ("
+                               '  SELECT MIN(concept_id_2) FROM maps_to WHERE concept_id_1 = concept_id'
+                               ') END '
+                               'FROM source_concepts ORDER BY vocabulary_id, concept_code')
+            connection.commit()
+            count = connection.execute('SELECT COUNT(*) FROM concepts').fetchone()[0]
+        finally:
+            connection.close()
+        os.replace(tmp_path, path)
+        logger.info('Created the concept index %s with %s concepts', path, count)
+        return cls(path)
@@ -0,0 +1,150 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Measures the import time of the main entry points of the package with python -X importtime, in a new interpreter
+for each run, and checks that they do not import the modules they should not need (e.g., fhirclient for the OMOP
+conversions). The results are printed as JSON and can be compared with the ones of a previous run, failing when an
+entry point became slower than the tolerance:
+
+    python -m benchmarks.import_time --output import_time.json
+    python -m benchmarks.import_time --compare import_time.json --tolerance 0.2
+
+With --package-dir the package is imported from another directory, e.g. a git worktree of a previous version, to
+compare the current import times with the ones of that version. The entry points missing there are skipped
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+# the entry points and the top level packages that they must not import
+ENTRY_POINTS = {
+    'bbmri_fp_etl.cli': ('fhirclient', 'requests', 'pydantic', 'asyncio'),
+    'bbmri_fp_etl.converter': ('fhirclient', 'requests', 'pydantic', 'asyncio'),
+    'bbmri_fp_etl.serializer': ('fhirclient', 'requests', 'pydantic', 'asyncio', 'tarfile', 'sqlite3'),
+    'bbmri_fp_etl.destinations.omop': ('fhirclient', 'requests'),
+    'bbmri_fp_etl.destinations.fhir_fast': ('fhirclient', 'requests'),
+    # the fhirclient models import requests
+    'bbmri_fp_etl.destinations.fhir': (),
+}
+
+
+def _import_time(module, package_dir=None):
+    """
+    Imports module in a new interpreter and returns its cumulative import time in microseconds and the set of the
+    top level packages imported, or None if the module does not exist
+    """
+    # the bytecode is written, so that only the first import measures the compilation of the modules
+    env = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             capture_output=True, text=True, cwd=package_dir, env=env)
+    if process.returncode != 0:
+        if 'ModuleNotFoundError' in process.stderr:
+            return None, None
+        raise RuntimeError(f'Import of {module} failed:\n{process.stderr}')
+    cumulative = None
+    packages = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative_us, name = line.split('|')
+        name = name.strip()
+        packages.add(name.split('.')[0])
+        if name == module:
+            cumulative = int(cumulative_us)
+    return cumulative, packages
+
+
+def run(repeat, package_dir=None):
+    results = {}
+    for module, forbidden in ENTRY_POINTS.items():
+        # warm up run, that compiles the modules
+        if _import_time(module, package_dir)[0] is None:
+            print(f'{module}: not found', file=sys.stderr)
+            continue
+        times = []
+        packages = set()
+        for _ in range(repeat):
+            cumulative, packages = _import_time(module, package_dir)
+            times.append(cumulative)
+        results[module] = {
+            'min_us': min(times),
+            'median_us': statistics.median(times),
+            'forbidden_imports': sorted(packages.intersection(forbidden))
+        }
+        print(f'{module}: {results[module]}', file=sys.stderr)
+    return results
+
+
+def compare(previous, current, tolerance):
+    """
+    Prints, for each entry point, the ratio between the current and the previous import time and returns False if
+    any of them increased more than tolerance
+    """
+    ok = True
+    for module, result in current['entry_points'].items():
+        try:
+            previous_us = previous['entry_points'][module]['min_us']
+        except KeyError:
+            continue
+        ratio = result['min_us'] / previous_us
+        print(f'{module}: {previous_us} -> {result["min_us"]} us ({ratio:.2f}x)', file=sys.stderr)
+        if ratio > 1 + tolerance:
+            ok = False
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the import time of the entry points of the package')
+    parser.add_argument('--repeat', type=int, default=5, help='number of imports of each entry point')
+    parser.add_argument('--output', help='file where the JSON results are written. Default: stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare the import times with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='maximum relative increase of the import times allowed by --compare')
+    parser.add_argument('--package-dir', help='directory from which the package is imported. Default: the current '
+                                              'directory')
+    args = parser.parse_args(argv)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'entry_points': run(args.repeat, args.package_dir)
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    ok = True
+    for module, result in report['entry_points'].items():
+        if result['forbidden_imports']:
+            print(f'{module} imports {", ".join(result["forbidden_imports"])}', file=sys.stderr)
+            ok = False
+    if args.compare:
+        with open(args.compare) as f:
+            ok = compare(json.load(f), report, args.tolerance) and ok
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Benchmarks of the conversion stages using the SyntheticSource. Each stage reports the elapsed time, the number of
+records processed per second, the memory blocks allocated per record and still alive at the end of the stage (for
+the destinations, the ones of the converted data) and the peak RSS of the process at the end of the stage. The
+results are printed as JSON, so that they can be saved and compared between versions:
+
+    python -m benchmarks.run_benchmarks --donors 10000 --output results.json
+    python -m benchmarks.run_benchmarks --donors 10000 --compare results.json
+"""
+
+import argparse
+import copy
+import gc
+import json
+import platform
+import resource
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+from bbmri_fp_etl.destinations.fhir import FHIRDest
+from bbmri_fp_etl.destinations.fhir_fast import FastFHIRDest
+from bbmri_fp_etl.destinations.omop import OMOPDest
+from bbmri_fp_etl.encoders import STDLIB
+from bbmri_fp_etl.serializer import GZIP, BaseOutput, JsonFile, NDJsonFile, StreamingCSVFile, ParquetFile
+
+from benchmarks.synthetic_source import SyntheticSource
+
+
+class CollectingOutput(BaseOutput):
+    """
+    Output that keeps the serialized data in memory, used to measure the destinations without I/O and to replay
+    the same data on the real outputs
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def serialize(self, *args):
+        self.calls.append(args)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _measure(results, stage, records, function):
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    results[stage] = {
+        'records': records,
+        'seconds': round(elapsed, 6),
+        'records_per_sec': round(records / elapsed, 2) if elapsed > 0 else None,
+        'allocated_blocks_per_record': round((sys.getallocatedblocks() - blocks) / records, 2),
+        'peak_rss_mb': round(_peak_rss_mb(), 2)
+    }
+    print(f'{stage}: {results[stage]}', file=sys.stderr)
+
+
+def _convert(destination_class, records, method_name):
+    output = CollectingOutput()
+    destination = destination_class(output)
+    convert = getattr(destination, method_name)
+    for record in records:
+        convert(record)
+    return output
+
+
+def _serialize(output, calls):
+    for args in calls:
+        output.serialize(*args)
+    output.close()
+
+
+def run(source):
+    results = {}
+    cases = []
+    _measure(results, 'model_construction', source.donors, lambda: cases.extend(source.get_cases_data()))
+    trusted_source = copy.copy(source)
+    trusted_source.trusted = True
+    _measure(results, 'model_construction_trusted', source.donors,
+             lambda: sum(1 for _ in trusted_source.get_cases_data()))
+    aggregates = list(source.get_biobanks_data())
+
+    outputs = {}
+    for stage, destination_class, records, method_name in (
+            ('fhir_create_participant', FHIRDest, cases, 'create_participant'),
+            ('fast_fhir_create_participant', FastFHIRDest, cases, 'create_participant'),
+            ('fhir_create_organizations', FHIRDest, aggregates, 'create_organizations'),
+            ('fast_fhir_create_organizations', FastFHIRDest, aggregates, 'create_organizations'),
+            ('omop_create_participant', OMOPDest, cases, 'create_participant')):
+        def _run(d=destination_class, r=records, m=method_name, s=stage):
+            outputs[s] = _convert(d, r, m)
+        _measure(results, stage, len(records), _run)
+
+    fhir_calls = outputs['fast_fhir_create_participant'].calls
+    omop_calls = outputs['omop_create_participant'].calls
+    with tempfile.TemporaryDirectory() as directory:
+        serializers = [
+            ('serialize_json_file', lambda: JsonFile(directory), fhir_calls),
+            ('serialize_ndjson_file', lambda: NDJsonFile(directory), fhir_calls),
+            ('serialize_ndjson_file_stdlib', lambda: NDJsonFile(directory, json_backend=STDLIB), fhir_calls),
+            ('serialize_streaming_csv_file', lambda: StreamingCSVFile(directory), omop_calls),
+            ('serialize_ndjson_file_gzip', lambda: NDJsonFile(directory, compression=GZIP), fhir_calls),
+            ('serialize_streaming_csv_file_gzip', lambda: StreamingCSVFile(directory, compression=GZIP), omop_calls),
+        ]
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print('pyarrow not installed: skipping ParquetFile', file=sys.stderr)
+        else:
+            serializers.append(('serialize_parquet_file', lambda: ParquetFile(directory), omop_calls))
+        for stage, create_output, calls in serializers:
+            _measure(results, stage, source.donors, lambda c=create_output, d=calls: _serialize(c(), d))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the benchmarks of the conversion stages')
+    parser.add_argument('--donors', type=int, default=1000)
+    parser.add_argument('--samples-per-donor', type=int, default=3)
+    parser.add_argument('--events-per-donor', type=int, default=2)
+    parser.add_argument('--mapping-codes', type=int, default=2)
+    parser.add_argument('--collections', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='file where the JSON results are written. Default: stdout')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare the throughput with')
+    args = parser.parse_args(argv)
+
+    source = SyntheticSource(donors=args.donors, samples_per_donor=args.samples_per_donor,
+                             events_per_donor=args.events_per_donor, mapping_codes=args.mapping_codes,
+                             collections=args.collections, seed=args.seed)
+    report = {
+        'version': _get_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {k: v for k, v in vars(args).items() if k not in ('output', 'compare')},
+        'stages': run(source)
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+def compare(previous, current):
+    """
+    Prints, for each stage, the ratio between the current and the previous throughput
+    """
+    if previous['parameters'] != current['parameters']:
+        print('Warning: the runs have different parameters', file=sys.stderr)
+    for stage, result in current['stages'].items():
+        try:
+            previous_rate = previous['stages'][stage]['records_per_sec']
+        except KeyError:
+            continue
+        if previous_rate and result['records_per_sec']:
+            print(f'{stage}: {previous_rate} -> {result["records_per_sec"]} records/s '
+                  f'({result["records_per_sec"] / previous_rate:.2f}x)', file=sys.stderr)
+
+
+def _get_version():
+    try:
+        return metadata.version('bbmri-fp-etl')
+    except metadata.PackageNotFoundError:
+        return None
+
+
+if __name__ == '__main__':
+    main()
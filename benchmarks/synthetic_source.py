@@ -0,0 +1,157 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import random
+from datetime import date, timedelta
+from typing import Iterable
+
+from bbmri_fp_etl.destinations.fhir_constants import COLLECTION_TYPE_MAP, DATA_CATEGORY_MAP, \
+    SPECIMEN_TYPE_MAP as FHIR_SPECIMEN_TYPE_MAP
+from bbmri_fp_etl.destinations.omop import SPECIMEN_TYPE_MAP as OMOP_SPECIMEN_TYPE_MAP
+from bbmri_fp_etl.models import Aggregate, AgeUnit, Biobank, Case, Collection, CollectionType, Contact, \
+    ContactRole, DataCategory, DiagnosisEvent, Disease, DiseaseOntology, DiseaseOntologyCode, Donor, EventType, \
+    Name, RoleType, Sample, SampleType, SamplingEvent, Sex, Telecom, TelecomType, construct
+from bbmri_fp_etl.registry import ModelRegistry
+from bbmri_fp_etl.sources import AbstractSource
+
+# only the sample types that all the destinations can map (i.e., with an OMOP concept id)
+SAMPLE_TYPES = [t for t in SampleType if t in FHIR_SPECIMEN_TYPE_MAP and len(OMOP_SPECIMEN_TYPE_MAP.get(t, ())) == 3]
+SEXES = list(Sex)
+COLLECTION_TYPES = [t for t in CollectionType if t in COLLECTION_TYPE_MAP]
+DATA_CATEGORIES = [c for c in DataCategory if c in DATA_CATEGORY_MAP]
+
+
+class SyntheticSource(AbstractSource):
+    """
+    Source that generates random, but reproducible, MIABIS data. The same seed and parameters always produce the
+    same records. The Cases are generated lazily, so any number of donors can be produced with constant memory.
+    With trusted True, the models are created with models.construct, without validation
+    """
+
+    def __init__(self, donors=1000, samples_per_donor=3, events_per_donor=2, mapping_codes=2, collections=10,
+                 biobanks=2, seed=42, trusted=False):
+        self.donors = donors
+        self.samples_per_donor = samples_per_donor
+        self.events_per_donor = events_per_donor
+        self.mapping_codes = mapping_codes
+        self.collections = collections
+        self.biobanks = biobanks
+        self.seed = seed
+        self.trusted = trusted
+
+    def _new(self, model, **values):
+        return construct(model, **values) if self.trusted else model(**values)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(donors={self.donors}, samples_per_donor={self.samples_per_donor}, ' \
+               f'events_per_donor={self.events_per_donor}, seed={self.seed})'
+
+    def _create_biobank(self, index):
+        return self._new(
+            Biobank,
+            id=f'bbmri-eric:ID:XX_{index}',
+            acronym=f'BB{index}',
+            name=f'Synthetic Biobank {index}',
+            description=f'Synthetic biobank number {index}',
+            jurystic_person=f'Synthetic Institute {index}',
+            url=[f'https://biobank{index}.example.org'],
+            contact=[self._new(
+                Contact,
+                name=self._new(Name, given='John', family=f'Doe{index}'),
+                telecom=[self._new(Telecom, type=TelecomType.EMAIL, value=f'head{index}@example.org')],
+                role=self._new(ContactRole, type=RoleType.HEAD, description='Head of the biobank')
+            ), self._new(
+                Contact,
+                name=self._new(Name, given='Jane', family=f'Roe{index}'),
+                telecom=[self._new(Telecom, type=TelecomType.PHONE, value=f'+39 000 {index:04d}')],
+                role=self._new(ContactRole, type=RoleType.RESEARCHER)
+            )]
+        )
+
+    def _create_collection(self, index, rng, biobanks):
+        return self._new(
+            Collection,
+            id=f'bbmri-eric:ID:XX_{index % self.biobanks}:collection:{index}',
+            name=f'Synthetic Collection {index}',
+            description=f'Synthetic collection number {index}',
+            type=rng.sample(COLLECTION_TYPES, 2),
+            data_category=rng.sample(DATA_CATEGORIES, 2),
+            sex=list(SEXES),
+            age_unit=[AgeUnit.YEARS],
+            biobank=biobanks[index % self.biobanks]
+        )
+
+    def _create_disease(self, rng, registry):
+        # the ICD-10 codes are shared by many diseases, so they are interned
+        return self._new(
+            Disease,
+            main_code=registry.disease_code(DiseaseOntology.ICD_10,
+                                            f'C{rng.randint(0, 99):02d}.{rng.randint(0, 9)}',
+                                            description='Synthetic disease'),
+            mapping_codes=[self._new(DiseaseOntologyCode, ontology=DiseaseOntology.SNOMED,
+                                     code=str(rng.randint(10000000, 99999999)))
+                           for _ in range(self.mapping_codes)]
+        )
+
+    def _create_case(self, index, rng, collections, registry):
+        donor_id = f'donor:{index}'
+        birth_date = date(1930, 1, 1) + timedelta(days=rng.randint(0, 30000))
+        events = [self._new(
+            DiagnosisEvent,
+            id=f'{donor_id}:diagnosis:{e}',
+            event_type=EventType.DIAGNOSIS,
+            age_at_event=rng.randint(1, 90),
+            age_at_event_unit=AgeUnit.YEARS,
+            disease=self._create_disease(rng, registry)
+        ) for e in range(self.events_per_donor)]
+        donor = self._new(
+            Donor,
+            id=donor_id,
+            id_source=f'source:{index}',
+            gender=rng.choice(SEXES),
+            birth_date=birth_date,
+            last_update=date(2024, 1, 1),
+            events=events
+        )
+        samples = []
+        for s in range(self.samples_per_donor):
+            sample_id = f'{donor_id}:sample:{s}'
+            sampling_date = birth_date + timedelta(days=rng.randint(0, 20000))
+            samples.append(self._new(
+                Sample,
+                id=sample_id,
+                type=rng.choice(SAMPLE_TYPES),
+                events=[self._new(SamplingEvent, id=f'{sample_id}:sampling', date_at_event=sampling_date)],
+                content_diagnosis=[self._create_disease(rng, registry)],
+                collection=rng.choice(collections)
+            ))
+        return self._new(Case, donor=donor, samples=samples)
+
+    def get_cases_data(self) -> Iterable[Case]:
+        rng = random.Random(self.seed)
+        registry = ModelRegistry(self.trusted)
+        biobanks = [self._create_biobank(i) for i in range(self.biobanks)]
+        collections = [self._create_collection(i, rng, biobanks) for i in range(self.collections)]
+        for index in range(self.donors):
+            yield self._create_case(index, rng, collections, registry)
+
+    def get_biobanks_data(self) -> Iterable[Aggregate]:
+        rng = random.Random(self.seed)
+        biobanks = [self._create_biobank(i) for i in range(self.biobanks)]
+        yield from biobanks
+        for index in range(self.collections):
+            yield self._create_collection(index, rng, biobanks)
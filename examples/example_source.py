@@ -23,8 +23,9 @@ from typing import Iterable
 from bbmri_fp_etl.converter import Converter
 from bbmri_fp_etl.destinations.fhir import FHIRDest
 from bbmri_fp_etl.destinations.omop import OMOPDest
-from bbmri_fp_etl.models import Donor, Sex, Case, SampleType, SamplingEvent, Sample, Collection
-from bbmri_fp_etl.serializer import JsonFile, CSVFile
+from bbmri_fp_etl.models import Donor, Sex, Case, SampleType, SamplingEvent, Sample
+from bbmri_fp_etl.registry import ModelRegistry
+from bbmri_fp_etl.serializer import JsonFile, StreamingCSVFile
 from bbmri_fp_etl.sources import AbstractSource
 
 # simulating a situation where there is one collection of samples
@@ -87,7 +88,10 @@ class ExampleSource(AbstractSource):
         raise NotImplementedError()
 
     def get_cases_data(self) -> Iterable[Case]:
-        cases = []
+        # the Cases are yielded one at a time so that the Converter can process them without
+        # keeping the whole dataset in memory
+        # all the samples reference the same Collection instance, provided by the registry
+        registry = ModelRegistry()
         for p in PATIENTS:
             donor = Donor(
                 id=p.id,
@@ -106,17 +110,13 @@ class ExampleSource(AbstractSource):
                         id=s.id,
                         type=SPECIMENS_MAPPING[s.type],
                         events=[sampling_event],
-                        collection=Collection(
-                            id=COLLECTION_ID
-                        )
+                        collection=registry.collection(COLLECTION_ID)
                     ))
 
-            cases.append(Case(
+            yield Case(
                 donor=donor,
                 samples=samples
-            ))
-
-        return cases
+            )
 
 
 if __name__ == '__main__':
@@ -130,6 +130,6 @@ if __name__ == '__main__':
     c = Converter(source, fhir_destination, Converter.CASE)
     c.run()
 
-    omop_destination = OMOPDest(CSVFile(output_dir))
+    omop_destination = OMOPDest(StreamingCSVFile(output_dir))
     c = Converter(source, omop_destination, Converter.CASE)
     c.run()
@@ -0,0 +1,129 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import csv
+import json
+import os
+import re
+import tarfile
+import zipfile
+
+import pytest
+
+from bbmri_fp_etl.serializer import ArchiveFile, JsonFile, get_shard_path
+
+BUNDLES = [{'resourceType': 'Bundle', 'id': f'donor-{i}', 'entry': [{'resource': {'id': 'x' * i}}]}
+           for i in range(7)]
+
+
+def _write(output, bundles):
+    for bundle in bundles:
+        output.serialize(bundle['id'], bundle)
+    output.close()
+
+
+def _read_members(path, archive_format):
+    if archive_format == ArchiveFile.TAR:
+        with tarfile.open(path) as tar:
+            return {m.name: json.loads(tar.extractfile(m).read()) for m in tar.getmembers()}
+    with zipfile.ZipFile(path) as z:
+        return {name: json.loads(z.read(name)) for name in z.namelist()}
+
+
+def _read_index(path):
+    with open(f'{path}.index.csv', newline='') as f:
+        return list(csv.reader(f))
+
+
+@pytest.mark.parametrize('archive_format', [ArchiveFile.TAR, ArchiveFile.ZIP])
+def test_archive_contains_the_bundles(tmp_path, archive_format):
+    path = str(tmp_path / f'bundles.{archive_format}')
+    _write(ArchiveFile(path, archive_format), BUNDLES)
+    assert _read_members(path, archive_format) == {f'{b["id"]}.json': b for b in BUNDLES}
+
+
+def test_tar_index_offsets(tmp_path):
+    path = str(tmp_path / 'bundles.tar')
+    _write(ArchiveFile(path), BUNDLES)
+    header, *rows = _read_index(path)
+    assert header == ['name', 'offset', 'size']
+    assert [name for name, _, _ in rows] == [f'{b["id"]}.json' for b in BUNDLES]
+    with tarfile.open(path) as tar, open(path, 'rb') as f:
+        for (name, offset, size), member in zip(rows, tar.getmembers()):
+            # the offset is the one of the data of the member
+            assert int(offset) == member.offset_data
+            f.seek(int(offset))
+            assert f.read(int(size)) == tar.extractfile(member).read()
+
+
+def test_zip_index_offsets(tmp_path):
+    path = str(tmp_path / 'bundles.zip')
+    _write(ArchiveFile(path, ArchiveFile.ZIP), BUNDLES)
+    _, *rows = _read_index(path)
+    with zipfile.ZipFile(path) as z, open(path, 'rb') as f:
+        for (name, offset, size), info in zip(rows, z.infolist()):
+            # the offset is the one of the local header of the member, the size the one of the uncompressed data
+            assert (name, int(offset), int(size)) == (info.filename, info.header_offset, info.file_size)
+            f.seek(int(offset))
+            assert f.read(4) == b'PK\x03\x04'
+
+
+@pytest.mark.parametrize('archive_format', [ArchiveFile.TAR, ArchiveFile.ZIP])
+def test_archive_reopened_after_close(tmp_path, archive_format):
+    path = str(tmp_path / f'bundles.{archive_format}')
+    output = ArchiveFile(path, archive_format)
+    _write(output, BUNDLES[:3])
+    _write(output, BUNDLES[3:])
+
+    # for tar files, the end of archive blocks written by the first close are overwritten: otherwise the members
+    # after them would not be read
+    assert _read_members(path, archive_format) == {f'{b["id"]}.json': b for b in BUNDLES}
+    header, *rows = _read_index(path)
+    assert header == ['name', 'offset', 'size']
+    assert [name for name, _, _ in rows] == [f'{b["id"]}.json' for b in BUNDLES]
+    if archive_format == ArchiveFile.TAR:
+        with tarfile.open(path) as tar:
+            assert [int(offset) for _, offset, _ in rows] == [m.offset_data for m in tar.getmembers()]
+        # the archive ends with a single end of archive marker
+        assert os.path.getsize(path) == output._offset + 2 * tarfile.BLOCKSIZE
+
+
+def test_tar_restored_from_state(tmp_path):
+    path = str(tmp_path / 'bundles.tar')
+    output = ArchiveFile(path)
+    for bundle in BUNDLES[:3]:
+        output.serialize(bundle['id'], bundle)
+    state = output.get_state()
+    _write(output, BUNDLES[3:5])
+
+    # the members written after the state are discarded by a new output restored from it
+    output = ArchiveFile(path)
+    output.restore_state(state)
+    _write(output, BUNDLES[5:])
+    assert _read_members(path, ArchiveFile.TAR) == {f'{b["id"]}.json': b for b in BUNDLES[:3] + BUNDLES[5:]}
+    assert [name for name, _, _ in _read_index(path)[1:]] == [f'{b["id"]}.json' for b in BUNDLES[:3] + BUNDLES[5:]]
+
+
+def test_sharded_json_files(tmp_path):
+    _write(JsonFile(str(tmp_path), shard_depth=2), BUNDLES)
+    paths = sorted(os.path.relpath(os.path.join(root, f), tmp_path)
+                   for root, _, files in os.walk(tmp_path) for f in files)
+    assert paths == sorted(f'{get_shard_path(b["id"], 2)}/{b["id"]}.json' for b in BUNDLES)
+    assert all(re.fullmatch(r'[0-9a-f]{2}/[0-9a-f]{2}/donor-\d\.json', p) for p in paths)
+    for bundle in BUNDLES:
+        with open(tmp_path / get_shard_path(bundle['id'], 2) / f'{bundle["id"]}.json') as f:
+            assert json.load(f) == bundle
@@ -0,0 +1,109 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import json
+import os
+import tarfile
+
+import pytest
+
+from bbmri_fp_etl.converter import Converter
+from bbmri_fp_etl.destinations.fhir_fast import FastFHIRDest
+from bbmri_fp_etl.destinations.omop import OMOPDest
+from bbmri_fp_etl.serializer import GZIP, ArchiveFile, NDJsonFile, StagedOutput, StreamingCSVFile
+from bbmri_fp_etl.sources import AbstractSource
+
+from benchmarks.synthetic_source import SyntheticSource
+
+OUTPUTS = {
+    'streaming_csv': lambda d: OMOPDest(StreamingCSVFile(d)),
+    'streaming_csv_gzip': lambda d: OMOPDest(StreamingCSVFile(d, compression=GZIP)),
+    'ndjson': lambda d: FastFHIRDest(NDJsonFile(d, max_file_size=30000)),
+    'ndjson_gzip': lambda d: FastFHIRDest(NDJsonFile(d, max_file_size=30000, compression=GZIP)),
+    'staged': lambda d: OMOPDest(StagedOutput(StreamingCSVFile(d))),
+    'archive': lambda d: FastFHIRDest(ArchiveFile(os.path.join(d, 'bundles.tar')))
+}
+
+
+class _SourceError(Exception):
+    pass
+
+
+class _Source(AbstractSource):
+    """
+    Source of the Cases of a SyntheticSource, which raises a _SourceError after fail_after Cases
+    """
+
+    def __init__(self, fail_after=None):
+        self.cases = list(SyntheticSource(donors=40, seed=1).get_cases_data())
+        self.fail_after = fail_after
+
+    def get_cases_data(self):
+        for i, case in enumerate(self.cases):
+            if i == self.fail_after:
+                raise _SourceError(f'failed after {i} cases')
+            yield case
+
+    def get_biobanks_data(self):
+        return []
+
+
+def _read_files(directory):
+    """
+    Returns the content of the files in directory, by relative path. The compressed files are decompressed and the
+    members of the tar files are read one by one, since their headers contain the modification time. Of the manifest
+    of StagedOutput only the list of files is kept
+    """
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, directory)
+            if name.endswith('.tar'):
+                with tarfile.open(path) as tar:
+                    files[relative_path] = [(m.name, tar.extractfile(m).read()) for m in tar.getmembers()]
+            elif name == StagedOutput.MANIFEST:
+                with open(path) as f:
+                    files[relative_path] = json.load(f)['files']
+            else:
+                with (gzip.open if name.endswith('.gz') else open)(path, 'rb') as f:
+                    files[relative_path] = f.read()
+    return files
+
+
+def _convert(directory, output, fail_after=None, resume=False, **kwargs):
+    os.makedirs(directory, exist_ok=True)
+    converter = Converter(_Source(fail_after), OUTPUTS[output](str(directory)), Converter.CASE,
+                          checkpoint_path=str(directory.parent / f'{directory.name}.checkpoint'),
+                          checkpoint_interval=10, resume=resume, **kwargs)
+    return converter.run()
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('output', OUTPUTS)
+def test_resumed_output_is_the_same_of_an_uninterrupted_run(tmp_path, output, workers):
+    _convert(tmp_path / 'expected', output)
+    expected = _read_files(tmp_path / 'expected')
+
+    # the records after the last checkpoint are written before the failure, and discarded when resuming
+    with pytest.raises(_SourceError):
+        _convert(tmp_path / 'resumed', output, fail_after=35, workers=workers, chunk_size=7)
+    assert os.path.exists(tmp_path / 'resumed.checkpoint')
+    assert _convert(tmp_path / 'resumed', output, resume=True, workers=workers, chunk_size=7) == 40
+    assert not os.path.exists(tmp_path / 'resumed.checkpoint')
+    assert _read_files(tmp_path / 'resumed') == expected
@@ -0,0 +1,48 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from bbmri_fp_etl.cli import apply_arguments, get_parser, main
+
+yaml = pytest.importorskip('yaml')
+
+
+def _write_config(tmp_path, output):
+    config = {
+        'source': {'class': 'benchmarks.synthetic_source.SyntheticSource', 'args': {'donors': 1}},
+        'destination': {'type': 'omop'}
+    }
+    if output is not None:
+        config['output'] = output
+    path = tmp_path / 'config.yaml'
+    path.write_text(yaml.safe_dump(config))
+    return str(path)
+
+
+def test_compression_overrides_the_output_option():
+    args = get_parser().parse_args(['config.yaml', '--compression', 'zstd'])
+    config = apply_arguments({'output': {'type': 'streaming_csv', 'directory': 'out', 'compression': 'gzip'}}, args)
+    assert config['output']['compression'] == 'zstd'
+
+
+@pytest.mark.parametrize('output', [None, {'type': 'parquet', 'directory': 'out', 'compression': 'snappy'}])
+def test_compression_of_unsupported_outputs(tmp_path, capsys, output):
+    with pytest.raises(SystemExit) as e:
+        main([_write_config(tmp_path, output), '--compression', 'gzip'])
+    assert e.value.code == 2
+    assert '--compression is supported only by the json, ndjson, csv, streaming_csv outputs' in capsys.readouterr().err
@@ -0,0 +1,145 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import os
+import sys
+import threading
+
+import pytest
+
+from bbmri_fp_etl.serializer import GZIP, ZSTD, CSVFile, JsonFile, NDJsonFile, StreamingCSVFile
+
+BUNDLES = [{'resourceType': 'Bundle', 'id': str(i), 'entry': [{'resource': {'resourceType': 'Patient', 'id': str(i)}}]}
+           for i in range(5)]
+ROWS = [{'person_id': i, 'gender': 'F' if i % 2 else 'M'} for i in range(5)]
+
+
+def _decompress(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return f.read()
+    zstandard = pytest.importorskip('zstandard')
+    with open(path, 'rb') as f:
+        # the files appended after a checkpoint contain more zstd frames
+        return zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True).read()
+
+
+def _read_files(directory):
+    files = {}
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(('.gz', '.zst')):
+            files[name.rsplit('.', 1)[0]] = _decompress(path)
+        else:
+            with open(path, 'rb') as f:
+                files[name] = f.read()
+    return files
+
+
+def _write_json(output):
+    for bundle in BUNDLES:
+        output.serialize(bundle['id'], bundle)
+
+
+def _write_ndjson(output):
+    for i, bundle in enumerate(BUNDLES):
+        output.serialize(bundle['id'], bundle)
+        if i == 2:
+            # the compressed streams are ended at the checkpoints, the next data are written in a new member/frame
+            output.get_state()
+
+
+def _write_csv(output):
+    output.serialize('person', ['person_id', 'gender'], ROWS)
+
+
+def _write_streaming_csv(output):
+    output.serialize('person', ['person_id', 'gender'], ROWS[:2])
+    output.get_state()
+    output.serialize('person', ['person_id', 'gender'], ROWS[2:])
+
+
+OUTPUTS = {
+    'json': (JsonFile, _write_json),
+    'ndjson': (lambda d, **kwargs: NDJsonFile(d, max_file_size=300, **kwargs), _write_ndjson),
+    'csv': (CSVFile, _write_csv),
+    'streaming_csv': (StreamingCSVFile, _write_streaming_csv)
+}
+
+
+@pytest.mark.parametrize('compression', [GZIP, ZSTD])
+@pytest.mark.parametrize('output', OUTPUTS)
+def test_compressed_output_round_trip(tmp_path, output, compression):
+    if compression == ZSTD:
+        pytest.importorskip('zstandard')
+    create, write = OUTPUTS[output]
+    for directory, kwargs in [('plain', {}), ('compressed', {'compression': compression})]:
+        os.makedirs(tmp_path / directory)
+        o = create(str(tmp_path / directory), **kwargs)
+        write(o)
+        o.close()
+
+    expected = _read_files(tmp_path / 'plain')
+    assert expected
+    assert _read_files(tmp_path / 'compressed') == expected
+    extension = '.gz' if compression == GZIP else '.zst'
+    assert all(name.endswith(extension) for name in os.listdir(tmp_path / 'compressed'))
+
+
+def test_zstd_requires_zstandard(tmp_path, monkeypatch):
+    # a None entry makes the import fail as if the package was not installed
+    monkeypatch.setitem(sys.modules, 'zstandard', None)
+    with pytest.raises(ImportError, match='pip install zstandard'):
+        NDJsonFile(str(tmp_path), compression=ZSTD)
+    # gzip does not need it
+    output = NDJsonFile(str(tmp_path), compression=GZIP)
+    output.serialize('0', BUNDLES[0])
+    output.close()
+    assert os.listdir(tmp_path) == ['Patient.ndjson.gz']
+
+
+def test_unsupported_compression(tmp_path):
+    with pytest.raises(ValueError, match='Unsupported compression'):
+        JsonFile(str(tmp_path), compression='bz2')
+
+
+def _writer_threads():
+    return [t for t in threading.enumerate() if t.name == 'bbmri_fp_etl-writer']
+
+
+def test_writer_thread_error_is_raised_by_close(tmp_path):
+    # the files are written by the background thread, which fails since the directory does not exist
+    output = JsonFile(str(tmp_path / 'missing'), compression=GZIP)
+    _write_json(output)
+    with pytest.raises(FileNotFoundError):
+        output.close()
+    assert not _writer_threads()
+
+
+def test_writer_thread_error_is_raised_by_flush(tmp_path, monkeypatch):
+    def write(self, data):
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(gzip.GzipFile, 'write', write)
+    output = StreamingCSVFile(str(tmp_path), compression=GZIP)
+    output.serialize('person', ['person_id', 'gender'], ROWS)
+    with pytest.raises(OSError, match='No space left'):
+        output.flush()
+    with pytest.raises(OSError, match='No space left'):
+        output.close()
+    assert not _writer_threads()
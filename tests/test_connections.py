@@ -0,0 +1,48 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+from bbmri_fp_etl.ids import IdAllocator
+
+
+def _allocate(allocator, values):
+    return allocator.get_ids('person', values)
+
+
+def test_connection_is_not_pickled(tmp_path):
+    allocator = IdAllocator(str(tmp_path / 'ids.db'))
+    assert allocator.get_ids('person', ['a', 'b']) == [1, 2]
+    copy = pickle.loads(pickle.dumps(allocator))
+    assert copy._connection is None
+    assert copy.get_ids('person', ['b', 'c']) == [2, 3]
+    copy.close()
+    allocator.close()
+
+
+def test_each_process_opens_its_own_connection(tmp_path):
+    allocator = IdAllocator(str(tmp_path / 'ids.db'))
+    connection = allocator._get_connection()
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(_allocate, [allocator] * 2, [['a', 'b'], ['b', 'c']]))
+    assert allocator._get_connection() is connection
+    # the ids allocated by the workers are seen by the main process
+    ids = dict(zip(['a', 'b', 'b', 'c'], results[0] + results[1]))
+    assert allocator.get_ids('person', ['a', 'b', 'c']) == [ids['a'], ids['b'], ids['c']]
+    assert sorted(ids.values()) == [1, 2, 3]
+    allocator.close()
@@ -0,0 +1,119 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import gc
+import json
+import sys
+
+import pytest
+
+from bbmri_fp_etl.models import AnatomicalSiteOntology, AnatomicalSiteOntologyCode
+
+from benchmarks.run_benchmarks import CollectingOutput
+from benchmarks.synthetic_source import SyntheticSource
+
+fhir = pytest.importorskip('bbmri_fp_etl.destinations.fhir')
+fhir_fast = pytest.importorskip('bbmri_fp_etl.destinations.fhir_fast')
+
+
+def _bundles(destination_class, method_name, records):
+    output = CollectingOutput()
+    convert = getattr(destination_class(output), method_name)
+    for record in records:
+        if isinstance(record, tuple):
+            convert(*record)
+        else:
+            convert(record)
+    return [json.dumps(args) for args in output.calls]
+
+
+def _assert_same_bundles(method_name, records):
+    records = list(records)
+    expected = _bundles(fhir.FHIRDest, method_name, records)
+    assert len(expected) == len(records)
+    assert _bundles(fhir_fast.FastFHIRDest, method_name, records) == expected
+
+
+def test_participants():
+    _assert_same_bundles('create_participant', SyntheticSource(donors=50, seed=1).get_cases_data())
+
+
+def test_organizations():
+    _assert_same_bundles('create_organizations', SyntheticSource(seed=1).get_biobanks_data())
+
+
+def test_contact_name_prefix_and_suffix():
+    biobank = next(iter(SyntheticSource(seed=1).get_biobanks_data()))
+    biobank.contact[0].name.prefix = 'Dr.'
+    biobank.contact[0].name.suffix = 'PhD'
+    _assert_same_bundles('create_organizations', [biobank])
+    bundle = json.loads(_bundles(fhir_fast.FastFHIRDest, 'create_organizations', [biobank])[0])[1]
+    names = [c['name'] for c in bundle['entry'][0]['resource']['contact']]
+    assert names[0]['prefix'] == ['Dr.'] and names[0]['suffix'] == ['PhD']
+    assert 'prefix' not in names[1] and 'suffix' not in names[1]
+
+
+def test_deletes():
+    _assert_same_bundles('delete_participant', [('donor:1', ['donor:1:sample:0'], ['donor:1:diagnosis:0']),
+                                                ('donor:2', ['donor:2:sample:0'], [], False)])
+    _assert_same_bundles('delete_organization', ['biobank:0', 'collection:0'])
+
+
+def test_anatomical_site_with_sampling_date():
+    case = next(iter(SyntheticSource(donors=1, seed=1).get_cases_data()))
+    anatomical_site = AnatomicalSiteOntologyCode(ontology=AnatomicalSiteOntology.UBERON, code='UBERON_0000178',
+                                                 free_text='blood')
+    for sample in case.samples:
+        sample.anatomical_site = anatomical_site
+    _assert_same_bundles('create_participant', [case])
+    bundle = json.loads(_bundles(fhir_fast.FastFHIRDest, 'create_participant', [case])[0])[1]
+    collection = [e['resource'] for e in bundle['entry']
+                  if e['resource']['resourceType'] == 'Specimen'][0]['collection']
+    assert collection['collectedDateTime'] == case.samples[0].events[0].date_at_event.isoformat()
+    assert collection['bodySite']['coding'][0]['code'] == 'UBERON_0000178'
+
+
+def _allocated_blocks_per_record(destination_class, cases):
+    output = CollectingOutput()
+    destination = destination_class(output)
+    # the caches of the ids and the fragments created at the first use are not counted
+    destination.create_participant(cases[0])
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for case in cases[1:]:
+        destination.create_participant(case)
+    gc.collect()
+    return (sys.getallocatedblocks() - blocks) / (len(cases) - 1)
+
+
+def test_fast_bundles_share_fragments():
+    cases = list(SyntheticSource(donors=201, seed=1).get_cases_data())
+    output = CollectingOutput()
+    destination = fhir_fast.FastFHIRDest(output)
+    for case in cases[:2]:
+        destination.create_participant(case)
+    first, second = (args[1]['entry'] for args in output.calls)
+    assert first[0]['resource']['meta'] is second[0]['resource']['meta']
+    first_specimen, second_specimen = (e[-1]['resource'] for e in (first, second))
+    if cases[0].samples[-1].collection.id == cases[1].samples[-1].collection.id:
+        assert first_specimen['extension'][0] is second_specimen['extension'][0]
+    # the lists extended per record are not shared
+    assert first_specimen['type']['coding'] is not second_specimen['type']['coding']
+
+    # FHIRDest creates the same bundles without sharing any fragment
+    assert _allocated_blocks_per_record(fhir_fast.FastFHIRDest, cases) < \
+        0.85 * _allocated_blocks_per_record(fhir.FHIRDest, cases)
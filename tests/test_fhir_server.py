@@ -0,0 +1,144 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from bbmri_fp_etl.serializer import FHIRServer
+
+requests = pytest.importorskip('requests')
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.bundles.append(body)
+            status, headers, delay = server.responses.pop(0) if server.responses else (200, {}, server.delay)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(delay)
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Type', 'application/fhir+json')
+            self.end_headers()
+            self.wfile.write(b'{"resourceType": "Bundle", "type": "transaction-response"}')
+        except OSError:
+            # the client gave up on the request
+            pass
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fhir_server():
+    """
+    Stand-in FHIR server that records the POSTed bundles. The responses list holds the (status, headers, delay) of
+    the next responses, the following ones are 200 after the default delay
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.lock = threading.Lock()
+    server.bundles = []
+    server.responses = []
+    server.delay = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+    server.url = f'http://127.0.0.1:{server.server_address[1]}/fhir/'
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _upload(url, bundles_count, entries_per_bundle=2, **kwargs):
+    output = FHIRServer(url, **kwargs)
+    try:
+        for i in range(bundles_count):
+            output.serialize(f'participant_{i}.json', {
+                'resourceType': 'Bundle',
+                'type': 'transaction',
+                'entry': [{'fullUrl': f'urn:{i}:{e}'} for e in range(entries_per_bundle)]
+            })
+    finally:
+        output.close()
+
+
+def test_bundle_size(fhir_server):
+    _upload(fhir_server.url, 7, bundle_size=3, max_concurrency=1)
+    assert [len(b['entry']) for b in fhir_server.bundles] == [6, 6, 2]
+    assert all(b['type'] == 'transaction' for b in fhir_server.bundles)
+    assert [e['fullUrl'] for b in fhir_server.bundles for e in b['entry']] == \
+           [f'urn:{i}:{e}' for i in range(7) for e in range(2)]
+
+
+def test_max_concurrency(fhir_server):
+    fhir_server.delay = 0.2
+    _upload(fhir_server.url, 8, bundle_size=1, max_concurrency=3)
+    assert len(fhir_server.bundles) == 8
+    assert fhir_server.max_in_flight == 3
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_retry_after(fhir_server, status):
+    fhir_server.responses = [(status, {'Retry-After': '0.2'}, 0), (status, {'Retry-After': '0.2'}, 0)]
+    start = time.monotonic()
+    # without the Retry-After header the retries would wait for the 10 and 20 seconds of the backoff
+    _upload(fhir_server.url, 1, backoff_factor=10)
+    assert 0.4 <= time.monotonic() - start < 5
+    assert len(fhir_server.bundles) == 3
+    assert fhir_server.bundles[0] == fhir_server.bundles[2]
+
+
+def test_retry_backoff(fhir_server):
+    fhir_server.responses = [(502, {}, 0)]
+    _upload(fhir_server.url, 1, backoff_factor=0.01)
+    assert len(fhir_server.bundles) == 2
+
+
+def test_retry_limit(fhir_server):
+    fhir_server.responses = [(500, {}, 0)] * 3
+    with pytest.raises(requests.HTTPError):
+        _upload(fhir_server.url, 1, max_retries=2, backoff_factor=0)
+    assert len(fhir_server.bundles) == 3
+
+
+def test_client_error(fhir_server):
+    fhir_server.responses = [(400, {}, 0)]
+    with pytest.raises(requests.HTTPError) as e:
+        _upload(fhir_server.url, 1, backoff_factor=0)
+    assert e.value.response.status_code == 400
+    assert len(fhir_server.bundles) == 1
+
+
+def test_timeout(fhir_server):
+    fhir_server.responses = [(200, {}, 1)]
+    _upload(fhir_server.url, 1, timeout=0.2, backoff_factor=0)
+    assert len(fhir_server.bundles) == 2
@@ -0,0 +1,90 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import tarfile
+
+import pytest
+
+from bbmri_fp_etl.converter import Converter
+from bbmri_fp_etl.destinations.fhir_fast import FastFHIRDest
+from bbmri_fp_etl.destinations.omop import OMOPDest
+from bbmri_fp_etl.serializer import ArchiveFile, JsonFile, NDJsonFile, StagedOutput, StreamingCSVFile
+
+from benchmarks.synthetic_source import SyntheticSource
+
+OUTPUTS = {
+    'json': lambda d: FastFHIRDest(JsonFile(d, shard_depth=1)),
+    'ndjson_resource': lambda d: FastFHIRDest(NDJsonFile(d, max_file_size=20000)),
+    'ndjson_bundle': lambda d: FastFHIRDest(NDJsonFile(d, mode=NDJsonFile.BUNDLE)),
+    'archive': lambda d: FastFHIRDest(ArchiveFile(os.path.join(d, 'bundles.tar'))),
+    'streaming_csv': lambda d: OMOPDest(StreamingCSVFile(d)),
+    'staged_streaming_csv': lambda d: OMOPDest(StagedOutput(StreamingCSVFile(d)))
+}
+
+
+def _read_files(directory):
+    """
+    Returns the content of the files in directory, by relative path. The members of the tar files are read one by
+    one, since their headers contain the modification time
+    """
+    files = {}
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            relative_path = os.path.relpath(path, directory)
+            if name.endswith('.tar'):
+                with tarfile.open(path) as tar:
+                    files[relative_path] = [(m.name, tar.extractfile(m).read()) for m in tar.getmembers()]
+            elif name != StagedOutput.MANIFEST:  # the manifest contains the creation time
+                with open(path, 'rb') as f:
+                    files[relative_path] = f.read()
+    return files
+
+
+def _convert(directory, output, **kwargs):
+    os.makedirs(directory)
+    destination = OUTPUTS[output](str(directory))
+    Converter(SyntheticSource(donors=40, seed=1), destination, Converter.CASE, **kwargs).run()
+    return _read_files(directory)
+
+
+@pytest.mark.parametrize('output', OUTPUTS)
+def test_ordered_output_is_the_same_of_one_worker(tmp_path, output):
+    expected = _convert(tmp_path / 'sequential', output)
+    assert expected
+    assert _convert(tmp_path / 'parallel', output, workers=2, chunk_size=7) == expected
+
+
+def _sorted_lines(files):
+    lines = {}
+    for path, content in files.items():
+        if path.endswith('.index.csv'):  # the offsets depend on the order of the members
+            lines[path] = sorted(line.split(b',')[::2] for line in content.splitlines())
+        else:
+            lines[path] = sorted(content.splitlines()) if isinstance(content, bytes) else sorted(content)
+    return lines
+
+
+@pytest.mark.parametrize('output', ['json', 'ndjson_bundle', 'archive', 'streaming_csv'])
+def test_unordered_output_has_the_same_content(tmp_path, output):
+    expected = _convert(tmp_path / 'sequential', output)
+    files = _convert(tmp_path / 'parallel', output, workers=2, chunk_size=7, ordered=False)
+    if output == 'json':
+        assert files == expected
+    else:
+        assert _sorted_lines(files) == _sorted_lines(expected)
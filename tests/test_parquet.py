@@ -0,0 +1,81 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+
+from bbmri_fp_etl.destinations.omop import OMOPDest
+from bbmri_fp_etl.ids import IdAllocator
+from bbmri_fp_etl.serializer import ParquetFile, StagedOutput
+from bbmri_fp_etl.vocabulary import ConceptIndex
+
+from benchmarks.synthetic_source import SyntheticSource
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+def _convert(output_dir, **kwargs):
+    destination = OMOPDest(StagedOutput(ParquetFile(str(output_dir))), **kwargs)
+    for case in SyntheticSource(donors=10, seed=1).get_cases_data():
+        destination.create_participant(case)
+    destination.output.commit()
+    destination.close()
+
+
+def _get_type(path, column):
+    return str(pq.read_schema(path).field(column).type)
+
+
+def test_source_ids_are_strings(tmp_path):
+    _convert(tmp_path)
+    assert _get_type(tmp_path / 'person.parquet', 'person_id') == 'string'
+    assert _get_type(tmp_path / 'specimen.parquet', 'specimen_id') == 'string'
+
+
+def test_allocated_ids_are_integers(tmp_path):
+    _convert(tmp_path / 'output', id_allocator=IdAllocator(str(tmp_path / 'ids.db')))
+    output_dir = tmp_path / 'output'
+    for table, columns in (('person', ('person_id',)),
+                           ('specimen', ('specimen_id', 'person_id')),
+                           ('condition_occurrence', ('condition_occurrence_id', 'person_id')),
+                           ('observation_period', ('observation_period_id', 'person_id'))):
+        for column in columns:
+            assert _get_type(output_dir / f'{table}.parquet', column) == 'int64'
+    assert pq.read_table(output_dir / 'person.parquet').column('person_id').to_pylist() == list(range(1, 11))
+
+
+def _build_vocabulary(tmp_path):
+    # the ICD-10 codes of the SyntheticSource (C00.0 to C99.9), all mapped to the same standard concept
+    icd10_codes = [f'C{i:02d}.{j}' for i in range(100) for j in range(10)]
+    concept_file = tmp_path / 'CONCEPT.csv'
+    concept_file.write_text('concept_id\tvocabulary_id\tconcept_code\tstandard_concept\n'
+                            '1\tSNOMED\t363346000\tS\n' +
+                            ''.join(f'{i}\tICD10\t{code}\t\n' for i, code in enumerate(icd10_codes, 2)))
+    relationship_file = tmp_path / 'CONCEPT_RELATIONSHIP.csv'
+    relationship_file.write_text('concept_id_1\tconcept_id_2\trelationship_id\tinvalid_reason\n' +
+                                 ''.join(f'{i}\t1\tMaps to\t\n' for i in range(2, len(icd10_codes) + 2)))
+    return ConceptIndex.build(str(tmp_path / 'concepts.db'), str(concept_file), str(relationship_file))
+
+
+def test_vocabulary_concept_ids_are_integers(tmp_path):
+    _convert(tmp_path / 'output', vocabulary=_build_vocabulary(tmp_path))
+    output_dir = tmp_path / 'output'
+    for column in ('condition_concept_id', 'condition_source_concept_id'):
+        assert _get_type(output_dir / 'condition_occurrence.parquet', column) == 'int64'
+    assert _get_type(output_dir / 'specimen.parquet', 'disease_status_concept_id') == 'int64'
+    conditions = pq.read_table(output_dir / 'condition_occurrence.parquet')
+    assert set(conditions.column('condition_concept_id').to_pylist()) == {1}
+    assert all(i > 1 for i in conditions.column('condition_source_concept_id').to_pylist())
@@ -0,0 +1,143 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import itertools
+import threading
+
+import pytest
+
+from bbmri_fp_etl.converter import Converter
+from bbmri_fp_etl.serializer import BaseOutput
+from bbmri_fp_etl.sources import AbstractSource, KeysetPaginatedSource
+from bbmri_fp_etl.utils import chunks
+
+from benchmarks.synthetic_source import SyntheticSource
+
+
+class _SourceError(Exception):
+    pass
+
+
+class _Source(AbstractSource):
+    """
+    Source of the Cases of a SyntheticSource. It raises a _SourceError after fail_after Cases and, with repeat, returns
+    the Cases forever
+    """
+
+    def __init__(self, donors=25, fail_after=None, repeat=False):
+        self.cases = list(SyntheticSource(donors=donors, seed=1).get_cases_data())
+        self.fail_after = fail_after
+        self.repeat = repeat
+
+    def get_cases_data(self):
+        cases = itertools.cycle(self.cases) if self.repeat else self.cases
+        for i, case in enumerate(cases):
+            if i == self.fail_after:
+                raise _SourceError(f'failed after {i} cases')
+            yield case
+
+    def get_biobanks_data(self):
+        return SyntheticSource(seed=1).get_biobanks_data()
+
+
+class _PagedSource(KeysetPaginatedSource):
+
+    def __init__(self, donors=25):
+        self.cases = sorted(SyntheticSource(donors=donors, seed=1).get_cases_data(), key=self.get_case_key)
+        self.pages = []
+
+    def get_cases_page(self, after_key, limit):
+        self.pages.append(after_key)
+        cases = [c for c in self.cases if after_key is None or self.get_case_key(c) > after_key]
+        return cases[:limit]
+
+    def get_biobanks_data(self):
+        return []
+
+
+class _Destination:
+    """
+    Destination that keeps the ids of the converted records. It raises a ValueError after fail_after records
+    """
+
+    def __init__(self, fail_after=None):
+        self.output = BaseOutput()
+        self.ids = []
+        self.fail_after = fail_after
+
+    def create_participant(self, record):
+        if len(self.ids) == self.fail_after:
+            raise ValueError('conversion failed')
+        self.ids.append(record.donor.id)
+
+    def create_organizations(self, record):
+        self.ids.append(record.id)
+
+    def close(self):
+        pass
+
+
+def _prefetch_threads():
+    return [t for t in threading.enumerate() if t.name == 'bbmri-fp-etl-prefetch']
+
+
+def test_chunks():
+    assert list(chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunks([], 3)) == []
+
+
+@pytest.mark.parametrize('options', [{'prefetch': 2, 'source_batch_size': 4},
+                                     {'use_async': True, 'source_batch_size': 4}])
+def test_prefetch_keeps_the_order(options):
+    source = _Source()
+    destination = _Destination()
+    assert Converter(source, destination, Converter.CASE, **options).run() == len(source.cases)
+    assert destination.ids == [c.donor.id for c in source.cases]
+
+    destination = _Destination()
+    Converter(source, destination, Converter.ORGANIZATION, **options).run()
+    assert destination.ids == [a.id for a in source.get_biobanks_data()]
+
+
+@pytest.mark.parametrize('options', [{'prefetch': 1, 'source_batch_size': 4}, {'use_async': True}])
+def test_source_errors_reach_the_caller(options):
+    source = _Source(fail_after=10)
+    destination = _Destination()
+    with pytest.raises(_SourceError, match='failed after 10 cases'):
+        Converter(source, destination, Converter.CASE, **options).run()
+    assert destination.ids == [c.donor.id for c in source.cases[:len(destination.ids)]]
+    assert not _prefetch_threads()
+
+
+@pytest.mark.parametrize('options', [{'prefetch': 2, 'source_batch_size': 4}, {'use_async': True}])
+def test_prefetch_thread_stops_with_the_consumer(options):
+    # the source never ends: the prefetch thread is blocked on the full queue when the conversion fails
+    destination = _Destination(fail_after=5)
+    with pytest.raises(ValueError, match='conversion failed'):
+        Converter(_Source(repeat=True), destination, Converter.CASE, **options).run()
+    assert len(destination.ids) == 5
+    assert not _prefetch_threads()
+
+
+def test_keyset_pagination():
+    source = _PagedSource()
+    batches = list(source.iter_case_batches(10))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert source.pages == [None, batches[0][-1].donor.id, batches[1][-1].donor.id]
+    destination = _Destination()
+    Converter(source, destination, Converter.CASE, prefetch=1, source_batch_size=10).run()
+    assert destination.ids == [c.donor.id for c in source.cases]
@@ -0,0 +1,112 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import json
+import os
+
+import pytest
+
+from bbmri_fp_etl.serializer import JsonFile, NDJsonFile, StagedOutput, StreamingCSVFile, get_shard_path
+
+
+@pytest.fixture
+def events(monkeypatch):
+    """
+    Records the fsync of the files and directories and the renames done by StagedOutput
+    """
+    events = []
+    fsync = StagedOutput._fsync
+    replace = os.replace
+
+    def record_fsync(path):
+        events.append(('fsync', os.path.normpath(path)))
+        fsync(path)
+
+    def record_replace(src, dst):
+        events.append(('replace', os.path.normpath(src)))
+        replace(src, dst)
+
+    def fail_sync():
+        raise AssertionError('os.sync() must not be called')
+
+    monkeypatch.setattr(StagedOutput, '_fsync', staticmethod(record_fsync))
+    monkeypatch.setattr(os, 'replace', record_replace)
+    monkeypatch.setattr(os, 'sync', fail_sync, raising=False)
+    return events
+
+
+def _synced(events):
+    paths = {path for event, path in events if event == 'fsync'}
+    events.clear()
+    return paths
+
+
+def test_checkpoint_syncs_only_the_new_files(tmp_path, events, monkeypatch):
+    output = StagedOutput(JsonFile(str(tmp_path), shard_depth=1))
+    staging_dir = os.path.join(tmp_path, StagedOutput.STAGING_DIR)
+    # the staging tree is not walked at the checkpoints
+    monkeypatch.setattr(output, '_get_staged_files', lambda: pytest.fail('the staging dir has been walked'))
+
+    def path(file_name):
+        return os.path.join(staging_dir, get_shard_path(file_name, 1), f'{file_name}.json')
+
+    output.serialize('a', {'id': 'a'})
+    output.serialize('b', {'id': 'b'})
+    output.get_state()
+    assert _synced(events) == {path('a'), path('b'), os.path.dirname(path('a')), os.path.dirname(path('b')),
+                               staging_dir}
+
+    output.serialize('c', {'id': 'c'})
+    output.get_state()
+    assert _synced(events) == {path('c'), os.path.dirname(path('c')), staging_dir}
+
+    output.get_state()
+    assert _synced(events) == {staging_dir}
+
+
+def test_checkpoint_syncs_the_open_and_rolled_over_files(tmp_path, events):
+    output = StagedOutput(NDJsonFile(str(tmp_path), mode=NDJsonFile.BUNDLE, max_file_size=100))
+    staging_dir = os.path.join(tmp_path, StagedOutput.STAGING_DIR)
+    bundle = {'resourceType': 'Bundle', 'entry': [], 'id': 'x' * 60}
+
+    output.serialize('a', bundle)
+    output.get_state()
+    assert os.path.join(staging_dir, 'bundles.ndjson') in _synced(events)
+
+    # the file open at the previous checkpoint is written and closed when the next part is started
+    output.serialize('b', bundle)
+    assert _synced(events) == set()
+    output.get_state()
+    assert {os.path.join(staging_dir, 'bundles.ndjson'), os.path.join(staging_dir, 'bundles.1.ndjson')} <= \
+        _synced(events)
+
+
+def test_files_are_synced_before_they_are_published(tmp_path, events):
+    output = StagedOutput(StreamingCSVFile(str(tmp_path)))
+    staging_dir = os.path.join(tmp_path, StagedOutput.STAGING_DIR)
+    output.serialize('person', ['person_id'], [{'person_id': 1}])
+    output.serialize('specimen', ['specimen_id'], [{'specimen_id': 2}])
+    output.commit()
+    output.close()
+
+    first_replace = next(i for i, (event, _) in enumerate(events) if event == 'replace')
+    synced = {path for event, path in events[:first_replace] if event == 'fsync'}
+    assert {os.path.join(staging_dir, 'person.csv'), os.path.join(staging_dir, 'specimen.csv'),
+            staging_dir} <= synced
+    with open(os.path.join(tmp_path, StagedOutput.MANIFEST)) as f:
+        assert set(json.load(f)['files']) == {'person.csv', 'specimen.csv'}
+    assert not os.path.exists(staging_dir)
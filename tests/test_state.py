@@ -0,0 +1,96 @@
+# Copyright (c) CRS4 2024
+#
+# This file is part of BBMRI-FP-ETL.
+#
+# BBMRI-FP-ETL is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# BBMRI-FP-ETL is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with BBMRI-FP-ETL. If not, see <https://www.gnu.org/licenses/>.
+
+import sqlite3
+
+from bbmri_fp_etl.converter import Converter
+from bbmri_fp_etl.destinations.fhir_fast import FastFHIRDest
+from bbmri_fp_etl.serializer import JsonFile
+from bbmri_fp_etl.sources import AbstractSource
+from bbmri_fp_etl.state import StateStore, content_hash
+
+from benchmarks.synthetic_source import SyntheticSource
+
+
+class _ListSource(AbstractSource):
+
+    def __init__(self, cases):
+        self.cases = cases
+
+    def get_cases_data(self):
+        return iter(self.cases)
+
+    def get_biobanks_data(self):
+        return iter([])
+
+
+def _get_cases(donors=5):
+    return list(SyntheticSource(donors=donors, seed=1).get_cases_data())
+
+
+def test_hash_includes_the_fields_of_the_subclasses():
+    case = _get_cases(1)[0]
+    hash_ = content_hash(case)
+    # the synthetic codes are between C00.0 and C99.9
+    case.donor.events[0].disease.main_code.code = 'X99.9'
+    assert content_hash(case) != hash_
+
+
+def test_incremental_run_converts_the_changed_subclass_fields(tmp_path):
+    cases = _get_cases()
+    state_store = StateStore(str(tmp_path / 'state.db'))
+    Converter(_ListSource(cases), FastFHIRDest(JsonFile(str(tmp_path))), Converter.CASE, state_store=state_store).run()
+    cases[2].donor.events[0].disease.main_code.code = 'X99.9'
+    converter = Converter(_ListSource(cases), FastFHIRDest(JsonFile(str(tmp_path))), Converter.CASE,
+                          state_store=state_store)
+    assert converter.run() == 1
+    assert converter.skipped == len(cases) - 1
+    state_store.close()
+
+
+def test_delete_removes_only_the_children_of_the_kind(tmp_path):
+    state_store = StateStore(str(tmp_path / 'state.db'))
+    state_store.update(Converter.CASE, 'x', 'a', {StateStore.SAMPLE: ['s1', 's2'], StateStore.EVENT: ['e1']})
+    state_store.update(Converter.ORGANIZATION, 'x', 'b')
+    assert state_store.get_children(StateStore.SAMPLE, 'x') == ['s1', 's2']
+
+    state_store.delete(Converter.ORGANIZATION, 'x')
+    assert state_store.get_hash(Converter.ORGANIZATION, 'x') is None
+    assert state_store.get_hash(Converter.CASE, 'x') == 'a'
+    assert state_store.get_children(StateStore.SAMPLE, 'x') == ['s1', 's2']
+    assert state_store.get_children(StateStore.EVENT, 'x') == ['e1']
+
+    state_store.delete(Converter.CASE, 'x')
+    assert state_store.get_children(StateStore.SAMPLE, 'x') == []
+    assert state_store.get_children(StateStore.EVENT, 'x') == []
+    state_store.close()
+
+
+def test_stores_without_parent_kind_are_migrated(tmp_path):
+    path = str(tmp_path / 'state.db')
+    connection = sqlite3.connect(path)
+    connection.execute('CREATE TABLE records (kind TEXT NOT NULL, id TEXT NOT NULL, parent_id TEXT, hash TEXT, '
+                       'seen INTEGER NOT NULL DEFAULT 1, PRIMARY KEY (kind, id))')
+    connection.executemany('INSERT INTO records VALUES (?, ?, ?, ?, 1)',
+                           [(Converter.CASE, 'x', None, 'a'), (StateStore.SAMPLE, 's1', 'x', None)])
+    connection.commit()
+    connection.close()
+
+    state_store = StateStore(path)
+    state_store.delete(Converter.CASE, 'x')
+    assert state_store.get_children(StateStore.SAMPLE, 'x') == []
+    state_store.close()